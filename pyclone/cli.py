@@ -72,6 +72,20 @@ def main():
 
     _setup_build_table_parser(build_table_parser)
 
+#----------------------------------------------------------------------------------------------------------------------
+    export_trace_parser = subparsers.add_parser(
+        'export_trace',
+        help='''Export the MCMC trace to the legacy bz2 compressed tsv format.''')
+
+    _setup_export_trace_parser(export_trace_parser)
+
+#----------------------------------------------------------------------------------------------------------------------
+    compile_parser = subparsers.add_parser(
+        'compile',
+        help='''Compile the numba kernels used by the samplers and post processing ahead of time.''')
+
+    _setup_compile_parser(compile_parser)
+
 #----------------------------------------------------------------------------------------------------------------------
     args = parser.parse_args()
 
@@ -84,6 +98,16 @@ def _setup_run_analysis_parser(parser):
 
     _add_seed_args(parser)
 
+    _add_chain_args(parser)
+
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        default=False,
+        help='''Continue an interrupted analysis from the last checkpoint written to the trace directory. The number of
+        chains must match the original run. Only supported for binary format traces.'''
+    )
+
     parser.set_defaults(func=run.run_analysis)
 
 
@@ -94,7 +118,8 @@ def _setup_setup_analysis_parser(parser):
         nargs='+',
         required=True,
         help='''Space delimited list of tsv format files with copy number and allele count information. See 
-        build_mutations_file command for information.'''
+        build_mutations_file command for information. The files are read directly so they should not be moved after
+        setup unless --write_yaml is used.'''
     )
 
     parser.add_argument(
@@ -132,6 +157,14 @@ def _setup_setup_analysis_parser(parser):
 
     _add_init_method_args(parser)
 
+    parser.add_argument(
+        '--sampler',
+        choices=['pydp', 'native'],
+        default='pydp',
+        help='''MCMC sampler engine. `native` runs the Gibbs sweep on arrays in compiled code and is much faster for
+        large datasets. Default is pydp.'''
+    )
+
     parser.add_argument(
         '--num_iters',
         default=10000,
@@ -139,8 +172,24 @@ def _setup_setup_analysis_parser(parser):
         help='''Number of iterations of the MCMC sampler to perform. Default is 10,000.'''
     )
 
+    parser.add_argument(
+        '--trace_format',
+        choices=['binary', 'tsv'],
+        default='binary',
+        help='''Format of the MCMC trace files. `binary` stores fixed width arrays which are much faster to write and
+        load. `tsv` is the legacy bz2 compressed format. Default is binary.'''
+    )
+
     _add_prior_args(parser)
 
+    parser.add_argument(
+        '--write_yaml',
+        action='store_true',
+        default=False,
+        help='''Convert the input files to YAML format mutations files in the working directory. By default the tsv
+        files are read directly by the analysis.'''
+    )
+
     parser.set_defaults(func=run.setup_analysis)
 
 
@@ -152,6 +201,8 @@ def _setup_analysis_pipeline_parser(parser):
 
     _add_seed_args(parser)
 
+    _add_chain_args(parser)
+
     parser.add_argument(
         '--plot_file_format',
         default='pdf',
@@ -216,6 +267,32 @@ def _setup_build_table_parser(parser):
     parser.set_defaults(func=run.build_table)
 
 
+def _setup_export_trace_parser(parser):
+
+    _add_config_file_args(parser)
+
+    parser.add_argument(
+        '--out_dir',
+        required=True,
+        help='''Path of directory where the tsv format trace files will be written.'''
+    )
+
+    parser.set_defaults(func=run.export_trace)
+
+
+def _setup_compile_parser(parser):
+
+    parser.add_argument(
+        '--cache_dir',
+        default=None,
+        help='''Path of directory where the compiled kernels will be cached. Use this when the PyClone install is not
+        writable, and set the NUMBA_CACHE_DIR environment variable to the same path when running PyClone. If not set
+        NUMBA_CACHE_DIR or the numba default location is used.'''
+    )
+
+    parser.set_defaults(func=run.compile_kernels)
+
+
 def _setup_cluster_plot_parser(parser):
 
     _add_config_file_args(parser)
@@ -317,6 +394,25 @@ def _add_seed_args(parser):
     )
 
 
+def _add_chain_args(parser):
+
+    parser.add_argument(
+        '--num_chains',
+        default=1,
+        type=int,
+        help='''Number of independent MCMC chains to run. Post-processing combines the post burnin samples of all
+        chains. Default is 1.'''
+    )
+
+    parser.add_argument(
+        '--jobs',
+        default=1,
+        type=int,
+        help='''Number of processes to use for running chains, and for rendering plots in run_analysis_pipeline.
+        Default is 1.'''
+    )
+
+
 def _add_prior_args(parser):
 
     parser.add_argument(
@@ -379,6 +475,13 @@ def _add_max_clusters_args(parser):
         only the final post-processing steps to get hard cluster assignments.'''
     )
 
+    parser.add_argument(
+        '--clustering_method', choices=['mpear', 'approximate_mpear'], default='mpear',
+        help='''Method used to get hard cluster assignments. `mpear` searches the cuts of the average linkage tree of
+        the posterior similarity matrix, which needs memory quadratic in the number of mutations. `approximate_mpear`
+        searches the partitions sampled in the trace and scales to large numbers of mutations. Default `mpear`.'''
+    )
+
 
 if __name__ == '__main__':
     main()
@@ -8,46 +8,406 @@ from __future__ import division
 from collections import namedtuple, OrderedDict
 from math import log
 
+import hashlib
 import numpy as np
+import os
+
+from pyclone.utils import make_directory
 
 import pyclone.paths as paths
 
 #=======================================================================================================================
 # Load data for sampler
 #=======================================================================================================================
-PyCloneData = namedtuple(
-    'PyCloneData',
+StateTable = namedtuple(
+    'StateTable',
+    [
+        'id',
+        'cn_n',
+        'cn_r',
+        'cn_v',
+        'mu_n',
+        'mu_r',
+        'mu_v',
+        'log_pi'
+    ]
+)
+
+
+class PyCloneData(namedtuple('PyCloneData', ['b', 'd', 'tumour_content', 'state_table'])):
+    '''
+    Data for a mutation in one sample. The states are held in a StateTable shared by all data points with the same
+    states.
+    '''
+    __slots__ = ()
+
+    @property
+    def cn_n(self):
+        return self.state_table.cn_n
+
+    @property
+    def cn_r(self):
+        return self.state_table.cn_r
+
+    @property
+    def cn_v(self):
+        return self.state_table.cn_v
+
+    @property
+    def mu_n(self):
+        return self.state_table.mu_n
+
+    @property
+    def mu_r(self):
+        return self.state_table.mu_r
+
+    @property
+    def mu_v(self):
+        return self.state_table.mu_v
+
+    @property
+    def log_pi(self):
+        return self.state_table.log_pi
+
+    @property
+    def state_table_id(self):
+        return self.state_table.id
+
+
+class StateTableCache(object):
+    '''
+    Intern state tables so data points with the same states share a single StateTable. Tables are numbered with
+    consecutive IDs starting from 0 in the order they are first seen.
+    '''
+
+    def __init__(self):
+        self.tables = []
+
+        self._tables_by_copy_number = {}
+
+        self._tables_by_value = {}
+
+    def get_copy_number_state_table(self, normal_cn, minor_cn, major_cn, prior, error_rate):
+        '''
+        Get the table for the states of a mutation with the given copy number, computing them only the first time.
+        '''
+        key = (normal_cn, minor_cn, major_cn, prior, error_rate)
+
+        if key not in self._tables_by_copy_number:
+            mutation = get_mutation(None, 0, 0, normal_cn, minor_cn, major_cn, prior)
+
+            self._tables_by_copy_number[key] = self.get_mutation_state_table(mutation, error_rate)
+
+        return self._tables_by_copy_number[key]
+
+    def get_mutation_state_table(self, mutation, error_rate):
+        cn_n = np.array([x.cn_n for x in mutation.states])
+        cn_r = np.array([x.cn_r for x in mutation.states])
+        cn_v = np.array([x.cn_v for x in mutation.states])
+
+        mu_n = np.array([x.get_mu_n(error_rate) for x in mutation.states], dtype=np.float64)
+        mu_r = np.array([x.get_mu_r(error_rate) for x in mutation.states], dtype=np.float64)
+        mu_v = np.array([x.get_mu_v(error_rate) for x in mutation.states], dtype=np.float64)
+
+        prior_weights = tuple([x.prior_weight for x in mutation.states])
+
+        log_pi = _get_log_pi(prior_weights)
+
+        return self.get_state_table(cn_n, cn_r, cn_v, mu_n, mu_r, mu_v, log_pi)
+
+    def get_state_table(self, cn_n, cn_r, cn_v, mu_n, mu_r, mu_v, log_pi):
+        arrays = (cn_n, cn_r, cn_v, mu_n, mu_r, mu_v, log_pi)
+
+        key = tuple([tuple(x.tolist()) for x in arrays])
+
+        if key not in self._tables_by_value:
+            table = StateTable(len(self.tables), *arrays)
+
+            self.tables.append(table)
+
+            self._tables_by_value[key] = table
+
+        return self._tables_by_value[key]
+
+
+PyCloneDataBlock = namedtuple(
+    'PyCloneDataBlock',
     [
         'b',
         'd',
         'tumour_content',
+        'state_offsets',
         'cn_n',
         'cn_r',
         'cn_v',
         'mu_n',
         'mu_r',
         'mu_v',
-        'log_pi'
+        'log_pi',
+        'state_table_ids'
     ]
 )
 
 
+def pack_data(data):
+    '''
+    Pack a list of data points into contiguous arrays for batched likelihood evaluation.
+
+    The states of data point i are stored in the slice state_offsets[i]:state_offsets[i + 1] of the state arrays.
+    state_table_ids numbers the distinct state tables in the block, so data points with the same id have the same
+    states.
+
+    Args:
+        data : (list) PyCloneData objects to pack.
+    '''
+    num_states = [len(x.log_pi) for x in data]
+
+    state_offsets = np.zeros(len(data) + 1, dtype=np.int64)
+
+    state_offsets[1:] = np.cumsum(num_states)
+
+    def concatenate(field):
+        if len(data) == 0:
+            return np.zeros(0)
+
+        return np.concatenate([getattr(x, field) for x in data]).astype(np.float64)
+
+    return PyCloneDataBlock(
+        np.array([x.b for x in data], dtype=np.int64),
+        np.array([x.d for x in data], dtype=np.int64),
+        np.array([x.tumour_content for x in data], dtype=np.float64),
+        state_offsets,
+        concatenate('cn_n'),
+        concatenate('cn_r'),
+        concatenate('cn_v'),
+        concatenate('mu_n'),
+        concatenate('mu_r'),
+        concatenate('mu_v'),
+        concatenate('log_pi'),
+        _get_block_state_table_ids(data)
+    )
+
+
+class PyCloneDataset(object):
+    '''
+    Data for all mutations and samples stored in contiguous arrays.
+
+    Behaves like the mapping of mutation IDs to mappings of sample IDs to PyCloneData returned by load_data, with the
+    rows built on demand. Subsets of mutations are selected with integer indices or boolean masks.
+
+    Args:
+        mutation_ids : (list) Mutation IDs, one per row.
+        sample_ids : (list) Sample IDs, one per column.
+        b : (array) Variant allele counts of shape number of mutations by number of samples.
+        d : (array) Total counts of shape number of mutations by number of samples.
+        tumour_content : (array) Tumour content of each sample.
+        state_table_ids : (array) Index in state_tables of the states of each mutation in each sample.
+        state_tables : (list) StateTable objects. Their states are also stored concatenated in the cn_n, cn_r, cn_v,
+            mu_n, mu_r, mu_v and log_pi arrays, with table t in the slice table_offsets[t]:table_offsets[t + 1].
+    '''
+
+    def __init__(self, mutation_ids, sample_ids, b, d, tumour_content, state_table_ids, state_tables):
+        self.mutation_ids = list(mutation_ids)
+
+        self.sample_ids = list(sample_ids)
+
+        self.b = b
+
+        self.d = d
+
+        self.tumour_content = tumour_content
+
+        self.state_table_ids = state_table_ids
+
+        self.state_tables = state_tables
+
+        self.table_sizes = np.array([len(x.log_pi) for x in state_tables], dtype=np.int64)
+
+        self.table_offsets = np.zeros(len(state_tables) + 1, dtype=np.int64)
+
+        self.table_offsets[1:] = np.cumsum(self.table_sizes)
+
+        for field in STATE_TABLE_FIELDS:
+            if len(state_tables) == 0:
+                values = np.zeros(0)
+
+            else:
+                values = np.concatenate([getattr(x, field) for x in state_tables]).astype(np.float64)
+
+            setattr(self, field, values)
+
+        self._index = dict([(x, i) for i, x in enumerate(self.mutation_ids)])
+
+    def __contains__(self, mutation_id):
+        return mutation_id in self._index
+
+    def __getitem__(self, mutation_id):
+        return self.get_data_point(self._index[mutation_id])
+
+    def __iter__(self):
+        return iter(self.mutation_ids)
+
+    def __len__(self):
+        return len(self.mutation_ids)
+
+    def get_data_block(self, sample_id, rows=None):
+        '''
+        Pack the data of a sample for batched likelihood evaluation, without building PyCloneData objects.
+
+        Args:
+            sample_id : (str) Sample to pack.
+            rows : (array) Integer indices or boolean mask of the mutations to pack. If None all mutations are packed.
+        '''
+        s = self.sample_ids.index(sample_id)
+
+        table_ids = self._get_rows(self.state_table_ids[:, s], rows)
+
+        num_states = self.table_sizes[table_ids]
+
+        state_offsets = np.zeros(len(table_ids) + 1, dtype=np.int64)
+
+        state_offsets[1:] = np.cumsum(num_states)
+
+        # Position of every state of the block in the concatenated table arrays.
+        idx = np.repeat(self.table_offsets[table_ids], num_states)
+
+        idx += np.arange(state_offsets[-1]) - np.repeat(state_offsets[:-1], num_states)
+
+        return PyCloneDataBlock(
+            self._get_rows(self.b[:, s], rows).copy(),
+            self._get_rows(self.d[:, s], rows).copy(),
+            np.repeat(self.tumour_content[s], len(table_ids)),
+            state_offsets,
+            self.cn_n[idx],
+            self.cn_r[idx],
+            self.cn_v[idx],
+            self.mu_n[idx],
+            self.mu_r[idx],
+            self.mu_v[idx],
+            self.log_pi[idx],
+            table_ids.copy()
+        )
+
+    def get_data_point(self, i):
+        '''
+        Get the data of the mutation in row i as a mapping of sample IDs to PyCloneData.
+        '''
+        data_point = OrderedDict()
+
+        for s, sample_id in enumerate(self.sample_ids):
+            data_point[sample_id] = PyCloneData(
+                int(self.b[i, s]),
+                int(self.d[i, s]),
+                self.tumour_content[s],
+                self.state_tables[self.state_table_ids[i, s]]
+            )
+
+        return data_point
+
+    def get_index(self, mutation_ids):
+        '''
+        Get the row indices of mutations.
+        '''
+        return np.array([self._index[x] for x in mutation_ids], dtype=np.int64)
+
+    def get_sample_data(self, sample_id, rows=None):
+        '''
+        Get the data of a sample as a list of PyCloneData.
+
+        Args:
+            sample_id : (str) Sample to get.
+            rows : (array) Integer indices or boolean mask of the mutations to get. If None all mutations are used.
+        '''
+        s = self.sample_ids.index(sample_id)
+
+        b = self._get_rows(self.b[:, s], rows)
+
+        d = self._get_rows(self.d[:, s], rows)
+
+        table_ids = self._get_rows(self.state_table_ids[:, s], rows)
+
+        t = self.tumour_content[s]
+
+        return [PyCloneData(int(x), int(y), t, self.state_tables[z]) for x, y, z in zip(b, d, table_ids)]
+
+    def items(self):
+        return zip(self.keys(), self.values())
+
+    def keys(self):
+        return list(self.mutation_ids)
+
+    def subset(self, rows):
+        '''
+        Get a dataset with the selected mutations.
+
+        Args:
+            rows : (array) Integer indices or boolean mask of the mutations to keep.
+        '''
+        return PyCloneDataset(
+            list(np.array(self.mutation_ids, dtype=object)[rows]),
+            self.sample_ids,
+            self.b[rows],
+            self.d[rows],
+            self.tumour_content,
+            self.state_table_ids[rows],
+            self.state_tables
+        )
+
+    def values(self):
+        return [self.get_data_point(i) for i in range(len(self))]
+
+    def _get_rows(self, x, rows):
+        if rows is None:
+            return x
+
+        return x[rows]
+
+
+def _get_block_state_table_ids(data):
+    # Number the tables by object identity so blocks are consistent even if the data was loaded by separate calls.
+    table_ids = {}
+
+    return np.array([table_ids.setdefault(id(x.state_table), len(table_ids)) for x in data], dtype=np.int64)
+
+
 def load_base_measure_params(config_file):
-    config = paths.load_config(config_file)
+    config = paths.get_config(config_file)
 
     params = config['base_measure_params']
 
     return params
 
 
+def load_convergence_params(config_file):
+    '''
+    Load the parameters for early stopping. Returns None if the convergence section is not set, in which case the
+    sampler runs for num_iters iterations.
+    '''
+    config = paths.get_config(config_file)
+
+    if 'convergence' not in config:
+        return None
+
+    params = {
+        'check_interval': 100,
+        'max_r_hat': 1.01,
+        'min_ess': 400,
+        'min_iters': 1000
+    }
+
+    params.update(config['convergence'])
+
+    return params
+
+
 def load_init_method(config_file):
-    config = paths.load_config(config_file)
+    config = paths.get_config(config_file)
 
     return config.get('init_method', 'disconnected')
 
 
 def load_precision_params(config_file):
-    config = paths.load_config(config_file)
+    config = paths.get_config(config_file)
 
     return config['beta_binomial_precision_params']
 
@@ -57,7 +417,68 @@ def load_data(config_file):
     Load data for all samples.
 
     Args:
-        config_file : (str) Path to YAML format configuration file.
+        config_file : (str | PyCloneConfig) Path to YAML format configuration file.
+
+    Returns:
+        data : (OrderedDict) Mapping of mutation IDs to mappings of sample IDs to PyCloneData.
+        sample_ids : (list) Sample IDs.
+    '''
+    sample_data, mutation_ids = _load_samples(config_file)
+
+    sample_ids = sample_data.keys()
+
+    data = OrderedDict()
+
+    for mutation_id in mutation_ids:
+        data[mutation_id] = OrderedDict()
+
+        for sample_id in sample_ids:
+            data[mutation_id][sample_id] = sample_data[sample_id][mutation_id]
+
+    return data, sample_ids
+
+
+def load_dataset(config_file):
+    '''
+    Load data for all samples into a PyCloneDataset.
+
+    Args:
+        config_file : (str | PyCloneConfig) Path to YAML format configuration file.
+    '''
+    sample_data, mutation_ids = _load_samples(config_file)
+
+    sample_ids = sample_data.keys()
+
+    tumour_content = paths.get_tumour_contents(config_file)
+
+    columns = [[sample_data[sample_id][x] for x in mutation_ids] for sample_id in sample_ids]
+
+    # Renumber the tables used by the common mutations consecutively.
+    state_tables = []
+
+    table_ids = {}
+
+    for column in columns:
+        for x in column:
+            if x.state_table_id not in table_ids:
+                table_ids[x.state_table_id] = len(state_tables)
+
+                state_tables.append(x.state_table)
+
+    return PyCloneDataset(
+        mutation_ids,
+        sample_ids,
+        np.array([[x.b for x in column] for column in columns], dtype=np.int64).T,
+        np.array([[x.d for x in column] for column in columns], dtype=np.int64).T,
+        np.array([tumour_content[x] for x in sample_ids], dtype=np.float64),
+        np.array([[table_ids[x.state_table_id] for x in column] for column in columns], dtype=np.int64).T,
+        state_tables
+    )
+
+
+def _load_samples(config_file):
+    '''
+    Load the data of each sample and find the mutations present in all samples.
     '''
     sample_data = OrderedDict()
 
@@ -65,10 +486,21 @@ def load_data(config_file):
 
     tumour_content = paths.get_tumour_contents(config_file)
 
-    for sample_id, file_name in paths.get_mutations_files(config_file).items():
-        sample_data[sample_id] = _load_sample_data(file_name, error_rate[sample_id], tumour_content[sample_id])
+    priors = paths.get_priors(config_file)
 
-    sample_ids = sample_data.keys()
+    cache_dir = paths.get_data_cache_dir(config_file)
+
+    state_tables = StateTableCache()
+
+    for sample_id, file_name in paths.get_mutations_files(config_file).items():
+        sample_data[sample_id] = _load_sample_data(
+            file_name,
+            error_rate[sample_id],
+            tumour_content[sample_id],
+            prior=priors[sample_id],
+            cache_dir=cache_dir,
+            state_tables=state_tables
+        )
 
     common_mutations = set.intersection(*[set(x.keys()) for x in sample_data.values()])
 
@@ -79,21 +511,69 @@ def load_data(config_file):
             ('Search the user group before posting a message or a bug.'),
         )))
 
-    data = OrderedDict()
+    return sample_data, list(common_mutations)
 
-    for mutation_id in common_mutations:
-        data[mutation_id] = OrderedDict()
 
-        for sample_id in sample_ids:
-            data[mutation_id][sample_id] = sample_data[sample_id][mutation_id]
-
-    return data, sample_ids
+def _load_sample_data(file_name, error_rate, tumour_content, prior=None, cache_dir=None, state_tables=None):
+    '''
+    Load data from PyClone formatted input file. Files with a .tsv or .txt extension are read as tsv input files, with
+    states set using the prior method, otherwise as YAML mutations files.
 
+    If cache_dir is set the parsed data is cached there in a npz file keyed by a hash of the input file and error rate,
+    so later loads of an unchanged file skip parsing.
 
-def _load_sample_data(file_name, error_rate, tumour_content):
-    '''
-    Load data from PyClone formatted input file.
+    State tables are interned in state_tables, which should be shared by all samples of an analysis.
     '''
+    if state_tables is None:
+        state_tables = StateTableCache()
+
+    # Values such as tumour_content: 1 are read from YAML as ints. They are passed to the compiled kernels as floats so
+    # the calls match the signatures built by pyclone.kernels.
+    error_rate = float(error_rate)
+
+    tumour_content = float(tumour_content)
+
+    if _is_tsv_file(file_name):
+        if prior is None:
+            raise Exception('The prior must be set in the config file to load the tsv file {0}.'.format(file_name))
+
+        parse_func = _parse_tsv_sample_data
+
+    else:
+        prior = None
+
+        parse_func = _parse_sample_data
+
+    if cache_dir is None:
+        return parse_func(file_name, error_rate, tumour_content, prior, state_tables)
+
+    cache_file = _get_sample_data_cache_file(cache_dir, file_name, error_rate, prior)
+
+    if os.path.exists(cache_file):
+        try:
+            return _load_sample_data_cache(cache_file, tumour_content, state_tables)
+
+        # A cache file which cannot be read, for example because it is truncated or corrupt, is rebuilt.
+        except Exception:
+            pass
+
+    data = parse_func(file_name, error_rate, tumour_content, prior, state_tables)
+
+    try:
+        _write_sample_data_cache(cache_file, data)
+
+    # The cache is an optimisation so failing to write it, for example in a read only directory, is not an error.
+    except (IOError, OSError):
+        pass
+
+    return data
+
+
+def _is_tsv_file(file_name):
+    return os.path.splitext(file_name)[1].lower() in ('.tsv', '.txt')
+
+
+def _parse_sample_data(file_name, error_rate, tumour_content, prior, state_tables):
     data = OrderedDict()
 
     config = paths.load_config(file_name)
@@ -101,30 +581,59 @@ def _load_sample_data(file_name, error_rate, tumour_content):
     for mutation_dict in config['mutations']:
         mutation = load_mutation_from_dict(mutation_dict)
 
-        data[mutation.id] = _get_pyclone_data(mutation, error_rate, tumour_content)
+        data[mutation.id] = _get_pyclone_data(mutation, error_rate, tumour_content, state_tables)
 
     return data
 
 
-def _get_pyclone_data(mutation, error_rate, tumour_content):
-    a = mutation.ref_counts
-    b = mutation.var_counts
+def _parse_tsv_sample_data(file_name, error_rate, tumour_content, prior, state_tables):
+    '''
+    Load data from a tsv input file as used by build_mutations_file.
 
-    d = a + b
+    The states only depend on the copy number of a mutation, so they are computed once for each distinct copy number.
+    '''
+    # Imported here as pandas is slow to import and is not needed to build mutation files.
+    import pandas as pd
 
-    cn_n = np.array([x.cn_n for x in mutation.states])
-    cn_r = np.array([x.cn_r for x in mutation.states])
-    cn_v = np.array([x.cn_v for x in mutation.states])
+    df = pd.read_csv(file_name, sep='\t', dtype={'mutation_id': str})
 
-    mu_n = np.array([x.get_mu_n(error_rate) for x in mutation.states])
-    mu_r = np.array([x.get_mu_r(error_rate) for x in mutation.states])
-    mu_v = np.array([x.get_mu_v(error_rate) for x in mutation.states])
+    cn_cols = ['normal_cn', 'minor_cn', 'major_cn']
 
-    prior_weights = tuple([x.prior_weight for x in mutation.states])
+    tables = {}
 
-    log_pi = _get_log_pi(prior_weights)
+    for key, _ in df.groupby(cn_cols):
+        normal_cn, minor_cn, major_cn = [int(x) for x in key]
 
-    return PyCloneData(b, d, tumour_content, cn_n, cn_r, cn_v, mu_n, mu_r, mu_v, log_pi)
+        if major_cn == 0:
+            raise Exception('Mutations with copy number {0} are invalid. Major CN must be greater 0.'.format(key))
+
+        tables[(normal_cn, minor_cn, major_cn)] = state_tables.get_copy_number_state_table(
+            normal_cn, minor_cn, major_cn, prior, error_rate
+        )
+
+    data = OrderedDict()
+
+    b = df['var_counts'].values.astype(int)
+
+    d = b + df['ref_counts'].values.astype(int)
+
+    cn = df[cn_cols].values.astype(int)
+
+    for i, mutation_id in enumerate(df['mutation_id']):
+        data[mutation_id] = PyCloneData(int(b[i]), int(d[i]), tumour_content, tables[tuple(cn[i])])
+
+    return data
+
+
+def _get_pyclone_data(mutation, error_rate, tumour_content, state_tables):
+    a = mutation.ref_counts
+    b = mutation.var_counts
+
+    d = a + b
+
+    state_table = state_tables.get_mutation_state_table(mutation, error_rate)
+
+    return PyCloneData(b, d, tumour_content, state_table)
 
 
 def _get_log_pi(weights):
@@ -132,6 +641,107 @@ def _get_log_pi(weights):
 
     return np.array([log(x) for x in pi])
 
+#=======================================================================================================================
+# Mutation data cache
+#=======================================================================================================================
+DATA_CACHE_VERSION = 3
+
+STATE_TABLE_FIELDS = ('cn_n', 'cn_r', 'cn_v', 'mu_n', 'mu_r', 'mu_v', 'log_pi')
+
+
+def _get_sample_data_cache_file(cache_dir, file_name, error_rate, prior=None):
+    file_hash = hashlib.sha1()
+
+    file_hash.update('{0}:{1!r}:{2}:'.format(DATA_CACHE_VERSION, float(error_rate), prior))
+
+    with open(file_name, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(2 ** 20), b''):
+            file_hash.update(chunk)
+
+    base_name = os.path.basename(file_name).split('.')[0]
+
+    return os.path.join(cache_dir, '{0}.{1}.npz'.format(base_name, file_hash.hexdigest()))
+
+
+def _load_sample_data_cache(cache_file, tumour_content, state_tables):
+    data = OrderedDict()
+
+    with np.load(cache_file) as fh:
+        arrays = dict(fh.items())
+
+    table_offsets = arrays['table_offsets']
+
+    tables = []
+
+    for t in range(len(table_offsets) - 1):
+        states = slice(table_offsets[t], table_offsets[t + 1])
+
+        tables.append(state_tables.get_state_table(*[arrays[x][states].copy() for x in STATE_TABLE_FIELDS]))
+
+    b = arrays['b']
+
+    d = arrays['d']
+
+    table_ids = arrays['table_ids']
+
+    is_str = arrays['mutation_id_is_str']
+
+    for i, mutation_id in enumerate(arrays['mutation_ids']):
+        mutation_id = unicode(mutation_id)
+
+        if is_str[i]:
+            mutation_id = mutation_id.encode('utf-8')
+
+        data[mutation_id] = PyCloneData(int(b[i]), int(d[i]), tumour_content, tables[table_ids[i]])
+
+    return data
+
+
+def _write_sample_data_cache(cache_file, data):
+    # Mutation IDs are stored as unicode so only cache files where they were parsed as strings.
+    if (len(data) == 0) or (not all([isinstance(x, basestring) for x in data.keys()])):
+        return
+
+    # IDs parsed as str are UTF-8 encoded and flagged so they are loaded as str again. Non-ASCII IDs read from YAML
+    # files are unicode already.
+    try:
+        mutation_ids = [x.decode('utf-8') if isinstance(x, str) else x for x in data.keys()]
+
+    except UnicodeDecodeError:
+        return
+
+    # Store each distinct state table once, numbered in order of first use in this file.
+    tables = OrderedDict()
+
+    for x in data.values():
+        if x.state_table_id not in tables:
+            tables[x.state_table_id] = (len(tables), x.state_table)
+
+    table_offsets = np.zeros(len(tables) + 1, dtype=np.int64)
+
+    table_offsets[1:] = np.cumsum([len(table.log_pi) for _, table in tables.values()])
+
+    arrays = {
+        'mutation_ids': np.array(mutation_ids, dtype=np.unicode_),
+        'mutation_id_is_str': np.array([isinstance(x, str) for x in data.keys()], dtype=bool),
+        'b': np.array([x.b for x in data.values()], dtype=np.int64),
+        'd': np.array([x.d for x in data.values()], dtype=np.int64),
+        'table_ids': np.array([tables[x.state_table_id][0] for x in data.values()], dtype=np.int64),
+        'table_offsets': table_offsets
+    }
+
+    for field in STATE_TABLE_FIELDS:
+        arrays[field] = np.concatenate([getattr(table, field) for _, table in tables.values()])
+
+    make_directory(os.path.dirname(cache_file))
+
+    # Write to a temporary file then rename so concurrent loads never see a partial file.
+    tmp_file = '{0}.{1}.tmp.npz'.format(cache_file, os.getpid())
+
+    np.savez(tmp_file, **arrays)
+
+    os.rename(tmp_file, cache_file)
+
 #=======================================================================================================================
 # Parse mutation dict
 #=======================================================================================================================
@@ -0,0 +1,215 @@
+'''
+Online convergence diagnostics used to stop the MCMC sampler early.
+
+@author: Andrew Roth
+'''
+from __future__ import division
+
+from collections import OrderedDict
+
+import numpy as np
+
+
+class ConvergenceMonitor(object):
+    '''
+    Track scalar summaries of the sampler state and decide when the chain has converged.
+
+    The chain is considered converged once the effective sample size of every tracked series is at least min_ess and,
+    for multiple chain analyses, the split-R-hat of every series against all other chains is at most max_r_hat. A chain
+    cannot stop before every other chain has published its series. Diagnostics are computed on the second half of the
+    draws so the early part of the chain is treated as warm up.
+
+    Args:
+        params : (dict) Convergence parameters as returned by pyclone.config.load_convergence_params.
+        precision : (bool) Whether to track the beta-binomial precision.
+        chain : (int) Chain ID for multiple chain analyses.
+        shared_series : (dict) Mapping shared between chains from chain ID to series. May be a multiprocessing
+            Manager dict proxy.
+        num_chains : (int) Number of chains in the analysis.
+    '''
+
+    def __init__(self, params, precision=False, chain=None, shared_series=None, num_chains=1):
+        self.check_interval = params['check_interval']
+
+        self.max_r_hat = params['max_r_hat']
+
+        self.min_ess = params['min_ess']
+
+        self.min_iters = params['min_iters']
+
+        self.chain = chain
+
+        self.num_chains = num_chains
+
+        self.shared_series = shared_series
+
+        self.series = OrderedDict()
+
+        self.series['alpha'] = []
+
+        self.series['num_clusters'] = []
+
+        if precision:
+            self.series['precision'] = []
+
+    def update(self, state):
+        self.series['alpha'].append(state['alpha'])
+
+        self.series['num_clusters'].append(len(np.unique(state['labels'])))
+
+        if 'precision' in self.series:
+            self.series['precision'].append(state['global_params'].x)
+
+    def check(self):
+        '''
+        Compute the diagnostics and return True if the chain has converged.
+
+        Only evaluated every check_interval draws once min_iters draws have been made, otherwise returns False.
+        '''
+        num_iters = len(self.series['alpha'])
+
+        if (num_iters < self.min_iters) or (num_iters % self.check_interval != 0):
+            return False
+
+        # Publish the series so the other chains can compute R-hat against them.
+        if self.shared_series is not None:
+            self.shared_series[self.chain] = dict(self.series)
+
+        converged = True
+
+        for name, values in self.series.items():
+            ess = effective_sample_size(_discard_warm_up(values))
+
+            converged = converged and (ess >= self.min_ess)
+
+            print 'Effective sample size of {0}: {1:.1f}'.format(name, ess)
+
+        if self.num_chains > 1:
+            other_chains = self._get_other_chains()
+
+            # Without every chain R-hat cannot detect chains stuck in different modes, so the chain keeps sampling.
+            if len(other_chains) < self.num_chains - 1:
+                converged = False
+
+                print 'Waiting for diagnostics from {0} of {1} other chains'.format(
+                    self.num_chains - 1 - len(other_chains),
+                    self.num_chains - 1
+                )
+
+            else:
+                for name, values in self.series.items():
+                    chains = [_discard_warm_up(values), ]
+
+                    chains.extend([_discard_warm_up(x[name]) for x in other_chains])
+
+                    r_hat = split_r_hat(chains)
+
+                    converged = converged and (r_hat <= self.max_r_hat)
+
+                    print 'Split R-hat of {0}: {1:.3f}'.format(name, r_hat)
+
+        print
+
+        return converged
+
+    def _get_other_chains(self):
+        if self.shared_series is None:
+            return []
+
+        return [x for chain, x in self.shared_series.items() if chain != self.chain]
+
+
+def effective_sample_size(x):
+    '''
+    Estimate the effective sample size of a series using Geyer's initial monotone sequence estimator.
+
+    Args:
+        x : (array) Draws from a single chain.
+    '''
+    x = np.asarray(x, dtype=np.float64)
+
+    n = len(x)
+
+    if n < 4:
+        return 0.0
+
+    # A constant series carries no information about mixing so it does not hold back convergence.
+    if np.all(x == x[0]):
+        return float(n)
+
+    rho = _autocorrelation(x)
+
+    # Sums of adjacent pairs of autocorrelations are positive and decreasing for a reversible chain.
+    num_pairs = n // 2
+
+    pair_sums = rho[0:2 * num_pairs:2] + rho[1:2 * num_pairs:2]
+
+    non_positive = np.where(pair_sums <= 0)[0]
+
+    if len(non_positive) > 0:
+        pair_sums = pair_sums[:non_positive[0]]
+
+    pair_sums = np.minimum.accumulate(pair_sums)
+
+    tau = -1 + 2 * np.sum(pair_sums)
+
+    return n / max(tau, 1 / np.log10(n))
+
+
+def split_r_hat(chains):
+    '''
+    Compute the split potential scale reduction factor.
+
+    Each chain is split in half and the halves are treated as separate chains. Chains are truncated to the length of
+    the shortest one.
+
+    Args:
+        chains : (list) Arrays of draws, one per chain.
+    '''
+    n = min([len(x) for x in chains]) // 2
+
+    if n < 2:
+        return np.inf
+
+    split_chains = []
+
+    for x in chains:
+        x = np.asarray(x[:2 * n], dtype=np.float64)
+
+        split_chains.append(x[:n])
+
+        split_chains.append(x[n:])
+
+    split_chains = np.array(split_chains)
+
+    within_var = np.mean(np.var(split_chains, axis=1, ddof=1))
+
+    between_var = n * np.var(np.mean(split_chains, axis=1), ddof=1)
+
+    if within_var == 0:
+        if between_var == 0:
+            return 1.0
+
+        else:
+            return np.inf
+
+    var_plus = ((n - 1) / n) * within_var + between_var / n
+
+    return np.sqrt(var_plus / within_var)
+
+
+def _autocorrelation(x):
+    n = len(x)
+
+    x = x - np.mean(x)
+
+    # Zero pad to avoid the circular correlation of the FFT.
+    f = np.fft.rfft(x, n=2 * n)
+
+    acov = np.fft.irfft(f * np.conjugate(f))[:n]
+
+    return acov / acov[0]
+
+
+def _discard_warm_up(x):
+    return x[len(x) // 2:]
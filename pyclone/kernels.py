@@ -0,0 +1,207 @@
+'''
+Compilation of the numba kernels used by the samplers and post processing.
+
+The kernels are compiled on first call and cached on disk. Compiling them ahead of time with explicit signatures lets
+read only installs and parallel jobs load the kernels from a shared cache instead of compiling them in every process.
+The cache location is set by the NUMBA_CACHE_DIR environment variable, which must be set before the kernels are
+imported.
+
+@author: Andrew Roth
+'''
+from collections import OrderedDict
+
+import importlib
+import os
+import sys
+import time
+
+from pyclone.utils import make_directory
+
+
+def compile_kernels(cache_dir=None):
+    '''
+    Compile the kernels for the signatures used at runtime, loading them from the cache when possible.
+
+    Args:
+        cache_dir : (str) Directory to write the compiled kernels to. If None the NUMBA_CACHE_DIR environment variable
+            or the numba default, the __pycache__ directory next to the source files, is used.
+
+    Returns:
+        (OrderedDict) Mapping of kernel and signature to whether the kernel was loaded from the cache.
+    '''
+    if cache_dir is not None:
+        set_cache_dir(cache_dir)
+
+    results = OrderedDict()
+
+    for module_name, kernels in get_kernel_signatures().items():
+        module = importlib.import_module(module_name)
+
+        for kernel_name, signatures in kernels:
+            dispatcher = getattr(module, kernel_name)
+
+            for signature in signatures:
+                hits = sum(dispatcher.stats.cache_hits.values())
+
+                start = time.time()
+
+                # Runtime calls look up the cache by the tuple of argument types, so compile with the same key.
+                dispatcher.compile(tuple(signature))
+
+                cached = sum(dispatcher.stats.cache_hits.values()) > hits
+
+                results[(module_name, kernel_name, signature)] = cached
+
+                print '{0}.{1}: {2} in {3:.2f}s'.format(
+                    module_name,
+                    kernel_name,
+                    'loaded from cache' if cached else 'compiled',
+                    time.time() - start
+                )
+
+    return results
+
+
+def get_cache_stats():
+    '''
+    Count the kernels loaded from the cache and compiled in this process.
+
+    Returns:
+        (dict) Number of cache hits and misses and the cache directories used. None if numba is not installed.
+    '''
+    try:
+        from numba.dispatcher import Dispatcher
+
+    except ImportError:
+        return None
+
+    stats = {'hits': 0, 'misses': 0, 'cache_dirs': set()}
+
+    for module_name, module in sys.modules.items():
+        if (module is None) or not module_name.startswith('pyclone'):
+            continue
+
+        for value in vars(module).values():
+            if not isinstance(value, Dispatcher) or (value.__module__ != module_name):
+                continue
+
+            hits = sum(value.stats.cache_hits.values())
+
+            misses = sum(value.stats.cache_misses.values())
+
+            stats['hits'] += hits
+
+            stats['misses'] += misses
+
+            if hits + misses > 0:
+                stats['cache_dirs'].add(value.stats.cache_path)
+
+    return stats
+
+
+def print_cache_report():
+    '''
+    Report whether the kernels used so far were loaded from the cache or freshly compiled.
+    '''
+    stats = get_cache_stats()
+
+    if stats is None:
+        print 'Numba is not installed, kernels were run as Python code.'
+        print
+
+        return
+
+    print 'Compiled kernels loaded from cache: {0}'.format(stats['hits'])
+    print 'Compiled kernels compiled in this process: {0}'.format(stats['misses'])
+
+    for cache_dir in sorted(stats['cache_dirs']):
+        print 'Kernel cache directory: {0}'.format(cache_dir)
+
+    if stats['misses'] > 0:
+        print 'Run PyClone compile to avoid compiling kernels in every analysis.'
+
+    print
+
+
+def set_cache_dir(cache_dir):
+    '''
+    Set the directory numba caches compiled kernels in for this process and its children.
+
+    Kernels imported before this is called keep their previous cache location.
+    '''
+    cache_dir = os.path.abspath(cache_dir)
+
+    make_directory(cache_dir)
+
+    os.environ['NUMBA_CACHE_DIR'] = cache_dir
+
+    if 'numba' in sys.modules:
+        import numba
+
+        numba.config.CACHE_DIR = cache_dir
+
+
+def get_kernel_signatures():
+    '''
+    Argument types of the kernels called from Python code, grouped by module.
+
+    The types must match the arrays and scalars passed at runtime, otherwise the kernels are compiled again on first
+    call.
+    '''
+    try:
+        from numba import types
+
+    except ImportError:
+        raise Exception('Numba is not installed. Install numba to compile the PyClone kernels.')
+
+    int_scalar = types.int64
+
+    float_scalar = types.float64
+
+    int_array = types.Array(types.int64, 1, 'C')
+
+    float_array = types.Array(types.float64, 1, 'C')
+
+    # Columns of the state table in the post processing data blocks.
+    float_column = types.Array(types.float64, 1, 'A')
+
+    int_matrix = types.Array(types.int64, 2, 'C')
+
+    float_matrix = types.Array(types.float64, 2, 'C')
+
+    # Packed data as built by pyclone.native_sampler._pack_data.
+    native_data = types.Tuple((int_matrix, int_matrix, float_matrix, int_matrix) + (float_array,) * 7)
+
+    return OrderedDict([
+        ('pyclone.math_utils', [
+            ('log_sum_exp', [(float_array,)]),
+        ]),
+        ('pyclone.pyclone_binomial', [
+            ('_log_p', [(int_scalar, int_scalar) + (int_array,) * 3 + (float_array,) * 4 + (float_scalar,) * 2]),
+            ('_log_p_matrix', [(int_array, int_array, float_array, int_array) + (float_array,) * 8]),
+        ]),
+        ('pyclone.pyclone_beta_binomial', [
+            ('_log_gamma_totals', [(int_array, float_scalar)]),
+            ('_log_p', [(int_scalar, int_scalar) + (int_array,) * 3 + (float_array,) * 4 + (float_scalar,) * 3]),
+            ('_log_p_matrix', [(int_array,) * 4 + (float_column,) * 7 + (float_array,) * 3 + (float_scalar,)]),
+        ]),
+        ('pyclone.native_sampler', [
+            ('_seed', [(int_scalar,)]),
+            ('_sample_partition', [
+                (native_data, int_array, float_matrix, int_array, int_scalar, float_scalar, int_scalar, float_scalar,
+                 float_scalar, int_scalar, float_scalar)
+            ]),
+            ('_sample_params', [
+                (native_data, int_array, float_matrix, int_scalar, float_scalar, float_scalar, int_scalar, float_scalar)
+            ]),
+            ('_sample_alpha', [(float_scalar, int_scalar, int_scalar, float_scalar, float_scalar)]),
+            ('_sample_precision', [(native_data, int_array, float_matrix) + (float_scalar,) * 4]),
+        ]),
+        ('pyclone.trace', [
+            ('_update_similarity_counts', [(types.Array(types.int32, 2, 'C'), int_array)]),
+        ]),
+        ('pyclone.post_process.clusters', [
+            ('_expected_co_clustered_pairs', [(int_array, int_scalar, int_matrix, int_array)]),
+            ('_get_co_clustering_scores', [(int_array, int_scalar, int_matrix, int_array)]),
+        ]),
+    ])
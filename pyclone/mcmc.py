@@ -0,0 +1,205 @@
+'''
+MCMC loop shared by the PyClone samplers, with periodic checkpoints so interrupted runs can be resumed.
+
+@author: Andrew Roth
+'''
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import glob
+import numpy as np
+import os
+import random
+
+from pyclone.diagnostics import ConvergenceMonitor
+from pyclone.trace import SimilarityMatrix
+
+import pyclone.config as config
+import pyclone.paths as paths
+
+
+def run_mcmc(config_file, sampler, data, trace, num_iters, init_method, chain=None, precision=False, resume=False,
+             shared_diagnostics=None, num_chains=1):
+    '''
+    Run the sampler and write the trace.
+
+    If the convergence section of the config is set the sampler stops once the diagnostics indicate convergence, in
+    which case num_iters is an upper bound on the number of iterations.
+
+    Args:
+        config_file : (str | PyCloneConfig) Path to configuration file used for analysis.
+        sampler : (object) Sampler with the pydp DirichletProcessSampler interface.
+        data : (OrderedDict | PyCloneDataset) Data points as returned by pyclone.config.load_data or
+            pyclone.config.load_dataset. A dataset is passed to the sampler as is, so samplers which accept it can
+            skip building a PyCloneData object per mutation and sample.
+        trace : (DiskTrace) Unopened trace to write to.
+        num_iters : (int) Total number of iterations, including those done before resuming.
+        init_method : (str) Partition initialisation method.
+        chain : (int) Chain ID for multiple chain analyses.
+        precision : (bool) Whether the sampler updates the beta-binomial precision.
+        resume : (bool) Continue from the last checkpoint and append to the existing trace.
+        shared_diagnostics : (dict) Mapping shared between chains used to compute R-hat across chains.
+        num_chains : (int) Number of chains in the analysis. With more than one chain the sampler only stops early
+            once R-hat against every other chain indicates convergence.
+    '''
+    checkpoint_interval = paths.get_checkpoint_interval(config_file)
+
+    # A bz2 stream is only complete once the file is closed, so a checkpoint could refer to rows which never reached a
+    # tsv trace file.
+    if paths.get_trace_format(config_file) == 'tsv':
+        if resume:
+            raise Exception(
+                'Analyses with tsv format traces cannot be resumed. Use trace_format: binary for resumable analyses.'
+            )
+
+        if checkpoint_interval > 0:
+            print 'Checkpoints are disabled for tsv format traces. Use trace_format: binary to enable them.'
+            print
+
+        checkpoint_interval = 0
+
+    checkpoint_file = paths.get_checkpoint_file(config_file, chain=chain)
+
+    convergence_params = config.load_convergence_params(config_file)
+
+    if convergence_params is None:
+        monitor = None
+
+    else:
+        monitor = ConvergenceMonitor(
+            convergence_params,
+            precision=precision,
+            chain=chain,
+            shared_series=shared_diagnostics,
+            num_chains=num_chains
+        )
+
+    if resume:
+        checkpoint = load_checkpoint(checkpoint_file)
+
+        sampler = checkpoint['sampler']
+
+        data = checkpoint['data']
+
+        start_iter = checkpoint['iteration']
+
+        if (monitor is not None) and (checkpoint['convergence_series'] is not None):
+            monitor.series = checkpoint['convergence_series']
+
+        print 'Resuming from iteration {}'.format(start_iter)
+        print
+
+        if checkpoint['similarity_matrix_file'] is None:
+            similarity_matrix = None
+
+        else:
+            similarity_matrix = SimilarityMatrix.load(checkpoint['similarity_matrix_file'])
+
+        trace.open(num_rows=start_iter, similarity_matrix=similarity_matrix)
+
+    else:
+        start_iter = 0
+
+        trace.open()
+
+        sampler.initialise_partition(_get_data_points(data), init_method)
+
+    for i in range(start_iter, num_iters):
+        state = sampler.state
+
+        if i % 100 == 0:
+            print 'Iteration: {}'.format(i)
+            print 'Number of clusters: {}'.format(len(np.unique(state['labels'])))
+            print 'DP concentration: {}'.format(state['alpha'])
+
+            if precision:
+                print 'Beta-Binomial precision: {}'.format(state['global_params'][0])
+
+            print
+
+        sampler.interactive_sample(_get_data_points(data))
+
+        trace.update(state)
+
+        if monitor is not None:
+            monitor.update(state)
+
+        if (checkpoint_interval > 0) and ((i + 1) % checkpoint_interval == 0):
+            trace.flush()
+
+            save_checkpoint(checkpoint_file, sampler, data, i + 1, monitor=monitor, trace=trace)
+
+        if (monitor is not None) and monitor.check():
+            print 'Converged after {} iterations'.format(i + 1)
+            print
+
+            break
+
+    trace.close()
+
+
+def load_checkpoint(file_name):
+    '''
+    Load a checkpoint and restore the state of the random number generators.
+    '''
+    if not os.path.exists(file_name):
+        raise Exception('No checkpoint found at {0}. Cannot resume analysis.'.format(file_name))
+
+    with open(file_name, 'rb') as fh:
+        checkpoint = pickle.load(fh)
+
+    random.setstate(checkpoint['random_state'])
+
+    np.random.set_state(checkpoint['numpy_random_state'])
+
+    return checkpoint
+
+
+def save_checkpoint(file_name, sampler, data, iteration, monitor=None, trace=None):
+    '''
+    Save the sampler, data and random number generator states after the given number of iterations.
+
+    The checkpoint is written to a temporary file which is then renamed, so an interrupted write never replaces the
+    previous checkpoint. The similarity matrix is saved to its own file named by iteration rather than pickled, so the
+    checkpoint stays small and always refers to the matrix of the same iteration.
+    '''
+    if (trace is None) or (trace.similarity_matrix is None):
+        similarity_matrix_file = None
+
+    else:
+        similarity_matrix_file = '{0}.similarity_matrix.{1}.npz'.format(file_name, iteration)
+
+        trace.similarity_matrix.num_iters = iteration
+
+        trace.similarity_matrix.save(similarity_matrix_file)
+
+    checkpoint = {
+        'convergence_series': None if monitor is None else monitor.series,
+        'data': data,
+        'iteration': iteration,
+        'numpy_random_state': np.random.get_state(),
+        'random_state': random.getstate(),
+        'sampler': sampler,
+        'similarity_matrix_file': similarity_matrix_file
+    }
+
+    tmp_file_name = file_name + '.tmp'
+
+    with open(tmp_file_name, 'wb') as fh:
+        pickle.dump(checkpoint, fh, protocol=pickle.HIGHEST_PROTOCOL)
+
+    os.rename(tmp_file_name, file_name)
+
+    # Remove the similarity matrices of earlier checkpoints.
+    for old_file_name in glob.glob('{0}.similarity_matrix.*.npz'.format(file_name)):
+        if old_file_name != similarity_matrix_file:
+            os.remove(old_file_name)
+
+
+def _get_data_points(data):
+    if isinstance(data, config.PyCloneDataset):
+        return data
+
+    return data.values()
@@ -0,0 +1,612 @@
+'''
+Array backed Dirichlet process sampler for the PyClone densities.
+
+The partition is stored as an integer label array and the cluster parameters as a (clusters x samples) array so the
+full auxiliary variable Gibbs sweep (Neal 2000, algorithm 8) runs inside compiled code.
+
+@author: Andrew Roth
+'''
+from __future__ import division
+
+from collections import OrderedDict
+from math import lgamma as log_gamma
+
+from pydp.data import GammaData
+
+import numpy as np
+import random
+
+from pyclone.math_utils import jit, log_sum_exp
+from pyclone.mcmc import run_mcmc
+from pyclone.pyclone_beta_binomial import _log_beta_binomial_likelihood
+from pyclone.pyclone_binomial import _log_binomial_likelihood
+from pyclone.trace import DiskTrace
+
+import pyclone.config as config
+
+BINOMIAL = 0
+
+BETA_BINOMIAL = 1
+
+DENSITY_TYPES = {
+    'pyclone_binomial': BINOMIAL,
+    'pyclone_beta_binomial': BETA_BINOMIAL
+}
+
+
+def run_native_analysis(config_file, density, num_iters, alpha, alpha_priors, chain=None, resume=False,
+                        shared_diagnostics=None, num_chains=1):
+    data = config.load_dataset(config_file)
+
+    sample_ids = data.sample_ids
+
+    print 'Beginning analysis using:'
+    print '{} mutations'.format(len(data))
+    print '{} sample(s)'.format(len(sample_ids))
+    print
+
+    base_measure_params = config.load_base_measure_params(config_file)
+
+    init_method = config.load_init_method(config_file)
+
+    if density == 'pyclone_beta_binomial':
+        precision_params = config.load_precision_params(config_file)
+
+    else:
+        precision_params = None
+
+    sampler = NativeDirichletProcessSampler(
+        density,
+        sample_ids,
+        base_measure_params,
+        alpha,
+        alpha_priors=alpha_priors,
+        precision_params=precision_params
+    )
+
+    trace = DiskTrace(
+        config_file,
+        data.keys(),
+        {'cellular_frequencies': 'x'},
+        precision=(precision_params is not None),
+        chain=chain
+    )
+
+    run_mcmc(
+        config_file,
+        sampler,
+        data,
+        trace,
+        num_iters,
+        init_method,
+        chain=chain,
+        precision=(precision_params is not None),
+        resume=resume,
+        shared_diagnostics=shared_diagnostics,
+        num_chains=num_chains
+    )
+
+
+class NativeDirichletProcessSampler(object):
+    '''
+    Drop in replacement for the pydp DirichletProcessSampler used by PyClone.
+
+    Args:
+        density : (str) Name of the PyClone density, pyclone_binomial or pyclone_beta_binomial.
+        sample_ids : (list) Sample IDs in the order used by the data points.
+        base_measure_params : (dict) Parameters alpha and beta of the Beta base measure.
+        alpha : (float) Initial value of the DP concentration parameter.
+        alpha_priors : (dict) Shape and rate of the Gamma prior on alpha. If None alpha is not updated.
+        precision_params : (dict) Beta-binomial precision settings from the config file. Required for the
+            pyclone_beta_binomial density.
+        num_auxiliary_params : (int) Number of auxiliary clusters proposed per data point.
+    '''
+
+    def __init__(
+            self,
+            density,
+            sample_ids,
+            base_measure_params,
+            alpha,
+            alpha_priors=None,
+            precision_params=None,
+            num_auxiliary_params=1):
+
+        if density not in DENSITY_TYPES:
+            raise Exception('{0} is not a valid density for the native sampler.'.format(density))
+
+        self.density_type = DENSITY_TYPES[density]
+
+        self.sample_ids = list(sample_ids)
+
+        # Scalars are passed to the kernels as floats so they match the signatures compiled by pyclone.kernels.
+        self.base_measure_params = _to_float(base_measure_params)
+
+        self.alpha = float(alpha)
+
+        self.alpha_priors = _to_float(alpha_priors)
+
+        self.num_auxiliary_params = num_auxiliary_params
+
+        if self.density_type == BETA_BINOMIAL:
+            if precision_params is None:
+                raise Exception('Precision parameters are required for the pyclone_beta_binomial density.')
+
+            self.precision = float(precision_params['value'])
+
+            self.precision_priors = _to_float(precision_params.get('prior', None))
+
+            if self.precision_priors is not None:
+                self.precision_proposal_precision = float(precision_params['proposal']['precision'])
+
+        else:
+            self.precision = 0.0
+
+            self.precision_priors = None
+
+        self.data = None
+
+        self.labels = None
+
+        self.params = None
+
+        self.sizes = None
+
+        self.num_clusters = 0
+
+    @property
+    def state(self):
+        '''
+        Snapshot of the sampler state. The cellular prevalence of each data point is given as an array per sample,
+        which DiskTrace writes out directly instead of building per data point parameter objects.
+        '''
+        # Indexing by the labels copies the parameters so later sweeps do not change the snapshot.
+        params = self.params[self.labels]
+
+        if self.density_type == BETA_BINOMIAL:
+            global_params = GammaData(self.precision)
+
+        else:
+            global_params = None
+
+        return {
+            'alpha': self.alpha,
+            'labels': self.labels.copy(),
+            'cellular_frequencies': OrderedDict([(x, params[:, s]) for s, x in enumerate(self.sample_ids)]),
+            'global_params': global_params
+        }
+
+    def initialise_partition(self, data, init_method):
+        '''
+        Pack the data and set the initial partition.
+
+        Args:
+            data : (PyCloneDataset | list) Dataset or data points, each a mapping of sample ID to PyCloneData.
+            init_method : (str) `connected` places all data points in one cluster, `disconnected` places each data
+                point in a separate cluster.
+        '''
+        self.data = _pack_data(data, self.sample_ids)
+
+        num_data_points = self.data[0].shape[1]
+
+        if init_method == 'connected':
+            self.labels = np.zeros(num_data_points, dtype=np.int64)
+
+            self.num_clusters = 1
+
+        elif init_method == 'disconnected':
+            self.labels = np.arange(num_data_points, dtype=np.int64)
+
+            self.num_clusters = num_data_points
+
+        else:
+            raise Exception('{0} is not a valid initialisation method.'.format(init_method))
+
+        self.params = np.zeros((num_data_points, len(self.sample_ids)))
+
+        for k in range(self.num_clusters):
+            for s in range(len(self.sample_ids)):
+                self.params[k, s] = random.betavariate(
+                    self.base_measure_params['alpha'],
+                    self.base_measure_params['beta']
+                )
+
+        self.sizes = np.bincount(self.labels, minlength=num_data_points).astype(np.int64)
+
+    def __getstate__(self):
+        # The packed data is rebuilt on the next sweep, which keeps checkpoints compact.
+        state = self.__dict__.copy()
+
+        state['data'] = None
+
+        return state
+
+    def interactive_sample(self, data):
+        '''
+        Perform one sweep of the sampler.
+
+        Args:
+            data : (PyCloneDataset | list) Data points in the order passed to initialise_partition.
+        '''
+        if self.data is None:
+            self.data = _pack_data(data, self.sample_ids)
+
+        _seed(random.randint(0, 2 ** 31 - 1))
+
+        self.num_clusters = _sample_partition(
+            self.data,
+            self.labels,
+            self.params,
+            self.sizes,
+            self.num_clusters,
+            self.alpha,
+            self.num_auxiliary_params,
+            self.base_measure_params['alpha'],
+            self.base_measure_params['beta'],
+            self.density_type,
+            self.precision
+        )
+
+        _sample_params(
+            self.data,
+            self.labels,
+            self.params,
+            self.num_clusters,
+            self.base_measure_params['alpha'],
+            self.base_measure_params['beta'],
+            self.density_type,
+            self.precision
+        )
+
+        if self.alpha_priors is not None:
+            self.alpha = _sample_alpha(
+                self.alpha,
+                self.num_clusters,
+                len(self.labels),
+                self.alpha_priors['shape'],
+                self.alpha_priors['rate']
+            )
+
+        if self.precision_priors is not None:
+            self.precision = _sample_precision(
+                self.data,
+                self.labels,
+                self.params,
+                self.precision,
+                self.precision_priors['shape'],
+                self.precision_priors['rate'],
+                self.precision_proposal_precision
+            )
+
+
+def _pack_data(data, sample_ids):
+    '''
+    Pack data points into a tuple of arrays indexed by (sample, data point). The states of data point n in sample s
+    are stored in the slice state_offsets[s, n]:state_offsets[s, n + 1] of the state arrays.
+    '''
+    if isinstance(data, config.PyCloneDataset):
+        blocks = [data.get_data_block(sample_id) for sample_id in sample_ids]
+
+    else:
+        data = list(data)
+
+        blocks = [config.pack_data([x[sample_id] for x in data]) for sample_id in sample_ids]
+
+    state_offsets = []
+
+    total = 0
+
+    for block in blocks:
+        state_offsets.append(block.state_offsets + total)
+
+        total += block.state_offsets[-1]
+
+    return (
+        np.vstack([x.b for x in blocks]),
+        np.vstack([x.d for x in blocks]),
+        np.vstack([x.tumour_content for x in blocks]),
+        np.vstack(state_offsets),
+        np.concatenate([x.cn_n for x in blocks]),
+        np.concatenate([x.cn_r for x in blocks]),
+        np.concatenate([x.cn_v for x in blocks]),
+        np.concatenate([x.mu_n for x in blocks]),
+        np.concatenate([x.mu_r for x in blocks]),
+        np.concatenate([x.mu_v for x in blocks]),
+        np.concatenate([x.log_pi for x in blocks])
+    )
+
+
+def _to_float(params):
+    if params is None:
+        return None
+
+    return OrderedDict([(key, float(value)) for key, value in params.items()])
+
+#=======================================================================================================================
+# Compiled kernels
+#=======================================================================================================================
+
+
+@jit(cache=True, nopython=True)
+def _seed(seed):
+    np.random.seed(seed)
+
+
+@jit(cache=True, nopython=True)
+def _log_p_sample(data, s, n, f, density_type, precision):
+    b, d, t, state_offsets, cn_n, cn_r, cn_v, mu_n, mu_r, mu_v, log_pi = data
+
+    max_ll = -np.inf
+
+    total = 0.0
+
+    for i in range(state_offsets[s, n], state_offsets[s, n + 1]):
+        if density_type == BINOMIAL:
+            ll = log_pi[i] + _log_binomial_likelihood(
+                b[s, n], d[s, n],
+                cn_n[i], cn_r[i], cn_v[i],
+                mu_n[i], mu_r[i], mu_v[i],
+                f, t[s, n]
+            )
+
+        else:
+            ll = log_pi[i] + _log_beta_binomial_likelihood(
+                b[s, n], d[s, n],
+                cn_n[i], cn_r[i], cn_v[i],
+                mu_n[i], mu_r[i], mu_v[i],
+                f, t[s, n], precision
+            )
+
+        if np.isinf(ll) and ll < 0:
+            continue
+
+        if ll > max_ll:
+            total = total * np.exp(max_ll - ll) + 1
+
+            max_ll = ll
+
+        else:
+            total += np.exp(ll - max_ll)
+
+    if total == 0:
+        return -np.inf
+
+    return np.log(total) + max_ll
+
+
+@jit(cache=True, nopython=True)
+def _log_p_data_point(data, n, f, density_type, precision):
+    log_p = 0.0
+
+    for s in range(f.shape[0]):
+        log_p += _log_p_sample(data, s, n, f[s], density_type, precision)
+
+    return log_p
+
+
+@jit(cache=True, nopython=True)
+def _discrete_rvs(log_p):
+    log_norm = log_sum_exp(log_p)
+
+    u = np.random.random()
+
+    cdf = 0.0
+
+    for i in range(log_p.shape[0]):
+        cdf += np.exp(log_p[i] - log_norm)
+
+        if u < cdf:
+            return i
+
+    return log_p.shape[0] - 1
+
+
+@jit(cache=True, nopython=True)
+def _sample_partition(
+        data,
+        labels,
+        params,
+        sizes,
+        num_clusters,
+        alpha,
+        num_aux,
+        base_a,
+        base_b,
+        density_type,
+        precision):
+
+    num_data_points = labels.shape[0]
+
+    num_samples = params.shape[1]
+
+    aux_params = np.zeros((num_aux, num_samples))
+
+    log_w = np.zeros(params.shape[0] + num_aux)
+
+    log_aux_weight = np.log(alpha / num_aux)
+
+    # Doubly linked lists of the members of each cluster, so removing a cluster only relabels the members of the cluster
+    # taking its place.
+    head = -np.ones(params.shape[0], dtype=np.int64)
+
+    next_member = -np.ones(num_data_points, dtype=np.int64)
+
+    prev_member = -np.ones(num_data_points, dtype=np.int64)
+
+    for n in range(num_data_points):
+        _link_member(head, next_member, prev_member, labels[n], n)
+
+    for n in range(num_data_points):
+        c = labels[n]
+
+        sizes[c] -= 1
+
+        _unlink_member(head, next_member, prev_member, c, n)
+
+        num_new = 0
+
+        # Singleton clusters donate their parameter to the first auxiliary cluster and are removed.
+        if sizes[c] == 0:
+            aux_params[0] = params[c]
+
+            num_new = 1
+
+            last = num_clusters - 1
+
+            if c != last:
+                params[c] = params[last]
+
+                sizes[c] = sizes[last]
+
+                head[c] = head[last]
+
+                m = head[last]
+
+                while m != -1:
+                    labels[m] = c
+
+                    m = next_member[m]
+
+            head[last] = -1
+
+            num_clusters -= 1
+
+        for j in range(num_new, num_aux):
+            for s in range(num_samples):
+                aux_params[j, s] = np.random.beta(base_a, base_b)
+
+        for k in range(num_clusters):
+            log_w[k] = np.log(sizes[k]) + _log_p_data_point(data, n, params[k], density_type, precision)
+
+        for j in range(num_aux):
+            log_w[num_clusters + j] = log_aux_weight + \
+                _log_p_data_point(data, n, aux_params[j], density_type, precision)
+
+        k = _discrete_rvs(log_w[:num_clusters + num_aux])
+
+        if k >= num_clusters:
+            params[num_clusters] = aux_params[k - num_clusters]
+
+            sizes[num_clusters] = 0
+
+            k = num_clusters
+
+            num_clusters += 1
+
+        labels[n] = k
+
+        sizes[k] += 1
+
+        _link_member(head, next_member, prev_member, k, n)
+
+    return num_clusters
+
+
+@jit(cache=True, nopython=True)
+def _link_member(head, next_member, prev_member, k, n):
+    next_member[n] = head[k]
+
+    prev_member[n] = -1
+
+    if head[k] != -1:
+        prev_member[head[k]] = n
+
+    head[k] = n
+
+
+@jit(cache=True, nopython=True)
+def _unlink_member(head, next_member, prev_member, k, n):
+    if prev_member[n] == -1:
+        head[k] = next_member[n]
+
+    else:
+        next_member[prev_member[n]] = next_member[n]
+
+    if next_member[n] != -1:
+        prev_member[next_member[n]] = prev_member[n]
+
+    next_member[n] = -1
+
+    prev_member[n] = -1
+
+
+@jit(cache=True, nopython=True)
+def _sample_params(data, labels, params, num_clusters, base_a, base_b, density_type, precision):
+    num_samples = params.shape[1]
+
+    old_ll = np.zeros(num_clusters)
+
+    new_ll = np.zeros(num_clusters)
+
+    proposal = np.zeros(num_clusters)
+
+    for s in range(num_samples):
+        for k in range(num_clusters):
+            proposal[k] = np.random.beta(base_a, base_b)
+
+            old_ll[k] = 0
+
+            new_ll[k] = 0
+
+        for n in range(labels.shape[0]):
+            k = labels[n]
+
+            old_ll[k] += _log_p_sample(data, s, n, params[k, s], density_type, precision)
+
+            new_ll[k] += _log_p_sample(data, s, n, proposal[k], density_type, precision)
+
+        # The base measure is the proposal so the MH ratio reduces to the likelihood ratio.
+        for k in range(num_clusters):
+            if np.log(np.random.random()) < new_ll[k] - old_ll[k]:
+                params[k, s] = proposal[k]
+
+
+@jit(cache=True, nopython=True)
+def _sample_alpha(alpha, num_clusters, num_data_points, shape, rate):
+    '''
+    Escobar and West (1995) auxiliary variable update of the DP concentration parameter.
+    '''
+    eta = np.random.beta(alpha + 1, num_data_points)
+
+    rate_post = rate - np.log(eta)
+
+    odds = (shape + num_clusters - 1) / (num_data_points * rate_post)
+
+    if np.random.random() < odds / (1 + odds):
+        shape_post = shape + num_clusters
+
+    else:
+        shape_post = shape + num_clusters - 1
+
+    return np.random.gamma(shape_post, 1 / rate_post)
+
+
+@jit(cache=True, nopython=True)
+def _sample_precision(data, labels, params, precision, prior_shape, prior_rate, proposal_precision):
+    new_precision = np.random.gamma(precision * proposal_precision, 1 / proposal_precision)
+
+    if new_precision <= 0:
+        return precision
+
+    log_ratio = _log_gamma_pdf(new_precision, prior_shape, prior_rate) - \
+        _log_gamma_pdf(precision, prior_shape, prior_rate)
+
+    log_ratio += _log_gamma_pdf(precision, new_precision * proposal_precision, proposal_precision) - \
+        _log_gamma_pdf(new_precision, precision * proposal_precision, proposal_precision)
+
+    for n in range(labels.shape[0]):
+        k = labels[n]
+
+        log_ratio += _log_p_data_point(data, n, params[k], BETA_BINOMIAL, new_precision)
+
+        log_ratio -= _log_p_data_point(data, n, params[k], BETA_BINOMIAL, precision)
+
+    if np.log(np.random.random()) < log_ratio:
+        return new_precision
+
+    return precision
+
+
+@jit(cache=True, nopython=True)
+def _log_gamma_pdf(x, shape, rate):
+    return shape * np.log(rate) - log_gamma(shape) + (shape - 1) * np.log(x) - rate * x
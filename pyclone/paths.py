@@ -12,86 +12,293 @@ except ImportError:
     from yaml import Loader
 
 
+TRACE_FILE_EXTENSIONS = {
+    'binary': '.dat',
+    'tsv': '.tsv.bz2'
+}
+
+
 def load_config(file_name):
+    '''
+    Parse a YAML file. Use get_config for PyClone configuration files, which caches the parsed file.
+    '''
     with open(file_name) as fh:
         config = yaml.load(fh, Loader=Loader)
 
     return config
 
+#=======================================================================================================================
+# Parsed configuration
+#=======================================================================================================================
+_config_cache = {}
 
-def get_error_rates(config_file):
-    values = {}
 
-    config = load_config(config_file)
+def get_config(config_file):
+    '''
+    Get the parsed configuration for a config file. The file is only parsed again if it changed on disk.
 
-    for sample_id in get_sample_ids(config_file):
-        values[sample_id] = config['samples'][sample_id]['error_rate']
+    All functions taking a config_file argument accept either the path of the file or a PyCloneConfig.
 
-    return values
+    Args:
+        config_file : (str | PyCloneConfig) Path to configuration file, or an already parsed configuration.
+    '''
+    if isinstance(config_file, PyCloneConfig):
+        return config_file
 
+    file_name = os.path.abspath(config_file)
 
-def get_mutations_files(config_file):
-    files = {}
+    stat = os.stat(file_name)
 
-    config = load_config(config_file)
+    key = (stat.st_mtime, stat.st_size)
 
-    for sample_id in get_sample_ids(config_file):
-        if os.path.exists(config['samples'][sample_id]['mutations_file']):
-            files[sample_id] = config['samples'][sample_id]['mutations_file']
+    if (file_name not in _config_cache) or (_config_cache[file_name][0] != key):
+        _config_cache[file_name] = (key, PyCloneConfig(file_name))
+
+    return _config_cache[file_name][1]
+
+
+class PyCloneConfig(object):
+    '''
+    PyClone configuration file, parsed and validated once with all paths resolved.
+
+    Values which are not resolved up front can be accessed with config[key] or config.get(key, default) as for the
+    parsed YAML dictionary.
+    '''
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+        self.config = load_config(file_name)
+
+        for key in ('samples', 'trace_dir', 'working_dir'):
+            if key not in self.config:
+                raise Exception('{0} is not set in the config file {1}.'.format(key, file_name))
+
+        self.working_dir = self.config['working_dir']
+
+        self.sample_ids = list(self.config['samples'].keys())
+
+        self.error_rates = {}
+
+        self.mutations_files = {}
+
+        self.priors = {}
+
+        self.tumour_contents = {}
+
+        for sample_id in self.sample_ids:
+            sample = self.config['samples'][sample_id]
+
+            self.error_rates[sample_id] = sample['error_rate']
+
+            if os.path.exists(sample['mutations_file']):
+                self.mutations_files[sample_id] = sample['mutations_file']
+
+            else:
+                self.mutations_files[sample_id] = os.path.join(self.working_dir, sample['mutations_file'])
+
+            # Method used to set the states of mutations loaded directly from tsv files.
+            self.priors[sample_id] = sample.get('prior', None)
+
+            self.tumour_contents[sample_id] = sample['tumour_content']['value']
+
+        self.trace_dir = os.path.join(self.working_dir, self.config['trace_dir'])
+
+        # Analyses configured before the binary format was added use tsv.
+        self.trace_format = self.config.get('trace_format', 'tsv')
+
+        if self.trace_format not in TRACE_FILE_EXTENSIONS:
+            raise Exception('{0} is not a valid trace format.'.format(self.trace_format))
+
+        self.trace_file_extension = TRACE_FILE_EXTENSIONS[self.trace_format]
+
+        self.trace_async = self.config.get('trace_async', False)
+
+        self.checkpoint_interval = self.config.get('checkpoint_interval', 0)
+
+        if self.config.get('data_cache', True):
+            self.data_cache_dir = os.path.join(self.working_dir, 'cache')
+
+            self.results_cache_dir = os.path.join(self.data_cache_dir, 'post_process')
 
         else:
-            files[sample_id] = os.path.join(config['working_dir'], config['samples'][sample_id]['mutations_file'])
+            self.data_cache_dir = None
 
-    return files
+            self.results_cache_dir = None
 
+        self.similarity_matrix_params = self._load_similarity_matrix_params()
 
-def get_sample_ids(config_file):
-    config = load_config(config_file)
+    def __contains__(self, key):
+        return key in self.config
 
-    return config['samples'].keys()
+    def __getitem__(self, key):
+        return self.config[key]
 
+    def get(self, key, default=None):
+        return self.config.get(key, default)
 
-def get_tumour_contents(config_file):
-    values = {}
+    def _load_similarity_matrix_params(self):
+        if 'similarity_matrix' not in self.config:
+            return None
 
-    config = load_config(config_file)
+        params = {
+            'burnin': 0,
+            'format': 'dense',
+            'thin': 1
+        }
 
-    for sample_id in get_sample_ids(config_file):
-        values[sample_id] = config['samples'][sample_id]['tumour_content']['value']
+        params.update(self.config['similarity_matrix'])
+
+        if params['format'] not in ('dense', 'sparse'):
+            raise Exception('{0} is not a valid similarity matrix format.'.format(params['format']))
+
+        return params
 
-    return values
+#=======================================================================================================================
+# Config accessors
+#=======================================================================================================================
 
 
-def get_cellular_prevalence_trace_files(config_file):
+def get_error_rates(config_file):
+    return dict(get_config(config_file).error_rates)
+
+
+def get_mutations_files(config_file):
+    return dict(get_config(config_file).mutations_files)
+
+
+def get_priors(config_file):
+    return dict(get_config(config_file).priors)
+
+
+def get_sample_ids(config_file):
+    return list(get_config(config_file).sample_ids)
+
+
+def get_tumour_contents(config_file):
+    return dict(get_config(config_file).tumour_contents)
+
+
+def get_cellular_prevalence_trace_files(config_file, chain=None):
     trace_files = {}
 
-    trace_dir = get_trace_dir(config_file)
+    trace_dir = get_trace_dir(config_file, chain=chain)
+
+    extension = get_trace_file_extension(config_file)
 
     for sample_id in get_sample_ids(config_file):
-        trace_files[sample_id] = os.path.join(trace_dir, '{0}.cellular_prevalence.tsv.bz2'.format(sample_id))
+        trace_files[sample_id] = os.path.join(trace_dir, '{0}.cellular_prevalence{1}'.format(sample_id, extension))
 
     return trace_files
 
 
-def get_concentration_trace_file(config_file):
-    trace_dir = get_trace_dir(config_file)
+def get_checkpoint_file(config_file, chain=None):
+    trace_dir = get_trace_dir(config_file, chain=chain)
 
-    return os.path.join(trace_dir, 'alpha.tsv.bz2')
+    return os.path.join(trace_dir, 'checkpoint.pkl')
 
 
-def get_labels_trace_file(config_file):
-    trace_dir = get_trace_dir(config_file)
+def get_checkpoint_interval(config_file):
+    '''
+    Get the number of iterations between sampler checkpoints. Zero disables checkpoints.
+    '''
+    return get_config(config_file).checkpoint_interval
+
+
+def get_data_cache_dir(config_file):
+    '''
+    Get the directory where parsed mutation data is cached. Returns None if data_cache is set to false.
+    '''
+    return get_config(config_file).data_cache_dir
+
 
-    return os.path.join(trace_dir, 'labels.tsv.bz2')
+def get_results_cache_dir(config_file):
+    '''
+    Get the directory where clustering results and summary tables are cached. Returns None if data_cache is set to
+    false.
+    '''
+    return get_config(config_file).results_cache_dir
 
 
-def get_precision_trace_file(config_file):
+def get_chain_ids(config_file):
+    '''
+    Get the IDs of the chains with a trace sub directory in the trace directory. Returns [None] for a single chain
+    analysis which writes directly to the trace directory.
+    '''
     trace_dir = get_trace_dir(config_file)
 
-    return os.path.join(trace_dir, 'precision.tsv.bz2')
+    chain_ids = []
+
+    if os.path.isdir(trace_dir):
+        for name in os.listdir(trace_dir):
+            if name.startswith('chain_') and name[len('chain_'):].isdigit():
+                chain_ids.append(int(name[len('chain_'):]))
+
+    if len(chain_ids) == 0:
+        return [None, ]
+
+    return sorted(chain_ids)
+
+
+def get_concentration_trace_file(config_file, chain=None):
+    trace_dir = get_trace_dir(config_file, chain=chain)
+
+    return os.path.join(trace_dir, 'alpha' + get_trace_file_extension(config_file))
+
+
+def get_labels_trace_file(config_file, chain=None):
+    trace_dir = get_trace_dir(config_file, chain=chain)
+
+    return os.path.join(trace_dir, 'labels' + get_trace_file_extension(config_file))
+
+
+def get_precision_trace_file(config_file, chain=None):
+    trace_dir = get_trace_dir(config_file, chain=chain)
+
+    return os.path.join(trace_dir, 'precision' + get_trace_file_extension(config_file))
+
+
+def get_similarity_matrix_file(config_file, chain=None):
+    trace_dir = get_trace_dir(config_file, chain=chain)
+
+    return os.path.join(trace_dir, 'similarity_matrix.npz')
+
+
+def get_similarity_matrix_params(config_file):
+    '''
+    Get the parameters for accumulating the posterior similarity matrix during sampling. Returns None if the
+    similarity_matrix section is not set, in which case no matrix is accumulated.
+    '''
+    params = get_config(config_file).similarity_matrix_params
+
+    if params is None:
+        return None
+
+    return dict(params)
+
+
+def get_trace_file_extension(config_file):
+    return get_config(config_file).trace_file_extension
+
+
+def get_trace_format(config_file):
+    '''
+    Get the format of the trace files, binary or tsv. Analyses configured before the binary format was added use tsv.
+    '''
+    return get_config(config_file).trace_format
+
+
+def get_trace_async(config_file):
+    '''
+    Get whether trace files are written in a background thread.
+    '''
+    return get_config(config_file).trace_async
+
 
+def get_trace_dir(config_file, chain=None):
+    trace_dir = get_config(config_file).trace_dir
 
-def get_trace_dir(config_file):
-    config = load_config(config_file)
+    if chain is not None:
+        trace_dir = os.path.join(trace_dir, 'chain_{0}'.format(chain))
 
-    return os.path.join(config['working_dir'], config['trace_dir'])
+    return trace_dir
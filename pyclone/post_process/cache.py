@@ -0,0 +1,96 @@
+'''
+Cache of post-processing results so clustering and summary tables are computed once per analysis and reused by the
+table and plot commands.
+
+@author: Andrew Roth
+'''
+import hashlib
+import json
+import os
+import pandas as pd
+
+from pyclone.utils import make_directory
+
+import pyclone.paths as paths
+
+# Increase when the format of a cached result changes so stale results are ignored.
+RESULTS_CACHE_VERSION = 1
+
+
+def load_cached_result(config_file, name, params, compute):
+    '''
+    Load a result from the cache, computing and caching it if it is missing or stale.
+
+    Results are keyed by the fingerprint of the trace and input files, so they are recomputed after the sampler is run
+    again or the input changes.
+
+    Args:
+        config_file : (str | PyCloneConfig) Path to configuration file used for analysis.
+        name : (str) Name of the result.
+        params : (dict) Parameters the result depends on, for example burnin and thin. Values must be JSON
+            serialisable.
+        compute : (function) Function without arguments computing the result as a pandas object.
+    '''
+    cache_dir = paths.get_results_cache_dir(config_file)
+
+    if cache_dir is None:
+        return compute()
+
+    cache_file = _get_cache_file(config_file, cache_dir, name, params)
+
+    if os.path.exists(cache_file):
+        try:
+            return pd.read_pickle(cache_file)
+
+        # Unreadable results, for example from an interrupted write, are recomputed.
+        except Exception:
+            pass
+
+    result = compute()
+
+    make_directory(cache_dir)
+
+    # Processes rendering plots in parallel may compute the same result.
+    tmp_file = '{0}.{1}.tmp'.format(cache_file, os.getpid())
+
+    result.to_pickle(tmp_file)
+
+    os.rename(tmp_file, cache_file)
+
+    return result
+
+
+def get_trace_fingerprint(config_file):
+    '''
+    Compute a hash which changes whenever the config file, the input files or any file in the trace directory changes.
+    '''
+    config = paths.get_config(config_file)
+
+    files = [config.file_name, ]
+
+    files.extend([config.mutations_files[x] for x in config.sample_ids])
+
+    for dir_name, _, file_names in sorted(os.walk(config.trace_dir)):
+        files.extend([os.path.join(dir_name, x) for x in sorted(file_names)])
+
+    hasher = hashlib.sha1()
+
+    for file_name in files:
+        stat = os.stat(file_name)
+
+        hasher.update('{0}\t{1}\t{2}\n'.format(os.path.abspath(file_name), stat.st_size, stat.st_mtime))
+
+    return hasher.hexdigest()
+
+
+def _get_cache_file(config_file, cache_dir, name, params):
+    key = json.dumps(
+        {
+            'fingerprint': get_trace_fingerprint(config_file),
+            'params': params,
+            'version': RESULTS_CACHE_VERSION
+        },
+        sort_keys=True
+    )
+
+    return os.path.join(cache_dir, '{0}.{1}.pkl'.format(name, hashlib.sha1(key).hexdigest()))
@@ -3,33 +3,86 @@ Created on Nov 29, 2015
 
 @author: Andrew Roth
 '''
+from collections import OrderedDict
 from pydp.cluster import cluster_with_mpear
-from pydp.data import BetaData, GammaData
-from pydp.utils import log_space_normalise
+from pydp.data import GammaData
+from scipy.cluster.hierarchy import average, fcluster
+from scipy.sparse import csr_matrix
+from scipy.spatial.distance import squareform
 
 import numpy as np
 import pandas as pd
 
-from pyclone.config import load_data
+from pyclone.config import load_dataset
+from pyclone.math_utils import jit, log_sum_exp
 from pyclone.pyclone_beta_binomial import PyCloneBetaBinomialDensity
 from pyclone.pyclone_binomial import PyCloneBinomialDensity
 
+from .cache import load_cached_result
+
 import pyclone.paths as paths
 import pyclone.trace as trace
 
+CLUSTERING_METHODS = ('mpear', 'approximate_mpear')
+
+# Number of mutation by grid point log likelihoods computed per call when building cluster posteriors.
+POSTERIOR_CHUNK_SIZE = 2 ** 22
+
+# Number of similarity matrix entries read per block when summing the similarities within a cluster.
+MPEAR_CHUNK_SIZE = 2 ** 22
+
+
+def cluster_pyclone_trace(config_file, burnin, thin, max_clusters=None, method='mpear'):
+    '''
+    Cluster the mutations using the MPEAR criterion. The labels are cached so the trace is only clustered once for
+    each setting of burnin, thin, max_clusters and method.
 
-def cluster_pyclone_trace(config_file, burnin, thin, max_clusters=None):
-    labels_trace = trace.load_cluster_labels_trace(
-        paths.get_labels_trace_file(config_file),
-        burnin,
-        thin
+    Args:
+        method : (str) `mpear` searches the cuts of the average linkage tree of the posterior similarity matrix, which
+            needs memory quadratic in the number of mutations. `approximate_mpear` searches the partitions sampled in
+            the trace, which scales linearly in the number of mutations.
+    '''
+    if method not in CLUSTERING_METHODS:
+        raise Exception('{0} is not a valid clustering method.'.format(method))
+
+    return load_cached_result(
+        config_file,
+        'labels',
+        {'burnin': burnin, 'max_clusters': max_clusters, 'method': method, 'thin': thin},
+        lambda: _cluster_pyclone_trace(config_file, burnin, thin, max_clusters=max_clusters, method=method)
     )
 
-    X = labels_trace.values
 
-    labels = cluster_with_mpear(X, max_clusters=max_clusters)
+def _cluster_pyclone_trace(config_file, burnin, thin, max_clusters=None, method='mpear'):
+    if method == 'approximate_mpear':
+        labels_trace = trace.load_cluster_labels_traces(config_file, burnin, thin)
+
+        labels = cluster_with_approximate_mpear(labels_trace.values, max_clusters=max_clusters)
+
+        labels = pd.Series(labels, index=labels_trace.columns)
+
+        labels = labels.reset_index()
 
-    labels = pd.Series(labels, index=labels_trace.columns)
+        labels.columns = 'mutation_id', 'cluster_id'
+
+        return labels
+
+    sim_mat = trace.load_similarity_matrices(config_file, burnin, thin)
+
+    # Fall back to the labels trace if no similarity matrix was accumulated with this burnin and thin.
+    if sim_mat is None:
+        labels_trace = trace.load_cluster_labels_traces(config_file, burnin, thin)
+
+        X = labels_trace.values
+
+        labels = cluster_with_mpear(X, max_clusters=max_clusters)
+
+        labels = pd.Series(labels, index=labels_trace.columns)
+
+    else:
+        labels = cluster_with_mpear_from_similarity_matrix(sim_mat.values, max_clusters=max_clusters)
+
+        labels = pd.Series(labels, index=sim_mat.index)
 
     labels = labels.reset_index()
 
@@ -38,10 +91,331 @@ def cluster_pyclone_trace(config_file, burnin, thin, max_clusters=None):
     return labels
 
 
-def load_summary_table(config_file, burnin=0, max_clusters=None, mesh_size=101, min_size=0, thin=1):
+def cluster_with_mpear_from_similarity_matrix(sim_mat, max_clusters=None):
+    '''
+    Find the partition maximising the posterior expected adjusted Rand index (MPEAR) among the cuts of the average
+    linkage tree of the similarity matrix. These are the partitions pydp's cluster_with_mpear searches.
+
+    The clusters of the cuts are nodes of the tree, so the similarities within each cluster are summed once and reused
+    by every cut containing it.
+
+    Args:
+        sim_mat : (array) Symmetric matrix of posterior co-clustering probabilities.
+        max_clusters : (int) Maximum number of clusters to consider. If None all cuts are considered.
+
+    Returns:
+        (array) Cluster labels, starting from 1.
+    '''
+    sim_mat = np.asarray(sim_mat, dtype=np.float64)
+
+    N = sim_mat.shape[0]
+
+    if N == 1:
+        return np.ones(1, dtype=int)
+
+    dist_mat = 1 - sim_mat
+
+    np.fill_diagonal(dist_mat, 0)
+
+    Z = average(squareform(dist_mat, checks=False))
+
+    if max_clusters is None:
+        max_clusters = N
+
+    max_pear = 0
+
+    best_labels = np.ones(N, dtype=int)
+
+    num_j = _get_expected_num_pairs(sim_mat)
+
+    cluster_sums = {}
+
+    for num_clusters in range(1, min(max_clusters, N) + 1):
+        if num_clusters == N:
+            labels = np.arange(1, N + 1)
+
+        else:
+            labels = fcluster(Z, num_clusters, criterion='maxclust')
+
+        pear = _compute_mpear(labels, sim_mat, num_j=num_j, cluster_sums=cluster_sums)
+
+        if pear > max_pear:
+            max_pear = pear
+
+            best_labels = labels
+
+    return best_labels
+
+
+def cluster_with_approximate_mpear(X, max_clusters=None, max_candidates=100):
+    '''
+    Find the partition maximising the posterior expected adjusted Rand index (MPEAR) among the partitions sampled in
+    the trace.
+
+    The expected index of each candidate is computed exactly from its contingency tables with the sampled partitions,
+    which takes time and memory linear in the number of data points instead of building the quadratic size similarity
+    matrix. Only the search over partitions is approximate.
+
+    Args:
+        X : (array) Cluster labels trace of shape number of samples by number of data points.
+        max_clusters : (int) Maximum number of clusters. Candidates with more clusters keep their max_clusters largest
+            clusters, and the other data points join the kept cluster they are most often clustered with. If None the
+            candidates are used as sampled.
+        max_candidates : (int) Maximum number of distinct sampled partitions to evaluate. If there are more they are
+            chosen evenly spaced through the trace.
+
+    Returns:
+        (array) Cluster labels, starting from 1.
+    '''
+    X = np.array([_relabel_partition(x) for x in np.asarray(X)], dtype=np.int64)
+
+    num_clusters = X.max(axis=1) + 1
+
+    N = X.shape[1]
+
+    if N == 1:
+        return np.ones(1, dtype=int)
+
+    # Sampled partitions are in canonical form so repeated partitions are only evaluated once.
+    candidates = OrderedDict()
+
+    for i, x in enumerate(X):
+        candidates.setdefault(x.tostring(), i)
+
+    candidates = np.array(candidates.values())
+
+    if len(candidates) > max_candidates:
+        candidates = candidates[np.unique(np.linspace(0, len(candidates) - 1, max_candidates).astype(int))]
+
+    num_pairs = N * (N - 1) / 2
+
+    # Expected number of pairs clustered together under the posterior.
+    num_j = np.mean([_count_pairs(np.bincount(x)) for x in X])
+
+    max_pear = -np.inf
+
+    best_labels = None
+
+    for i in candidates:
+        labels = X[i]
+
+        if (max_clusters is not None) and (num_clusters[i] > max_clusters):
+            labels = _merge_small_clusters(labels, max_clusters, X, num_clusters)
+
+        num_i = _count_pairs(np.bincount(labels))
+
+        ind_sum = _expected_co_clustered_pairs(labels, labels.max() + 1, X, num_clusters)
+
+        pear = _get_pear(ind_sum, num_i, num_j, num_pairs)
+
+        if pear > max_pear:
+            max_pear = pear
+
+            best_labels = labels + 1
+
+    return best_labels
+
+
+def _count_pairs(sizes):
+    sizes = sizes.astype(np.float64)
+
+    return np.sum(sizes * (sizes - 1) / 2)
+
+
+@jit(cache=True, nopython=True)
+def _expected_co_clustered_pairs(labels, num_labels, X, num_clusters):
+    '''
+    Compute the number of pairs clustered together in labels and in a sampled partition, averaged over the samples.
+    '''
+    num_samples, N = X.shape
+
+    total = 0.0
+
+    for t in range(num_samples):
+        size = num_labels * num_clusters[t]
+
+        # Count the cells of the contingency table directly when it is small, otherwise sort the cell indices.
+        if size <= 4 * N:
+            counts = np.zeros(size, dtype=np.int64)
+
+            for i in range(N):
+                counts[labels[i] * num_clusters[t] + X[t, i]] += 1
+
+            for c in counts:
+                total += c * (c - 1) / 2
+
+        else:
+            keys = np.zeros(N, dtype=np.int64)
+
+            for i in range(N):
+                keys[i] = labels[i] * num_clusters[t] + X[t, i]
+
+            keys.sort()
+
+            c = 1
+
+            for i in range(1, N):
+                if keys[i] == keys[i - 1]:
+                    c += 1
+
+                else:
+                    total += c * (c - 1) / 2
+
+                    c = 1
+
+            total += c * (c - 1) / 2
+
+    return total / num_samples
+
+
+def _merge_small_clusters(labels, max_clusters, X, num_clusters):
+    '''
+    Keep the max_clusters largest clusters of a partition and move each other data point to the kept cluster whose
+    members it is clustered with most often in the sampled partitions.
+    '''
+    kept = np.argsort(-np.bincount(labels), kind='mergesort')[:max_clusters]
+
+    kept_labels = -np.ones(labels.max() + 1, dtype=np.int64)
+
+    kept_labels[kept] = np.arange(len(kept))
+
+    new_labels = kept_labels[labels]
+
+    scores = _get_co_clustering_scores(new_labels, len(kept), X, num_clusters)
+
+    moved = new_labels < 0
+
+    new_labels[moved] = np.argmax(scores[moved], axis=1)
+
+    return _relabel_partition(new_labels)
+
+
+@jit(cache=True, nopython=True)
+def _get_co_clustering_scores(labels, num_labels, X, num_clusters):
+    '''
+    Compute the number of members of each cluster clustered with each data point, summed over the sampled partitions.
+    Data points with a negative label are not counted as members of any cluster.
+    '''
+    num_samples, N = X.shape
+
+    scores = np.zeros((N, num_labels))
+
+    for t in range(num_samples):
+        counts = np.zeros((num_labels, num_clusters[t]))
+
+        for i in range(N):
+            if labels[i] >= 0:
+                counts[labels[i], X[t, i]] += 1
+
+        for i in range(N):
+            for k in range(num_labels):
+                scores[i, k] += counts[k, X[t, i]]
+
+    return scores
+
+
+def _relabel_partition(labels):
+    '''
+    Relabel a partition as 0, 1, ... in order of first appearance.
+    '''
+    _, first_index, inverse = np.unique(labels, return_index=True, return_inverse=True)
+
+    rank = np.zeros(len(first_index), dtype=np.int64)
+
+    rank[np.argsort(first_index)] = np.arange(len(first_index))
+
+    return rank[inverse]
+
+
+def _compute_mpear(labels, sim_mat, num_j=None, cluster_sums=None):
+    '''
+    Compute the posterior expected adjusted Rand index of a partition given the similarity matrix.
+
+    Args:
+        labels : (array) Cluster labels of the partition.
+        sim_mat : (array) Symmetric matrix of posterior co-clustering probabilities.
+        num_j : (float) Expected number of pairs clustered together under the posterior. Computed if None.
+        cluster_sums : (dict) Sums of the similarities within clusters, keyed by first member and size. Only valid
+            for partitions whose clusters are nodes of the same tree, where the key identifies the cluster. Updated
+            with the clusters of this partition.
+    '''
+    N = sim_mat.shape[0]
+
+    num_pairs = N * (N - 1) / 2
+
+    if num_j is None:
+        num_j = _get_expected_num_pairs(sim_mat)
+
+    if cluster_sums is None:
+        cluster_sums = {}
+
+    # Stable sort so the members of each cluster are in index order and the first member is the smallest.
+    order = np.argsort(labels, kind='mergesort')
+
+    boundaries = np.flatnonzero(np.diff(labels[order])) + 1
+
+    # Number of pairs clustered together in the partition and the expected number of them clustered together under
+    # the posterior.
+    num_i = 0
+
+    ind_sum = 0
+
+    for members in np.split(order, boundaries):
+        size = len(members)
+
+        num_i += size * (size - 1) / 2
+
+        key = (members[0], size)
+
+        if key not in cluster_sums:
+            cluster_sums[key] = _get_within_cluster_sum(sim_mat, members)
+
+        ind_sum += cluster_sums[key]
+
+    return _get_pear(ind_sum, num_i, num_j, num_pairs)
+
+
+def _get_expected_num_pairs(sim_mat):
+    return (np.sum(sim_mat) - np.trace(sim_mat)) / 2
+
+
+def _get_within_cluster_sum(sim_mat, members):
+    '''
+    Sum the similarities of the pairs of members, reading a block of rows at a time to bound memory use.
+    '''
+    total = 0
+
+    step = max(1, MPEAR_CHUNK_SIZE // len(members))
+
+    for start in range(0, len(members), step):
+        rows = members[start:start + step]
+
+        total += np.sum(sim_mat[np.ix_(rows, members)])
+
+    return (total - np.sum(sim_mat[members, members])) / 2
+
+
+def _get_pear(ind_sum, num_i, num_j, num_pairs):
+    '''
+    Compute the posterior expected adjusted Rand index from the expected number of pairs clustered together in both
+    the partition and the posterior (ind_sum), in the partition (num_i) and in the posterior (num_j).
+    '''
+    expected_index = num_i * num_j / num_pairs
+
+    max_index = (num_i + num_j) / 2
+
+    if max_index == expected_index:
+        return 0
+
+    return (ind_sum - expected_index) / (max_index - expected_index)
+
+
+def load_summary_table(config_file, burnin=0, clustering_method='mpear', max_clusters=None, mesh_size=101, min_size=0,
+                       thin=1):
     df = load_table(
         config_file,
         burnin=burnin,
+        clustering_method=clustering_method,
         max_clusters=max_clusters,
         mesh_size=mesh_size,
         min_size=min_size,
@@ -75,15 +449,30 @@ def load_summary_table(config_file, burnin=0, max_clusters=None, mesh_size=101,
     return out_df
 
 
-def load_table(config_file, burnin=0, min_size=0, max_clusters=None, mesh_size=101, thin=1):
-    config = paths.load_config(config_file)
+def load_table(config_file, burnin=0, min_size=0, clustering_method='mpear', max_clusters=None, mesh_size=101, thin=1):
+    df = load_cached_result(
+        config_file,
+        'cluster_posteriors',
+        {
+            'burnin': burnin,
+            'clustering_method': clustering_method,
+            'max_clusters': max_clusters,
+            'mesh_size': mesh_size,
+            'thin': thin
+        },
+        lambda: _load_table(config_file, burnin, clustering_method, max_clusters, mesh_size, thin)
+    )
+
+    df = df[df['size'] >= min_size]
 
-    if config['density'] == 'pyclone_beta_binomial':
-        precision_file = paths.get_precision_trace_file(config_file)
+    return df
 
-        precision = pd.read_csv(precision_file, header=None, compression='bz2', sep='\t', squeeze=True)
 
-        precision = precision.iloc[burnin::thin].mean()
+def _load_table(config_file, burnin, clustering_method, max_clusters, mesh_size, thin):
+    config = paths.get_config(config_file)
+
+    if config['density'] == 'pyclone_beta_binomial':
+        precision = trace.load_precision_traces(config_file, burnin, thin).mean()
 
         density = PyCloneBetaBinomialDensity(GammaData(precision))
 
@@ -93,29 +482,44 @@ def load_table(config_file, burnin=0, min_size=0, max_clusters=None, mesh_size=1
     else:
         raise Exception('Only pyclone_binomial and pyclone_beta_binomial density are supported.')
 
-    data, sample_ids = load_data(config_file)
+    dataset = load_dataset(config_file)
 
-    labels = cluster_pyclone_trace(config_file, burnin, thin, max_clusters=max_clusters)
+    labels = cluster_pyclone_trace(config_file, burnin, thin, max_clusters=max_clusters, method=clustering_method)
 
-    labels = labels.set_index('mutation_id')
+    cluster_ids, cluster_index, cluster_sizes = np.unique(
+        labels['cluster_id'].values,
+        return_inverse=True,
+        return_counts=True
+    )
 
-    posteriors = []
+    rows = dataset.get_index(labels['mutation_id'])
 
-    for cluster_id, cluster_df in labels.groupby('cluster_id'):
-        mutation_ids = list(cluster_df.index)
+    mesh = np.linspace(0, 1, mesh_size)
 
-        cluster_data = [data[x] for x in mutation_ids]
+    sample_posteriors = OrderedDict()
 
-        for sample_id in sample_ids:
-            cluster_sample_data = [x[sample_id] for x in cluster_data]
+    for sample_id in dataset.sample_ids:
+        sample_posteriors[sample_id] = _compute_posterior(
+            dataset,
+            sample_id,
+            rows,
+            cluster_index,
+            len(cluster_ids),
+            density,
+            mesh
+        )
 
-            cluster_sample_posterior = _compute_posterior(cluster_sample_data, density, mesh_size)
+    posteriors = []
+
+    for k, cluster_id in enumerate(cluster_ids):
+        for sample_id in dataset.sample_ids:
+            cluster_sample_posterior = dict(zip(mesh, sample_posteriors[sample_id][k]))
 
             cluster_sample_posterior['sample_id'] = sample_id
 
             cluster_sample_posterior['cluster_id'] = cluster_id
 
-            cluster_sample_posterior['size'] = len(mutation_ids)
+            cluster_sample_posterior['size'] = cluster_sizes[k]
 
             posteriors.append(cluster_sample_posterior)
 
@@ -125,20 +529,46 @@ def load_table(config_file, burnin=0, min_size=0, max_clusters=None, mesh_size=1
 
     df = df.reset_index()
 
-    df = df[df['size'] >= min_size]
-
     return df
 
 
-def _compute_posterior(data, density, mesh_size):
-    posterior = {}
+def _compute_posterior(dataset, sample_id, rows, cluster_index, num_clusters, density, mesh):
+    '''
+    Compute the normalised log posterior of the cellular prevalence of every cluster in a sample on a grid.
+
+    The log likelihood of each mutation at every grid point is computed by the density in one compiled call per chunk of
+    mutations, then summed over the members of each cluster.
+
+    Args:
+        dataset : (PyCloneDataset) Data for all mutations.
+        sample_id : (str) Sample to compute the posteriors for.
+        rows : (array) Dataset rows of the clustered mutations.
+        cluster_index : (array) Cluster index in 0, ..., num_clusters - 1 of each row.
+        num_clusters : (int) Number of clusters.
+        density : (Density) Density with a log_p_matrix method.
+        mesh : (array) Grid of cellular prevalences.
+
+    Returns:
+        (array) Matrix of shape number of clusters by mesh size.
+    '''
+    log_p = np.zeros((num_clusters, len(mesh)))
+
+    # Bound the size of the mutation by mesh matrix for large meshes.
+    chunk_size = max(1, POSTERIOR_CHUNK_SIZE // len(mesh))
+
+    for start in range(0, len(rows), chunk_size):
+        stop = min(start + chunk_size, len(rows))
+
+        data_block = dataset.get_data_block(sample_id, rows[start:stop])
 
-    for cellular_prevalence in np.linspace(0, 1, mesh_size):
-        posterior[cellular_prevalence] = 0
+        membership = csr_matrix(
+            (np.ones(stop - start), (cluster_index[start:stop], np.arange(stop - start))),
+            shape=(num_clusters, stop - start)
+        )
 
-        for data_point in data:
-            posterior[cellular_prevalence] += density.log_p(data_point, BetaData(cellular_prevalence))
+        log_p += membership.dot(density.log_p_matrix(data_block, mesh))
 
-    posterior = dict(zip(posterior.keys(), log_space_normalise(posterior.values())))
+    for k in range(num_clusters):
+        log_p[k] -= log_sum_exp(log_p[k])
 
-    return posterior
+    return log_p
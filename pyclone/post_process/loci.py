@@ -5,28 +5,30 @@ Created on Nov 27, 2015
 '''
 from __future__ import division
 
+import numpy as np
 import pandas as pd
-import yaml
 
-try:
-    from yaml import CLoader as Loader
-except ImportError:
-    from yaml import Loader
-
-from pyclone.config import load_mutation_from_dict
+from pyclone.config import load_dataset
 
+from .cache import load_cached_result
 from .clusters import cluster_pyclone_trace
-from pyclone.trace import load_cellular_frequencies_trace
+from pyclone.trace import iter_cellular_frequencies_trace_blocks
 
 import pyclone.paths as paths
 
 
-def load_table(config_file, burnin, thin, max_clusters=None, min_cluster_size=0, old_style=False):
-    data = pd.merge(
-        _load_variant_allele_frequencies(config_file),
-        _load_cellular_prevalences(config_file, burnin, thin),
-        how='inner',
-        on=['mutation_id', 'sample_id']
+def load_table(config_file, burnin, thin, clustering_method='mpear', max_clusters=None, min_cluster_size=0,
+               old_style=False):
+    data = load_cached_result(
+        config_file,
+        'loci',
+        {'burnin': burnin, 'thin': thin},
+        lambda: pd.merge(
+            _load_variant_allele_frequencies(config_file),
+            _load_cellular_prevalences(config_file, burnin, thin),
+            how='inner',
+            on=['mutation_id', 'sample_id']
+        )
     )
 
     labels = cluster_pyclone_trace(
@@ -34,6 +36,7 @@ def load_table(config_file, burnin, thin, max_clusters=None, min_cluster_size=0,
         burnin,
         thin,
         max_clusters=max_clusters,
+        method=clustering_method
     )
 
     labels = labels.set_index('mutation_id')['cluster_id']
@@ -88,10 +91,36 @@ def _reformat_multi_sample_table(df):
 
 
 def _load_variant_allele_frequencies(config_file):
+    '''
+    Load the variant allele frequencies of the mutations present in all samples.
+
+    Computed from the parsed counts so tsv and YAML input files are handled alike.
+    '''
+    dataset = load_dataset(config_file)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vaf = np.where(dataset.d > 0, dataset.b / dataset.d.astype(np.float64), np.nan)
+
+    data = pd.DataFrame(vaf, index=dataset.mutation_ids, columns=dataset.sample_ids)
+
+    data.index.name = 'mutation_id'
+
+    data.columns.name = 'sample_id'
+
+    data = data.stack(dropna=False).rename('variant_allele_frequency').reset_index()
+
+    return data
+
+#=======================================================================================================================
+# Load cellular prevalences for all samples
+#=======================================================================================================================
+
+
+def _load_cellular_prevalences(config_file, burnin, thin):
     data = []
 
-    for sample_id, file_name in paths.get_mutations_files(config_file).items():
-        sample_data = _load_sample_variant_allele_frequencies(file_name)
+    for sample_id in paths.get_sample_ids(config_file):
+        sample_data = _load_sample_cellular_prevalences(config_file, sample_id, burnin, thin)
 
         sample_data['sample_id'] = sample_id
 
@@ -107,25 +136,52 @@ def _load_variant_allele_frequencies(config_file):
     return data
 
 
-def _load_sample_variant_allele_frequencies(file_name):
+def _load_sample_cellular_prevalences(config_file, sample_id, burnin, thin):
     '''
-    Load data from PyClone formatted input file.
+    Compute the mean and standard deviation of the cellular prevalence of each mutation. The trace is processed one
+    block of iterations at a time so it never needs to fit in memory.
     '''
-    data = {}
+    num_iters = 0
+
+    for block in iter_cellular_frequencies_trace_blocks(config_file, sample_id, burnin, thin):
+        values = block.values.astype(np.float64)
+
+        block_num_iters = values.shape[0]
+
+        block_mean = values.mean(axis=0)
+
+        block_m2 = np.sum(np.square(values - block_mean), axis=0)
+
+        if num_iters == 0:
+            columns = block.columns
+
+            mean = block_mean
+
+            m2 = block_m2
+
+        else:
+            delta = block_mean - mean
+
+            total = num_iters + block_num_iters
+
+            mean = mean + delta * block_num_iters / total
 
-    with open(file_name) as fh:
-        config = yaml.load(fh, Loader=Loader)
+            m2 = m2 + block_m2 + np.square(delta) * num_iters * block_num_iters / total
 
-    for mutation_dict in config['mutations']:
-        mutation = load_mutation_from_dict(mutation_dict)
+        num_iters += block_num_iters
 
-        try:
-            data[mutation.id] = mutation.var_counts / (mutation.ref_counts + mutation.var_counts)
+    if num_iters == 0:
+        raise Exception('No samples left in the trace of sample {0} after burnin and thinning.'.format(sample_id))
 
-        except ZeroDivisionError:
-            data[mutation.id] = pd.np.nan
+    if num_iters > 1:
+        std = np.sqrt(m2 / (num_iters - 1))
 
-    data = pd.Series(data, name='variant_allele_frequency')
+    else:
+        std = np.full(len(mean), np.nan)
+
+    data = pd.concat([pd.Series(mean, index=columns), pd.Series(std, index=columns)], axis=1)
+
+    data.columns = 'cellular_prevalence', 'cellular_prevalence_std'
 
     data.index.name = 'mutation_id'
 
@@ -134,39 +190,72 @@ def _load_sample_variant_allele_frequencies(file_name):
     return data
 
 #=======================================================================================================================
-# Load cellular prevalences for all samples
+# Cellular prevalence histograms
 #=======================================================================================================================
 
 
-def _load_cellular_prevalences(config_file, burnin, thin):
+def load_cellular_prevalence_histograms(config_file, burnin, thin, num_bins=50):
+    '''
+    Compute fixed bin histograms of the post burnin cellular prevalence of each mutation in each sample.
+
+    The trace is processed one block of iterations at a time, binning all mutations of a block in one pass. The
+    result is cached.
+
+    Args:
+        num_bins : (int) Number of equal width bins in [0, 1].
+
+    Returns:
+        (DataFrame) Fraction of samples in each bin, indexed by mutation_id and sample_id with one column per bin
+            centre. Only mutations present in all samples are included.
+    '''
+    return load_cached_result(
+        config_file,
+        'loci_histograms',
+        {'burnin': burnin, 'num_bins': num_bins, 'thin': thin},
+        lambda: _load_cellular_prevalence_histograms(config_file, burnin, thin, num_bins)
+    )
+
+
+def _load_cellular_prevalence_histograms(config_file, burnin, thin, num_bins):
+    sample_ids = paths.get_sample_ids(config_file)
+
     data = []
 
-    for sample_id, file_name in paths.get_cellular_prevalence_trace_files(config_file).items():
-        sample_data = _load_sample_cellular_prevalences(file_name, burnin, thin)
+    for sample_id in sample_ids:
+        counts = None
 
-        sample_data['sample_id'] = sample_id
+        for block in iter_cellular_frequencies_trace_blocks(config_file, sample_id, burnin, thin):
+            values = block.values
 
-        data.append(sample_data)
+            if counts is None:
+                columns = block.columns
 
-    data = pd.concat(data, axis=0)
+                counts = np.zeros(len(columns) * num_bins, dtype=np.int64)
 
-    num_samples = len(paths.get_sample_ids(config_file))
+            bins = np.clip((values * num_bins).astype(np.int64), 0, num_bins - 1)
 
-    # Filter for mutations in all samples
-    data = data.groupby('mutation_id').filter(lambda x: len(x) == num_samples)
+            bins += np.arange(values.shape[1]) * num_bins
 
-    return data
+            counts += np.bincount(bins.ravel(), minlength=len(counts))
 
+        if counts is None:
+            raise Exception('No samples left in the trace of sample {0} after burnin and thinning.'.format(sample_id))
 
-def _load_sample_cellular_prevalences(file_name, burnin, thin):
-    data = load_cellular_frequencies_trace(file_name, burnin, thin)
+        counts = counts.reshape((len(columns), num_bins))
 
-    data = pd.concat([data.mean(), data.std()], axis=1)
+        sample_data = pd.DataFrame(
+            counts / counts.sum(axis=1)[:, np.newaxis],
+            index=pd.MultiIndex.from_product([columns, [sample_id, ]], names=['mutation_id', 'sample_id']),
+            columns=(np.arange(num_bins) + 0.5) / num_bins
+        )
 
-    data.columns = 'cellular_prevalence', 'cellular_prevalence_std'
+        data.append(sample_data)
 
-    data.index.name = 'mutation_id'
+    data = pd.concat(data, axis=0)
 
-    data = data.reset_index()
+    # Filter for mutations in all samples
+    num_samples = data.groupby(level='mutation_id').size()
+
+    data = data[data.index.get_level_values('mutation_id').isin(num_samples[num_samples == len(sample_ids)].index)]
 
     return data
@@ -6,10 +6,12 @@ Created on Dec 2, 2015
 from __future__ import division
 
 from math import ceil
-from matplotlib.patches import Ellipse
+from matplotlib.collections import EllipseCollection
+from matplotlib.colors import to_rgba
 
 import matplotlib.gridspec as gs
 import matplotlib.pyplot as pp
+import numpy as np
 
 import defaults
 import utils
@@ -82,7 +84,10 @@ def plot_all_pairs(color_map, mean_df, plot_file, samples, error_df=None, legend
 
 def _plot(ax, color_map, df, x_sample, y_sample, error_df=None):
 
-    colors = [color_map[x] for x in df.index]
+    # Convert each color once so the collections do not convert one color per point.
+    rgba = dict([(key, to_rgba(value)) for key, value in color_map.items()])
+
+    colors = np.array([rgba[x] for x in df.index])
 
     x = df[x_sample].values
 
@@ -95,21 +100,26 @@ def _plot(ax, color_map, df, x_sample, y_sample, error_df=None):
 
         y_err = error_df[y_sample].values
 
-    ax.scatter(x, y, alpha=0.8, c=colors, s=15)
-
-    for i in range(len(x)):
-        if error_df is not None:
-            e = Ellipse(
-                (x[i], y[i]),
-                width=x_err[i],
-                height=y_err[i],
-            )
+    # Vector output with many points is slow to write and view.
+    rasterized = len(x) > defaults.scatter_rasterize_min_points
 
-            e.set_facecolor(colors[i])
+    ax.scatter(x, y, alpha=0.8, c=colors, s=15, rasterized=rasterized)
 
-            e.set_alpha(0.2)
-
-            ax.add_artist(e)
+    if error_df is not None:
+        # All error ellipses are drawn by one artist, with widths and heights in data units.
+        ellipses = EllipseCollection(
+            x_err,
+            y_err,
+            np.zeros(len(x)),
+            units='xy',
+            offsets=np.column_stack([x, y]),
+            transOffset=ax.transData,
+            facecolors=colors,
+            alpha=0.2,
+            rasterized=rasterized
+        )
+
+        ax.add_collection(ellipses, autolim=False)
 
     ax.set_xlim(*defaults.cellular_prevalence_limits)
 
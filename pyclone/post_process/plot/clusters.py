@@ -20,6 +20,7 @@ def density_plot(
         config_file,
         plot_file,
         burnin=0,
+        clustering_method='mpear',
         max_clusters=None,
         mesh_size=101,
         min_cluster_size=0,
@@ -30,6 +31,7 @@ def density_plot(
         config_file,
         burnin=burnin,
         thin=thin,
+        clustering_method=clustering_method,
         max_clusters=max_clusters,
         mesh_size=mesh_size,
         min_size=min_cluster_size
@@ -133,6 +135,7 @@ def parallel_coordinates_plot(
         config_file,
         plot_file,
         burnin=0,
+        clustering_method='mpear',
         max_clusters=None,
         mesh_size=101,
         min_cluster_size=0,
@@ -144,6 +147,7 @@ def parallel_coordinates_plot(
     plot_df = post_process.clusters.load_summary_table(
         config_file,
         burnin=burnin,
+        clustering_method=clustering_method,
         max_clusters=max_clusters,
         mesh_size=mesh_size,
         min_size=min_cluster_size,
@@ -220,6 +224,7 @@ def scatter_plot(
         config_file,
         plot_file,
         burnin=0,
+        clustering_method='mpear',
         max_clusters=None,
         mesh_size=101,
         min_cluster_size=0,
@@ -231,6 +236,7 @@ def scatter_plot(
     df = post_process.clusters.load_summary_table(
         config_file,
         burnin=burnin,
+        clustering_method=clustering_method,
         max_clusters=max_clusters,
         mesh_size=mesh_size,
         min_size=min_cluster_size,
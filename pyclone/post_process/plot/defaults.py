@@ -39,3 +39,33 @@ cellular_prevalence_limits = (-0.05, 1.05)
 line_plot_marker = 'o'
 
 line_plot_marker_size = 4
+
+#=======================================================================================================================
+# Density
+#=======================================================================================================================
+density_plot_max_loci_per_page = 50
+
+density_plot_num_bins = 50
+
+#=======================================================================================================================
+# Parallel coordinates
+#=======================================================================================================================
+# Loci parallel coordinates plots with more loci are drawn as faint rasterised lines without markers.
+parallel_coordinates_density_min_loci = 1000
+
+#=======================================================================================================================
+# Scatter
+#=======================================================================================================================
+# Scatter plots with more points per panel are rasterised.
+scatter_rasterize_min_points = 1000
+
+#=======================================================================================================================
+# Similarity matrix
+#=======================================================================================================================
+# Larger inputs are plotted for a subset of loci sampled from each cluster.
+similarity_matrix_max_loci = 2000
+
+# Figure size per locus in inches, and the largest figure size. Loci are labelled while the figure is not capped.
+similarity_matrix_locus_size = 0.12
+
+similarity_matrix_max_size = 24
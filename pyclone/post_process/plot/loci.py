@@ -3,15 +3,18 @@ Created on Nov 30, 2015
 
 @author: Andrew Roth
 '''
+from __future__ import division
+
+from matplotlib.collections import LineCollection
 from scipy.cluster.hierarchy import average
-from scipy.spatial.distance import pdist, squareform
+from scipy.spatial.distance import squareform
 
 import matplotlib.gridspec as gs
 import matplotlib.pyplot as pp
+import numpy as np
 import pandas as pd
 import seaborn as sb
 
-import pyclone.paths as paths
 import pyclone.post_process as post_process
 import pyclone.trace as trace
 
@@ -28,21 +31,41 @@ def density_plot(
         config_file,
         plot_file,
         burnin=0,
+        max_loci_per_page=defaults.density_plot_max_loci_per_page,
+        num_bins=defaults.density_plot_num_bins,
         samples=None,
         thin=1):
+    '''
+    Plot the posterior distribution of the cellular prevalence of each locus in each sample as a violin drawn from a
+    histogram of the trace.
 
+    If there are more than max_loci_per_page loci the plot is split into pages. Pages are written to a single
+    file for pdf output, otherwise each page is written to a separate file as described in utils.iter_page_files.
+    '''
     utils.setup_plot()
 
-    df = _load_density_df(config_file, burnin, thin)
+    histograms = post_process.loci.load_cellular_prevalence_histograms(config_file, burnin, thin, num_bins=num_bins)
 
     if samples is None:
-        samples = sorted(df['sample_id'].unique())
+        samples = sorted(histograms.index.get_level_values('sample_id').unique())
 
-    else:
-        df = df[df['sample_id'].isin(samples)]
+    loci = list(histograms.index.get_level_values('mutation_id').unique())
+
+    num_pages = int(np.ceil(len(loci) / max_loci_per_page))
+
+    colors = sb.color_palette(n_colors=len(samples))
+
+    for page, page_file in utils.iter_page_files(plot_file, num_pages):
+        page_loci = loci[page * max_loci_per_page:(page + 1) * max_loci_per_page]
+
+        fig = _density_plot_page(histograms, page_loci, samples, colors)
 
-    loci = df['mutation_id'].unique()
+        page_file.savefig(fig, bbox_inches='tight')
 
+        pp.close(fig)
+
+
+def _density_plot_page(histograms, loci, samples, colors):
     num_loci = len(loci)
 
     width = 8
@@ -53,23 +76,43 @@ def density_plot(
 
     grid = gs.GridSpec(nrows=num_loci, ncols=1)
 
+    bin_centres = histograms.columns.values.astype(float)
+
+    bin_width = 1 / len(bin_centres)
+
     for ax_index, locus in enumerate(loci):
         ax = fig.add_subplot(grid[ax_index])
 
         utils.setup_axes(ax)
 
-        plot_df = df[df['mutation_id'] == locus]
+        for x, sample_id in enumerate(samples):
+            density = np.nan_to_num(histograms.loc[(locus, sample_id)].values)
 
-        sb.violinplot(
-            ax=ax,
-            data=plot_df,
-            x='sample_id',
-            y='cellular_prevalence',
+            support = np.flatnonzero(density > 0)
 
-            inner=None,
-            order=samples,
-            scale='width'
-        )
+            # Nothing to draw if the histogram is empty, for example when no iterations are left after burnin.
+            if len(support) == 0:
+                continue
+
+            start, stop = support[0], support[-1] + 1
+
+            # Scale each violin to the same width as seaborn.violinplot(scale='width') does, closing it half a bin
+            # beyond the occupied bins.
+            half_width = 0.4 * density[start:stop] / density.max()
+
+            half_width = np.concatenate([[0], half_width, [0]])
+
+            y = np.concatenate([
+                [bin_centres[start] - bin_width / 2],
+                bin_centres[start:stop],
+                [bin_centres[stop - 1] + bin_width / 2]
+            ])
+
+            ax.fill_betweenx(y, x - half_width, x + half_width, facecolor=colors[x], edgecolor='0.25', linewidth=1)
+
+        ax.set_xlim(-0.5, len(samples) - 0.5)
+
+        ax.set_xticks(range(len(samples)))
 
         ax.set_ylabel('')
 
@@ -79,6 +122,8 @@ def density_plot(
             ax.set_xlabel('')
 
         else:
+            ax.set_xticklabels(samples)
+
             ax.set_xlabel(defaults.sample_label)
 
         ax.set_ylim(*defaults.cellular_prevalence_limits)
@@ -104,35 +149,7 @@ def density_plot(
 
     grid.tight_layout(fig, h_pad=3)
 
-    utils.save_figure(fig, plot_file)
-
-
-def _load_density_df(config_file, burnin, thin):
-    trace_files = paths.get_cellular_prevalence_trace_files(config_file)
-
-    df = []
-
-    for sample_id, file_name in trace_files.items():
-
-        sample_df = trace.load_cellular_frequencies_trace(
-            file_name,
-            burnin,
-            thin
-        )
-
-        sample_df = sample_df.unstack().reset_index()
-
-        sample_df.columns = 'mutation_id', 'iter', 'cellular_prevalence'
-
-        sample_df['sample_id'] = sample_id
-
-        sample_df = sample_df[['mutation_id', 'sample_id', 'cellular_prevalence']]
-
-        df.append(sample_df)
-
-    df = pd.concat(df)
-
-    return df
+    return fig
 
 #=======================================================================================================================
 # Parallel coordinates
@@ -143,6 +160,7 @@ def parallel_coordinates_plot(
         config_file,
         plot_file,
         burnin=0,
+        clustering_method='mpear',
         max_clusters=None,
         min_cluster_size=0,
         samples=None,
@@ -155,6 +173,7 @@ def parallel_coordinates_plot(
         config_file,
         burnin,
         thin,
+        clustering_method=clustering_method,
         max_clusters=max_clusters,
         min_cluster_size=min_cluster_size
     )
@@ -167,9 +186,22 @@ def parallel_coordinates_plot(
     else:
         df = df[df['sample_id'].isin(samples)]
 
-    df['sample_index'] = df['sample_id'].apply(lambda x: samples.index(x))
+    values = df.pivot(index='mutation_id', columns='sample_id', values=value)[samples]
+
+    labels = df.groupby('mutation_id')['cluster_id'].first().loc[values.index]
+
+    x = np.arange(len(samples))
+
+    # Many overlapping lines are drawn faintly and rasterised so their density shows.
+    num_loci = len(values)
+
+    density = num_loci > defaults.parallel_coordinates_density_min_loci
+
+    if density:
+        alpha = max(0.75 * defaults.parallel_coordinates_density_min_loci / num_loci, 0.02)
 
-    df = df.sort_values(by='sample_index')
+    else:
+        alpha = 0.75
 
     fig = pp.figure()
 
@@ -177,21 +209,27 @@ def parallel_coordinates_plot(
 
     utils.setup_axes(ax)
 
-    for cluster_id, cluster_df in df.groupby('cluster_id'):
-        for _, locus_df in cluster_df.groupby('mutation_id'):
-            x = locus_df['sample_index']
+    for cluster_id in sorted(labels.unique()):
+        y = values[(labels == cluster_id).values].values
+
+        segments = np.dstack([np.tile(x, (len(y), 1)), y])
 
-            y = locus_df[value]
+        ax.add_collection(LineCollection(segments, alpha=alpha, colors=[color_map[cluster_id]], rasterized=density))
 
+        if not density:
             ax.plot(
-                x,
-                y,
-                alpha=0.75,
+                np.tile(x, len(y)),
+                y.ravel(),
+                alpha=alpha,
                 c=color_map[cluster_id],
+                linestyle='none',
                 marker=defaults.line_plot_marker,
                 markersize=defaults.line_plot_marker_size
             )
 
+    # Collections do not update the view limits when added.
+    ax.autoscale_view()
+
     ax.set_xlabel(defaults.sample_label, fontsize=defaults.axis_label_font_size)
 
     if value == 'cellular_prevalence':
@@ -200,7 +238,7 @@ def parallel_coordinates_plot(
     elif value == 'variant_allele_frequency':
         ax.set_ylabel(defaults.variant_allele_frequency_label)
 
-    ax.set_xticks(sorted(df['sample_index'].unique()))
+    ax.set_xticks(x)
 
     ax.set_xticklabels(samples)
 
@@ -236,6 +274,7 @@ def scatter_plot(
         config_file,
         plot_file,
         burnin=0,
+        clustering_method='mpear',
         max_clusters=None,
         min_cluster_size=0,
         samples=None,
@@ -248,6 +287,7 @@ def scatter_plot(
         config_file,
         burnin,
         thin,
+        clustering_method=clustering_method,
         max_clusters=max_clusters,
         min_cluster_size=min_cluster_size
     )
@@ -280,14 +320,28 @@ def similarity_matrix_plot(
         config_file,
         plot_file,
         burnin=0,
+        clustering_method='mpear',
         max_clusters=None,
+        max_loci=defaults.similarity_matrix_max_loci,
         min_cluster_size=0,
         samples=None,
         thin=1):
+    '''
+    Plot the posterior similarity matrix of the loci.
 
+    Memory use is bounded by max_loci. If more loci are used a subset of max_loci loci sampled from each cluster in
+    proportion to its size is plotted. The matrix is taken from the one accumulated during sampling if available,
+    otherwise it is computed from the labels trace for the plotted loci only.
+    '''
     sb.set_style('whitegrid')
 
-    labels = post_process.cluster_pyclone_trace(config_file, burnin, thin, max_clusters=max_clusters)
+    labels = post_process.cluster_pyclone_trace(
+        config_file,
+        burnin,
+        thin,
+        max_clusters=max_clusters,
+        method=clustering_method
+    )
 
     labels = labels.set_index('mutation_id')
 
@@ -301,27 +355,33 @@ def similarity_matrix_plot(
 
     labels = labels[labels.isin(used_clusters)]
 
-    used_loci = labels.index
+    num_loci = len(labels)
 
-    trace_file = paths.get_labels_trace_file(config_file)
+    if num_loci > max_loci:
+        labels = _downsample_loci(labels, max_loci)
 
-    labels_trace = trace.load_cluster_labels_trace(trace_file, burnin, thin)
+    used_loci = list(labels.index)
 
-    labels_trace = labels_trace[used_loci]
+    sim_mat = trace.load_similarity_matrices(config_file, burnin, thin, columns=used_loci)
 
-    dist_mat = pdist(labels_trace.values.T, 'hamming')
+    if sim_mat is None:
+        sim_mat = _compute_similarity_matrix(config_file, burnin, thin, used_loci)
 
-    Z = average(dist_mat)
+    dist_mat = 1 - sim_mat.values
 
-    dist_mat = pd.DataFrame(squareform(dist_mat), index=labels_trace.columns, columns=labels_trace.columns)
+    np.fill_diagonal(dist_mat, 0)
 
-    sim_mat = 1 - dist_mat
+    Z = average(squareform(dist_mat, checks=False))
 
     N = sim_mat.shape[0]
 
     cluster_colors = labels.map(color_map)
 
-    size = 0.12 * N
+    size = defaults.similarity_matrix_locus_size * N
+
+    show_tick_labels = size <= defaults.similarity_matrix_max_size
+
+    size = min(size, defaults.similarity_matrix_max_size)
 
     g = sb.clustermap(
         sim_mat,
@@ -330,7 +390,10 @@ def similarity_matrix_plot(
         row_colors=cluster_colors,
         col_linkage=Z,
         row_linkage=Z,
-        figsize=(size, size)
+        figsize=(size, size),
+        rasterized=True,
+        xticklabels=show_tick_labels,
+        yticklabels=show_tick_labels
     )
 
     ax = g.ax_heatmap
@@ -343,4 +406,43 @@ def similarity_matrix_plot(
 
     ax.set_ylabel('Loci', fontsize=defaults.axis_label_font_size)
 
+    if N < num_loci:
+        g.fig.suptitle('Subset of {0} of {1} loci'.format(N, num_loci), fontsize=defaults.axis_label_font_size, y=1.02)
+
     g.fig.savefig(plot_file, bbox_inches='tight')
+
+
+def _compute_similarity_matrix(config_file, burnin, thin, mutation_ids):
+    '''
+    Compute the posterior similarity matrix of a set of loci from the labels trace, one sample at a time.
+    '''
+    labels_trace = trace.load_cluster_labels_traces(config_file, burnin, thin, columns=mutation_ids)
+
+    sim_mat = trace.SimilarityMatrix(labels_trace.columns)
+
+    for labels in labels_trace.values:
+        sim_mat.update(labels)
+
+    return pd.DataFrame(
+        sim_mat.get_counts() / max(sim_mat.num_samples, 1),
+        index=sim_mat.mutation_ids,
+        columns=sim_mat.mutation_ids
+    )
+
+
+def _downsample_loci(labels, max_loci, seed=0):
+    '''
+    Sample max_loci loci, keeping the proportion of loci in each cluster and at least one locus from every cluster.
+    '''
+    random_state = np.random.RandomState(seed)
+
+    num_loci = len(labels)
+
+    sampled = []
+
+    for _, cluster_labels in labels.groupby(labels):
+        n = max(1, int(round(max_loci * len(cluster_labels) / num_loci)))
+
+        sampled.extend(random_state.choice(cluster_labels.index, size=min(n, len(cluster_labels)), replace=False))
+
+    return labels.loc[sampled]
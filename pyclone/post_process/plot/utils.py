@@ -4,8 +4,10 @@ Created on 2012-08-20
 @author: Andrew Roth
 '''
 from collections import OrderedDict
+from matplotlib.backends.backend_pdf import PdfPages
 from matplotlib.lines import Line2D
 
+import os
 import seaborn as sb
 
 
@@ -47,6 +49,37 @@ def save_figure(fig, file_name):
     fig.savefig(file_name, bbox_inches='tight')
 
 
+def iter_page_files(file_name, num_pages):
+    '''
+    Iterate over the pages of a multi-page plot, yielding the page index and an object with a savefig method.
+
+    A single page is saved to file_name. Multiple pages are saved as pages of file_name for pdf output, otherwise page
+    i is saved to <file_name without extension>.page_<i + 1><extension>.
+    '''
+    if num_pages <= 1:
+        yield 0, _PageFile(file_name)
+
+    elif file_name.endswith('.pdf'):
+        with PdfPages(file_name) as pdf:
+            for page in range(num_pages):
+                yield page, pdf
+
+    else:
+        root, ext = os.path.splitext(file_name)
+
+        for page in range(num_pages):
+            yield page, _PageFile('{0}.page_{1}{2}'.format(root, page + 1, ext))
+
+
+class _PageFile(object):
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+    def savefig(self, fig, **kwargs):
+        fig.savefig(self.file_name, **kwargs)
+
+
 def set_axis_label_font_size(ax, size):
     ax.set_xlabel(ax.get_xlabel(), fontsize=size)
 
@@ -6,6 +6,7 @@ Created on 2013-04-28
 from __future__ import division
 
 from collections import OrderedDict
+from math import lgamma as log_gamma
 
 from pydp.base_measures import BetaBaseMeasure, GammaBaseMeasure
 from pydp.data import GammaData
@@ -18,14 +19,16 @@ from pydp.samplers.partition import AuxillaryParameterPartitionSampler
 
 import numpy as np
 
-from pyclone.math_utils import log_beta_binomial_likelihood, log_sum_exp, jit
+from pyclone.math_utils import log_beta, log_beta_binomial_likelihood, log_sum_exp, jit
+from pyclone.mcmc import run_mcmc
 from pyclone.multi_sample import MultiSampleBaseMeasure, MultiSampleDensity, MultiSampleAtomSampler
 from pyclone.trace import DiskTrace
 
 import pyclone.config as config
 
 
-def run_pyclone_beta_binomial_analysis(config_file, num_iters, alpha, alpha_priors):
+def run_pyclone_beta_binomial_analysis(config_file, num_iters, alpha, alpha_priors, chain=None, resume=False,
+                                       shared_diagnostics=None, num_chains=1):
     data, sample_ids = config.load_data(config_file)
 
     print 'Beginning analysis using:'
@@ -84,33 +87,88 @@ def run_pyclone_beta_binomial_analysis(config_file, num_iters, alpha, alpha_prio
         global_params_sampler,
     )
 
-    trace = DiskTrace(config_file, data.keys(), {'cellular_frequencies': 'x'}, precision=True)
+    trace = DiskTrace(config_file, data.keys(), {'cellular_frequencies': 'x'}, precision=True, chain=chain)
+
+    run_mcmc(
+        config_file,
+        sampler,
+        data,
+        trace,
+        num_iters,
+        init_method,
+        chain=chain,
+        precision=True,
+        resume=resume,
+        shared_diagnostics=shared_diagnostics,
+        num_chains=num_chains
+    )
 
-    trace.open()
 
-    sampler.initialise_partition(data.values(), init_method)
+class PyCloneBetaBinomialDensity(Density):
 
-    for i in range(num_iters):
-        state = sampler.state
+    def __init__(self, params=None):
+        Density.__init__(self, params)
 
-        if i % 100 == 0:
-            print 'Iteration: {}'.format(i)
-            print 'Number of clusters: {}'.format(len(np.unique(state['labels'])))
-            print 'DP concentration: {}'.format(state['alpha'])
-            print 'Beta-Binomial precision: {}'.format(state['global_params'][0])
-            print
+        self._state_table_cache = None
 
-        sampler.interactive_sample(data.values())
+        self._log_gamma_totals_cache = None
 
-        trace.update(state)
+    def log_p(self, data, params):
+        return self._log_p(data, params)
 
-    trace.close()
+    def log_p_matrix(self, data_block, params):
+        '''
+        Compute the log likelihood of every data point in a block for every cellular prevalence in one call.
+
+        The normalising log_beta(a, b) terms are shared by all states in the block with the same copy number, allele
+        probabilities and tumour content. The per data point log_gamma(s + d) terms are cached until the precision s
+        changes.
+
+        Args:
+            data_block : (PyCloneDataBlock) Packed data built by pyclone.config.pack_data.
+            params : (array) Cellular prevalences to evaluate.
+
+        Returns:
+            (array) Matrix of shape number of data points by number of cellular prevalences.
+        '''
+        precision = self.params.x
+
+        state_ids, states = self._get_state_table(data_block)
+
+        log_gamma_totals = self._get_log_gamma_totals(data_block, precision)
+
+        return _log_p_matrix(
+            data_block.b, data_block.d,
+            data_block.state_offsets,
+            state_ids,
+            states[:, 0], states[:, 1], states[:, 2],
+            states[:, 3], states[:, 4], states[:, 5],
+            states[:, 6],
+            data_block.log_pi,
+            log_gamma_totals,
+            np.asarray(params, dtype=np.float64),
+            precision
+        )
 
+    def _get_log_gamma_totals(self, data_block, precision):
+        cache = self._log_gamma_totals_cache
 
-class PyCloneBetaBinomialDensity(Density):
+        if (cache is None) or (cache[0] is not data_block) or (cache[1] != precision):
+            cache = (data_block, precision, _log_gamma_totals(data_block.d, precision))
 
-    def log_p(self, data, params):
-        return self._log_p(data, params)
+            self._log_gamma_totals_cache = cache
+
+        return cache[2]
+
+    def _get_state_table(self, data_block):
+        cache = self._state_table_cache
+
+        if (cache is None) or (cache[0] is not data_block):
+            cache = (data_block,) + _get_state_table(data_block)
+
+            self._state_table_cache = cache
+
+        return cache[1], cache[2]
 
     def _log_p(self, data, params):
         return _log_p(
@@ -122,6 +180,125 @@ class PyCloneBetaBinomialDensity(Density):
         )
 
 
+def _get_state_table(data_block):
+    '''
+    Find the distinct (cn_n, cn_r, cn_v, mu_n, mu_r, mu_v, tumour_content) states in a data block.
+
+    Data points sharing a state table and tumour content have the same states, so only the first data point of each
+    such group is expanded.
+
+    Returns:
+        state_ids : (array) Index of the distinct state for each entry of the block state arrays.
+        states : (array) Distinct states, one per row.
+    '''
+    num_states = np.diff(data_block.state_offsets)
+
+    if len(data_block.b) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, 7))
+
+    groups = np.column_stack([data_block.state_table_ids, data_block.tumour_content])
+
+    _, first, group_ids = np.unique(groups, axis=0, return_index=True, return_inverse=True)
+
+    group_ids = group_ids.ravel()
+
+    group_sizes = num_states[first]
+
+    group_offsets = np.zeros(len(first) + 1, dtype=np.int64)
+
+    group_offsets[1:] = np.cumsum(group_sizes)
+
+    rows = np.concatenate([
+        np.arange(data_block.state_offsets[n], data_block.state_offsets[n + 1]) for n in first
+    ])
+
+    states = np.column_stack([
+        data_block.cn_n[rows], data_block.cn_r[rows], data_block.cn_v[rows],
+        data_block.mu_n[rows], data_block.mu_r[rows], data_block.mu_v[rows],
+        np.repeat(data_block.tumour_content[first], group_sizes)
+    ])
+
+    # Position of each entry within the states of its data point.
+    local_ids = np.arange(data_block.state_offsets[-1]) - np.repeat(data_block.state_offsets[:-1], num_states)
+
+    state_ids = np.repeat(group_offsets[group_ids], num_states) + local_ids
+
+    return state_ids.astype(np.int64), np.ascontiguousarray(states)
+
+
+@jit(cache=True, nopython=True)
+def _log_gamma_totals(d, precision):
+    log_gamma_totals = np.zeros(len(d))
+
+    for n in range(len(d)):
+        log_gamma_totals[n] = log_gamma(precision + d[n])
+
+    return log_gamma_totals
+
+
+@jit(cache=True, nopython=True)
+def _log_p_matrix(
+        b, d,
+        state_offsets,
+        state_ids,
+        cn_n, cn_r, cn_v,
+        mu_n, mu_r, mu_v,
+        t,
+        log_pi,
+        log_gamma_totals,
+        f,
+        precision):
+
+    num_data_points = len(b)
+
+    num_params = len(f)
+
+    num_unique_states = len(t)
+
+    log_p = np.zeros((num_data_points, num_params))
+
+    mu = np.zeros(num_unique_states)
+
+    log_norm = np.zeros(num_unique_states)
+
+    max_num_states = 0
+
+    for n in range(num_data_points):
+        max_num_states = max(max_num_states, state_offsets[n + 1] - state_offsets[n])
+
+    ll = np.zeros(max_num_states)
+
+    for k in range(num_params):
+        for u in range(num_unique_states):
+            mu[u] = _get_mu(cn_n[u], cn_r[u], cn_v[u], mu_n[u], mu_r[u], mu_v[u], f[k], t[u])
+
+            log_norm[u] = log_beta(mu[u] * precision, (1 - mu[u]) * precision)
+
+        for n in range(num_data_points):
+            start = state_offsets[n]
+
+            stop = state_offsets[n + 1]
+
+            for i in range(start, stop):
+                u = state_ids[i]
+
+                param_a = mu[u] * precision
+
+                param_b = (1 - mu[u]) * precision
+
+                if np.isinf(log_norm[u]):
+                    ll[i - start] = log_pi[i] + log_beta_binomial_likelihood(b[n], d[n], param_a, param_b)
+
+                else:
+                    ll[i - start] = log_pi[i] + \
+                        log_gamma(param_a + b[n]) + log_gamma(param_b + d[n] - b[n]) - \
+                        log_gamma_totals[n] - log_norm[u]
+
+            log_p[n, k] = log_sum_exp(ll[:stop - start])
+
+    return log_p
+
+
 @jit(cache=True, nopython=True)
 def _log_p(b, d, cn_n, cn_r, cn_v, mu_n, mu_r, mu_v, log_pi, f, t, s):
     num_states = len(log_pi)
@@ -143,6 +320,17 @@ def _log_p(b, d, cn_n, cn_r, cn_v, mu_n, mu_r, mu_v, log_pi, f, t, s):
 
 @jit(cache=True, nopython=True)
 def _log_beta_binomial_likelihood(b, d, cn_n, cn_r, cn_v, mu_n, mu_r, mu_v, f, t, precision):
+    mu = _get_mu(cn_n, cn_r, cn_v, mu_n, mu_r, mu_v, f, t)
+
+    param_a = mu * precision
+
+    param_b = (1 - mu) * precision
+
+    return log_beta_binomial_likelihood(b, d, param_a, param_b)
+
+
+@jit(cache=True, nopython=True)
+def _get_mu(cn_n, cn_r, cn_v, mu_n, mu_r, mu_v, f, t):
     p_n = (1 - t) * cn_n
     p_r = t * (1 - f) * cn_r
     p_v = t * f * cn_v
@@ -153,10 +341,4 @@ def _log_beta_binomial_likelihood(b, d, cn_n, cn_r, cn_v, mu_n, mu_r, mu_v, f, t
     p_r = p_r / norm_const
     p_v = p_v / norm_const
 
-    mu = p_n * mu_n + p_r * mu_r + p_v * mu_v
-
-    param_a = mu * precision
-
-    param_b = (1 - mu) * precision
-
-    return log_beta_binomial_likelihood(b, d, param_a, param_b)
+    return p_n * mu_n + p_r * mu_r + p_v * mu_v
@@ -16,13 +16,15 @@ from pydp.samplers.partition import AuxillaryParameterPartitionSampler
 import numpy as np
 
 from pyclone.math_utils import jit, log_binomial_likelihood, log_sum_exp
+from pyclone.mcmc import run_mcmc
 from pyclone.multi_sample import MultiSampleBaseMeasure, MultiSampleDensity, MultiSampleAtomSampler
 from pyclone.trace import DiskTrace
 
 import pyclone.config as config
 
 
-def run_pyclone_binomial_analysis(config_file, num_iters, alpha, alpha_priors):
+def run_pyclone_binomial_analysis(config_file, num_iters, alpha, alpha_priors, chain=None, resume=False,
+                                  shared_diagnostics=None, num_chains=1):
     data, sample_ids = config.load_data(config_file)
 
     print 'Beginning analysis using:'
@@ -58,26 +60,20 @@ def run_pyclone_binomial_analysis(config_file, num_iters, alpha, alpha_priors):
 
     sampler = DirichletProcessSampler(atom_sampler, partition_sampler, alpha, alpha_priors)
 
-    trace = DiskTrace(config_file, data.keys(), {'cellular_frequencies': 'x'})
+    trace = DiskTrace(config_file, data.keys(), {'cellular_frequencies': 'x'}, chain=chain)
 
-    trace.open()
-
-    sampler.initialise_partition(data.values(), init_method)
-
-    for i in range(num_iters):
-        state = sampler.state
-
-        if i % 100 == 0:
-            print 'Iteration: {}'.format(i)
-            print 'Number of clusters: {}'.format(len(np.unique(state['labels'])))
-            print 'DP concentration: {}'.format(state['alpha'])
-            print
-
-        sampler.interactive_sample(data.values())
-
-        trace.update(state)
-
-    trace.close()
+    run_mcmc(
+        config_file,
+        sampler,
+        data,
+        trace,
+        num_iters,
+        init_method,
+        chain=chain,
+        resume=resume,
+        shared_diagnostics=shared_diagnostics,
+        num_chains=num_chains
+    )
 
 
 class PyCloneBinomialDensity(Density):
@@ -85,6 +81,26 @@ class PyCloneBinomialDensity(Density):
     def log_p(self, data, params):
         return self._log_p(data, params)
 
+    def log_p_matrix(self, data_block, params):
+        '''
+        Compute the log likelihood of every data point in a block for every cellular prevalence in one call.
+
+        Args:
+            data_block : (PyCloneDataBlock) Packed data built by pyclone.config.pack_data.
+            params : (array) Cellular prevalences to evaluate.
+
+        Returns:
+            (array) Matrix of shape number of data points by number of cellular prevalences.
+        '''
+        return _log_p_matrix(
+            data_block.b, data_block.d, data_block.tumour_content,
+            data_block.state_offsets,
+            data_block.cn_n, data_block.cn_r, data_block.cn_v,
+            data_block.mu_n, data_block.mu_r, data_block.mu_v,
+            data_block.log_pi,
+            np.asarray(params, dtype=np.float64)
+        )
+
     def _log_p(self, data, params):
         return _log_p(
             data.b, data.d,
@@ -95,6 +111,37 @@ class PyCloneBinomialDensity(Density):
         )
 
 
+@jit(cache=True, nopython=True)
+def _log_p_matrix(b, d, t, state_offsets, cn_n, cn_r, cn_v, mu_n, mu_r, mu_v, log_pi, f):
+    num_data_points = len(b)
+
+    num_params = len(f)
+
+    log_p = np.zeros((num_data_points, num_params))
+
+    for n in range(num_data_points):
+        start = state_offsets[n]
+
+        stop = state_offsets[n + 1]
+
+        ll = np.zeros(stop - start)
+
+        for k in range(num_params):
+            for i in range(start, stop):
+                ll[i - start] = log_pi[i]
+
+                ll[i - start] += _log_binomial_likelihood(
+                    b[n], d[n],
+                    cn_n[i], cn_r[i], cn_v[i],
+                    mu_n[i], mu_r[i], mu_v[i],
+                    f[k], t[n]
+                )
+
+            log_p[n, k] = log_sum_exp(ll)
+
+    return log_p
+
+
 @jit(cache=True, nopython=True)
 def _log_p(b, d, cn_n, cn_r, cn_v, mu_n, mu_r, mu_v, log_pi, f, t):
     num_states = len(log_pi)
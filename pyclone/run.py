@@ -13,18 +13,22 @@ except ImportError:
     from yaml import Dumper, Loader
 
 import csv
+import multiprocessing
+import numpy as np
 import os
 import random
+import shutil
+import traceback
 import yaml
 
 from pyclone.config import get_mutation
-from pyclone.pyclone_beta_binomial import run_pyclone_beta_binomial_analysis
-from pyclone.pyclone_binomial import run_pyclone_binomial_analysis
 from pyclone.utils import make_directory, make_parent_directory
 
+import pyclone.kernels as kernels
 import pyclone.paths as paths
-import pyclone.post_process as post_process
-import pyclone.post_process.plot as plot
+
+# The samplers, trace and post processing modules pull in numba, scipy, pandas and matplotlib. They are imported by the
+# functions which use them so commands such as build_mutations_file start quickly.
 
 #=======================================================================================================================
 # PyClone analysis
@@ -39,12 +43,15 @@ def run_analysis_pipeline(args):
         num_iters=args.num_iters,
         samples=args.samples,
         prior=args.prior,
+        sampler=args.sampler,
+        trace_format=args.trace_format,
         tumour_contents=args.tumour_contents,
         working_dir=args.working_dir,
         config_extras_file=args.config_extras_file,
+        write_yaml=args.write_yaml,
     )
 
-    _run_analysis(config_file, args.seed)
+    _run_analysis(config_file, args.seed, num_chains=args.num_chains, jobs=args.jobs)
 
     tables_dir = os.path.join(args.working_dir, 'tables')
 
@@ -57,12 +64,14 @@ def run_analysis_pipeline(args):
             config_file=config_file,
             out_file=out_file,
             burnin=args.burnin,
+            clustering_method=args.clustering_method,
             max_clusters=args.max_clusters,
             mesh_size=args.mesh_size,
             table_type=table_type,
             thin=args.thin
         )
 
+    # The tables cache the clustering and summary results, so the plots only load them.
     plots_dir = os.path.join(args.working_dir, 'plots')
 
     plots = [
@@ -77,6 +86,8 @@ def run_analysis_pipeline(args):
         ('loci', 'vaf_scatter')
     ]
 
+    plot_args = []
+
     for category, plot_type in plots:
 
         plot_file = os.path.join(plots_dir, category, '{0}.{1}'.format(plot_type, args.plot_file_format))
@@ -85,29 +96,102 @@ def run_analysis_pipeline(args):
 
         if category == 'cluster':
 
-            _cluster_plot(
-                config_file,
-                plot_file,
-                args.burnin,
-                args.max_clusters,
-                args.mesh_size,
-                args.min_cluster_size,
-                plot_type,
-                args.samples,
-                args.thin
-            )
+            plot_args.append((
+                _cluster_plot,
+                (
+                    config_file,
+                    plot_file,
+                    args.burnin,
+                    args.max_clusters,
+                    args.mesh_size,
+                    args.min_cluster_size,
+                    plot_type,
+                    args.samples,
+                    args.thin
+                ),
+                {'clustering_method': args.clustering_method}
+            ))
 
         elif category == 'loci':
 
-            _loci_plot(
-                config_file,
-                plot_file,
-                plot_type,
-                burnin=args.burnin,
-                min_cluster_size=args.min_cluster_size,
-                samples=args.samples,
-                thin=args.thin
-            )
+            plot_args.append((
+                _loci_plot,
+                (config_file, plot_file, plot_type),
+                {
+                    'burnin': args.burnin,
+                    'clustering_method': args.clustering_method,
+                    'max_clusters': args.max_clusters,
+                    'min_cluster_size': args.min_cluster_size,
+                    'samples': args.samples,
+                    'thin': args.thin
+                }
+            ))
+
+    _render_plots(plot_args, jobs=args.jobs)
+
+
+def _render_plots(plot_args, jobs=1):
+    '''
+    Render plots with a non-interactive backend, in separate processes if jobs is greater than one. A plot which fails
+    is reported without stopping the others, and an exception listing the failed plots is raised once all are done.
+
+    Args:
+        plot_args : (list) Tuples of plot function, positional arguments and keyword arguments. The second positional
+            argument must be the plot file.
+        jobs : (int) Number of processes to use.
+    '''
+    if jobs == 1:
+        _init_plot_process()
+
+        results = [_render_plot(x) for x in plot_args]
+
+    else:
+        pool = multiprocessing.Pool(jobs, initializer=_init_plot_process)
+
+        try:
+            results = pool.map(_render_plot, plot_args, chunksize=1)
+
+        finally:
+            pool.close()
+
+            pool.join()
+
+    failed_plots = []
+
+    for plot_file, error in results:
+        if error is not None:
+            print 'Failed to render {0}'.format(plot_file)
+            print error
+
+            failed_plots.append(plot_file)
+
+    if len(failed_plots) > 0:
+        raise Exception('Failed to render {0} of {1} plots: {2}'.format(
+            len(failed_plots),
+            len(plot_args),
+            ', '.join(failed_plots)
+        ))
+
+
+def _init_plot_process():
+    import matplotlib.pyplot as pp
+
+    # Plots are only written to files so no display is needed.
+    pp.switch_backend('Agg')
+
+
+def _render_plot(args):
+    func, func_args, func_kwargs = args
+
+    plot_file = func_args[1]
+
+    try:
+        func(*func_args, **func_kwargs)
+
+    except Exception:
+        return plot_file, traceback.format_exc()
+
+    return plot_file, None
 
 
 def _write_config_file(
@@ -118,7 +202,10 @@ def _write_config_file(
         num_iters,
         tumour_contents,
         working_dir,
-        config_extras_file=None):
+        config_extras_file=None,
+        priors=None,
+        sampler='pydp',
+        trace_format='binary'):
 
     config = {}
 
@@ -148,10 +235,21 @@ def _write_config_file(
 
     config['init_method'] = init_method
 
+    # Checkpoints are only supported for binary traces.
+    if trace_format == 'binary':
+        config['checkpoint_interval'] = 1000
+
+    else:
+        config['checkpoint_interval'] = 0
+
+    config['sampler'] = sampler
+
     config['working_dir'] = os.path.abspath(working_dir)
 
     config['trace_dir'] = 'trace'
 
+    config['trace_format'] = trace_format
+
     config['samples'] = {}
 
     for sample_id in mutations_files:
@@ -163,6 +261,9 @@ def _write_config_file(
             'error_rate': 0.001
         }
 
+        if (priors is not None) and (sample_id in priors):
+            config['samples'][sample_id]['prior'] = priors[sample_id]
+
     if config_extras_file is not None:
         config.update(yaml.load(open(config_extras_file), Loader=Loader))
 
@@ -171,14 +272,112 @@ def _write_config_file(
 
 
 def run_analysis(args):
-    _run_analysis(args.config_file, args.seed)
+    _run_analysis(args.config_file, args.seed, num_chains=args.num_chains, jobs=args.jobs, resume=args.resume)
+
+
+def _run_analysis(config_file, seed, num_chains=1, jobs=1, resume=False):
+    '''
+    Run the MCMC sampler. When more than one chain is requested each chain is run in a separate process with its own
+    seed and writes its trace to a chain_<i> sub directory of the trace directory.
+
+    If resume is set each chain continues from its last checkpoint and the existing traces are kept.
+    '''
+    # Remove chains left by a previous run so post-processing does not mix traces from different runs.
+    if not resume:
+        for chain_id in paths.get_chain_ids(config_file):
+            if chain_id is not None:
+                shutil.rmtree(paths.get_trace_dir(config_file, chain=chain_id))
+
+    else:
+        _check_resume_chains(config_file, num_chains)
+
+    if num_chains == 1:
+        _run_chain(config_file, seed, resume=resume)
+
+        return
+
+    chain_seeds = _get_chain_seeds(seed, num_chains)
+
+    # Chains publish their diagnostic series here so early stopping can use R-hat across chains.
+    if jobs == 1:
+        manager = None
+
+        shared_diagnostics = {}
+
+    else:
+        manager = multiprocessing.Manager()
+
+        shared_diagnostics = manager.dict()
+
+    chain_args = [
+        (config_file, chain_seeds[chain_id], chain_id, resume, shared_diagnostics, num_chains)
+        for chain_id in range(num_chains)
+    ]
+
+    if jobs == 1:
+        for x in chain_args:
+            _run_chain(*x)
+
+    else:
+        pool = multiprocessing.Pool(jobs)
+
+        try:
+            pool.map(_run_chain_from_args, chain_args)
+
+        finally:
+            pool.close()
+
+            pool.join()
+
+            manager.shutdown()
+
 
+def _check_resume_chains(config_file, num_chains):
+    '''
+    Check the chains on disk match the number of chains requested before resuming.
+    '''
+    if num_chains == 1:
+        expected_chain_ids = [None, ]
 
-def _run_analysis(config_file, seed):
+    else:
+        expected_chain_ids = list(range(num_chains))
+
+    chain_ids = paths.get_chain_ids(config_file)
+
+    if chain_ids != expected_chain_ids:
+        if chain_ids == [None, ]:
+            num_found = 1
+
+        else:
+            num_found = len(chain_ids)
+
+        raise Exception(
+            'Cannot resume analysis with {0} chains. The trace directory has {1} chains. Set --num_chains to match the '
+            'analysis being resumed.'.format(num_chains, num_found)
+        )
+
+
+def _get_chain_seeds(seed, num_chains):
+    '''
+    Get an independent seed for each chain. The seeds are reproducible if seed is not None.
+    '''
+    rng = random.Random(seed)
+
+    return [rng.randint(0, 2 ** 31 - 1) for _ in range(num_chains)]
+
+
+def _run_chain_from_args(args):
+    _run_chain(*args)
+
+
+def _run_chain(config_file, seed, chain=None, resume=False, shared_diagnostics=None, num_chains=1):
     if seed is not None:
         random.seed(seed)
 
-    config = paths.load_config(config_file)
+        np.random.seed(seed % (2 ** 32))
+
+    # Parse the config once and pass the parsed object down to the sampler and trace.
+    config = paths.get_config(config_file)
 
     alpha = config['concentration']['value']
 
@@ -191,25 +390,59 @@ def _run_analysis(config_file, seed):
 
     density = config['density']
 
-    if density == 'pyclone_beta_binomial':
+    sampler = config.get('sampler', 'pydp')
+
+    if sampler == 'native':
+        from pyclone.native_sampler import run_native_analysis
+
+        run_native_analysis(
+            config,
+            density,
+            num_iters,
+            alpha,
+            alpha_priors,
+            chain=chain,
+            resume=resume,
+            shared_diagnostics=shared_diagnostics,
+            num_chains=num_chains
+        )
+
+    elif sampler != 'pydp':
+        raise Exception('{0} is not a valid sampler for PyClone.'.format(sampler))
+
+    elif density == 'pyclone_beta_binomial':
+        from pyclone.pyclone_beta_binomial import run_pyclone_beta_binomial_analysis
+
         run_pyclone_beta_binomial_analysis(
-            config_file,
+            config,
             num_iters,
             alpha,
-            alpha_priors
+            alpha_priors,
+            chain=chain,
+            resume=resume,
+            shared_diagnostics=shared_diagnostics,
+            num_chains=num_chains
         )
 
     elif density == 'pyclone_binomial':
+        from pyclone.pyclone_binomial import run_pyclone_binomial_analysis
+
         run_pyclone_binomial_analysis(
-            config_file,
+            config,
             num_iters,
             alpha,
-            alpha_priors
+            alpha_priors,
+            chain=chain,
+            resume=resume,
+            shared_diagnostics=shared_diagnostics,
+            num_chains=num_chains
         )
 
     else:
         raise Exception('{0} is not a valid density for PyClone.'.format(density))
 
+    kernels.print_cache_report()
+
 
 def setup_analysis(args):
     _setup_analysis(
@@ -220,8 +453,11 @@ def setup_analysis(args):
         num_iters=args.num_iters,
         samples=args.samples,
         prior=args.prior,
+        sampler=args.sampler,
+        trace_format=args.trace_format,
         tumour_contents=args.tumour_contents,
         working_dir=args.working_dir,
+        write_yaml=args.write_yaml,
     )
 
 
@@ -233,14 +469,17 @@ def _setup_analysis(
         num_iters,
         samples, prior,
         tumour_contents,
-        working_dir):
+        working_dir,
+        sampler='pydp',
+        trace_format='binary',
+        write_yaml=False):
 
     make_directory(working_dir)
 
-    make_directory(os.path.join(working_dir, 'yaml'))
-
     mutations_files = OrderedDict()
 
+    priors = {}
+
     _tumour_contents = {}
 
     for i, in_file in enumerate(in_files):
@@ -250,13 +489,20 @@ def _setup_analysis(
         else:
             sample_id = os.path.splitext(os.path.basename(in_file))[0]
 
-        mutations_files[sample_id] = os.path.join(working_dir, 'yaml', '{0}.yaml'.format(sample_id))
+        # The tsv files are loaded directly unless the intermediate YAML files are requested.
+        if write_yaml:
+            mutations_files[sample_id] = os.path.join(working_dir, 'yaml', '{0}.yaml'.format(sample_id))
 
-        _build_mutations_file(
-            in_file,
-            mutations_files[sample_id],
-            prior
-        )
+            _build_mutations_file(
+                in_file,
+                mutations_files[sample_id],
+                prior
+            )
+
+        else:
+            mutations_files[sample_id] = os.path.abspath(in_file)
+
+            priors[sample_id] = prior
 
         if tumour_contents is not None:
             _tumour_contents[sample_id] = tumour_contents[i]
@@ -275,10 +521,28 @@ def _setup_analysis(
         tumour_contents=_tumour_contents,
         working_dir=working_dir,
         config_extras_file=config_extras_file,
+        priors=priors,
+        sampler=sampler,
+        trace_format=trace_format,
     )
 
     return config_file
 
+
+def compile_kernels(args):
+    results = kernels.compile_kernels(cache_dir=args.cache_dir)
+
+    num_cached = sum(results.values())
+
+    print
+    print 'Kernels loaded from cache: {0}'.format(num_cached)
+    print 'Kernels compiled: {0}'.format(len(results) - num_cached)
+
+    if args.cache_dir is not None:
+        print 'Set NUMBA_CACHE_DIR={0} when running PyClone to use the compiled kernels.'.format(
+            os.path.abspath(args.cache_dir)
+        )
+
 #=======================================================================================================================
 # Input file code
 #=======================================================================================================================
@@ -337,11 +601,18 @@ def _build_mutations_file(in_file, out_file, prior):
 #=======================================================================================================================
 
 
+def export_trace(args):
+    import pyclone.trace as trace
+
+    trace.export_trace(args.config_file, args.out_dir)
+
+
 def build_table(args):
     _build_table(
         config_file=args.config_file,
         out_file=args.out_file,
         burnin=args.burnin,
+        clustering_method=args.clustering_method,
         max_clusters=args.max_clusters,
         mesh_size=args.mesh_size,
         table_type=args.table_type,
@@ -349,11 +620,16 @@ def build_table(args):
     )
 
 
-def _build_table(config_file, out_file, burnin, max_clusters, mesh_size, table_type, thin):
+def _build_table(config_file, out_file, burnin, max_clusters, mesh_size, table_type, thin, clustering_method='mpear'):
+    import pyclone.post_process as post_process
+
+    config_file = paths.get_config(config_file)
+
     if table_type == 'cluster':
         df = post_process.clusters.load_summary_table(
             config_file,
             burnin=burnin,
+            clustering_method=clustering_method,
             max_clusters=max_clusters,
             mesh_size=mesh_size,
             thin=thin,
@@ -364,6 +640,7 @@ def _build_table(config_file, out_file, burnin, max_clusters, mesh_size, table_t
             config_file,
             burnin,
             thin,
+            clustering_method=clustering_method,
             max_clusters=max_clusters,
             old_style=False
         )
@@ -373,6 +650,7 @@ def _build_table(config_file, out_file, burnin, max_clusters, mesh_size, table_t
             config_file,
             burnin,
             thin,
+            clustering_method=clustering_method,
             max_clusters=max_clusters,
             old_style=True
         )
@@ -385,6 +663,7 @@ def cluster_plot(args):
         config_file=args.config_file,
         plot_file=args.plot_file,
         burnin=args.burnin,
+        clustering_method=args.clustering_method,
         max_clusters=args.max_clusters,
         mesh_size=args.mesh_size,
         min_cluster_size=args.min_cluster_size,
@@ -394,7 +673,11 @@ def cluster_plot(args):
     )
 
 
-def _cluster_plot(config_file, plot_file, burnin, max_clusters, mesh_size, min_cluster_size, plot_type, samples, thin):
+def _cluster_plot(config_file, plot_file, burnin, max_clusters, mesh_size, min_cluster_size, plot_type, samples, thin,
+                  clustering_method='mpear'):
+    import pyclone.post_process.plot as plot
+
+    config_file = paths.get_config(config_file)
 
     if plot_type == 'density':
 
@@ -403,6 +686,7 @@ def _cluster_plot(config_file, plot_file, burnin, max_clusters, mesh_size, min_c
             plot_file,
             burnin=burnin,
             thin=thin,
+            clustering_method=clustering_method,
             max_clusters=max_clusters,
             mesh_size=mesh_size,
             min_cluster_size=min_cluster_size,
@@ -415,6 +699,7 @@ def _cluster_plot(config_file, plot_file, burnin, max_clusters, mesh_size, min_c
             config_file,
             plot_file,
             burnin=burnin,
+            clustering_method=clustering_method,
             max_clusters=max_clusters,
             mesh_size=mesh_size,
             min_cluster_size=min_cluster_size,
@@ -428,6 +713,7 @@ def _cluster_plot(config_file, plot_file, burnin, max_clusters, mesh_size, min_c
             config_file,
             plot_file,
             burnin=burnin,
+            clustering_method=clustering_method,
             max_clusters=max_clusters,
             mesh_size=mesh_size,
             min_cluster_size=min_cluster_size,
@@ -442,6 +728,7 @@ def loci_plot(args):
         args.plot_file,
         args.plot_type,
         burnin=args.burnin,
+        clustering_method=args.clustering_method,
         max_clusters=args.max_clusters,
         min_cluster_size=args.min_cluster_size,
         samples=args.samples,
@@ -453,13 +740,19 @@ def _loci_plot(
         plot_file,
         plot_type,
         burnin=0,
+        clustering_method='mpear',
         max_clusters=None,
         min_cluster_size=0,
         samples=None,
         thin=1):
 
+    import pyclone.post_process.plot as plot
+
+    config_file = paths.get_config(config_file)
+
     kwargs = {
         'burnin': burnin,
+        'clustering_method': clustering_method,
         'max_clusters': max_clusters,
         'min_cluster_size': min_cluster_size,
         'samples': samples,
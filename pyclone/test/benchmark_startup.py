@@ -0,0 +1,92 @@
+'''
+Benchmark the start up time of the PyClone command line interface.
+
+Commands such as build_mutations_file are run once per sample by pipelines, so importing the command line interface must
+not pull in the samplers or the post processing modules. Exits with a non-zero status if a heavy module is imported or
+the median start up time exceeds the threshold.
+
+@author: Andrew Roth
+'''
+import argparse
+import subprocess
+import sys
+import time
+
+HEAVY_MODULES = [
+    'matplotlib',
+    'numba',
+    'pandas',
+    'pydp',
+    'scipy',
+    'seaborn',
+    'pyclone.native_sampler',
+    'pyclone.post_process',
+    'pyclone.trace',
+]
+
+IMPORT_CODE = 'import pyclone.cli'
+
+CHECK_CODE = '''
+import sys
+import pyclone.cli
+print('\\n'.join(x for x in {0} if x in sys.modules))
+'''.format(HEAVY_MODULES)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--num_runs', default=10, type=int,
+                        help='''Number of times to start the command line interface. Default is 10.''')
+
+    parser.add_argument('--max_time', default=0.5, type=float,
+                        help='''Maximum median start up time in seconds. Default is 0.5.''')
+
+    args = parser.parse_args()
+
+    failed = False
+
+    imported = subprocess.check_output([sys.executable, '-c', CHECK_CODE]).split()
+
+    if len(imported) > 0:
+        print 'Heavy modules imported at start up: {0}'.format(', '.join(imported))
+
+        failed = True
+
+    baseline = _time_command([sys.executable, '-c', 'pass'], args.num_runs)
+
+    import_time = _time_command([sys.executable, '-c', IMPORT_CODE], args.num_runs)
+
+    help_time = _time_command([sys.executable, '-c', IMPORT_CODE + '; pyclone.cli.main()', '--help'], args.num_runs)
+
+    print 'Interpreter start up: {0:.3f}s'.format(baseline)
+    print 'import pyclone.cli: {0:.3f}s'.format(import_time)
+    print 'PyClone --help: {0:.3f}s'.format(help_time)
+
+    if help_time > args.max_time:
+        print 'Start up time exceeds the maximum of {0:.3f}s'.format(args.max_time)
+
+        failed = True
+
+    sys.exit(int(failed))
+
+
+def _time_command(cmd, num_runs):
+    '''
+    Median wall time of running a command.
+    '''
+    times = []
+
+    with open('/dev/null', 'w') as devnull:
+        for _ in range(num_runs):
+            start = time.time()
+
+            subprocess.check_call(cmd, stdout=devnull)
+
+            times.append(time.time() - start)
+
+    return sorted(times)[num_runs // 2]
+
+
+if __name__ == '__main__':
+    main()
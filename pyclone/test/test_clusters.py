@@ -0,0 +1,116 @@
+'''
+Tests of the MPEAR clustering of the posterior similarity matrix.
+
+Run with python -m unittest pyclone.test.test_clusters
+
+@author: Andrew Roth
+'''
+from __future__ import division
+
+import numpy as np
+import unittest
+
+from pyclone.post_process.clusters import cluster_with_mpear_from_similarity_matrix, _compute_mpear
+
+
+class MPEARTest(unittest.TestCase):
+
+    def test_compute_mpear_matches_pairwise_definition(self):
+        rng = np.random.RandomState(0)
+
+        X = _simulate_trace(rng)
+
+        sim_mat = _get_similarity_matrix(X)
+
+        for labels in [X[-1], np.zeros(X.shape[1], dtype=int), np.arange(X.shape[1]), rng.randint(0, 5, X.shape[1])]:
+            self.assertAlmostEqual(_compute_mpear(labels, sim_mat), _compute_pairwise_mpear(labels, sim_mat))
+
+    def test_cluster_sums_are_reused_across_cuts(self):
+        rng = np.random.RandomState(1)
+
+        sim_mat = _get_similarity_matrix(_simulate_trace(rng))
+
+        cluster_sums = {}
+
+        for labels in [[1, 1, 1, 1, 2, 2, 2, 2] * 5, [1, 1, 3, 3, 2, 2, 2, 2] * 5]:
+            labels = np.array(labels)
+
+            labels[20:] += 3
+
+            self.assertAlmostEqual(
+                _compute_mpear(labels, sim_mat, cluster_sums=cluster_sums),
+                _compute_pairwise_mpear(labels, sim_mat)
+            )
+
+    def test_matches_pydp(self):
+        try:
+            from pydp.cluster import cluster_with_mpear
+
+        except ImportError:
+            self.skipTest('pydp is not installed')
+
+        rng = np.random.RandomState(2)
+
+        for max_clusters in (None, 3):
+            X = _simulate_trace(rng)
+
+            labels = cluster_with_mpear_from_similarity_matrix(_get_similarity_matrix(X), max_clusters=max_clusters)
+
+            pydp_labels = cluster_with_mpear(X, max_clusters=max_clusters)
+
+            np.testing.assert_array_equal(_get_co_clustering(labels), _get_co_clustering(pydp_labels))
+
+
+def _compute_pairwise_mpear(labels, sim_mat):
+    '''
+    Reference implementation summing over every pair of data points.
+    '''
+    N = len(labels)
+
+    num_pairs = N * (N - 1) / 2
+
+    upper = np.triu(np.ones((N, N), dtype=bool), k=1)
+
+    same_cluster = _get_co_clustering(labels) & upper
+
+    num_i = np.sum(same_cluster)
+
+    num_j = np.sum(sim_mat[upper])
+
+    ind_sum = np.sum(sim_mat[same_cluster])
+
+    expected_index = num_i * num_j / num_pairs
+
+    max_index = (num_i + num_j) / 2
+
+    return (ind_sum - expected_index) / (max_index - expected_index)
+
+
+def _get_co_clustering(labels):
+    labels = np.asarray(labels)
+
+    return labels[:, np.newaxis] == labels[np.newaxis, :]
+
+
+def _get_similarity_matrix(X):
+    return np.mean(X[:, :, np.newaxis] == X[:, np.newaxis, :], axis=0)
+
+
+def _simulate_trace(rng, num_samples=200, num_data_points=40, num_clusters=4, noise=0.1):
+    '''
+    Simulate a labels trace of well separated clusters where each data point is placed in a random cluster with
+    probability noise.
+    '''
+    true_labels = rng.randint(0, num_clusters, num_data_points)
+
+    X = np.tile(true_labels, (num_samples, 1))
+
+    swap = rng.random_sample(X.shape) < noise
+
+    X[swap] = rng.randint(0, num_clusters, np.sum(swap))
+
+    return X
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,382 @@
+'''
+Tests of the native Dirichlet process sampler.
+
+Run with python -m unittest pyclone.test.test_native_sampler
+
+@author: Andrew Roth
+'''
+from __future__ import division
+
+from collections import OrderedDict
+
+import numpy as np
+import pickle
+import random
+import unittest
+
+from pyclone.native_sampler import NativeDirichletProcessSampler, _pack_data, _sample_alpha, _sample_params, \
+    _sample_precision
+
+import pyclone.config as config
+
+BASE_MEASURE_PARAMS = {'alpha': 1, 'beta': 1}
+
+ALPHA_PRIORS = {'shape': 1, 'rate': 1}
+
+PRECISION_PARAMS = {'value': 400, 'prior': {'shape': 1, 'rate': 0.001}, 'proposal': {'precision': 0.01}}
+
+SAMPLE_IDS = ['s1', 's2']
+
+
+class NativeSamplerTest(unittest.TestCase):
+
+    def test_partition_invariants(self):
+        data = _get_data([[0.2, 0.8]] * 10 + [[0.9, 0.3]] * 10)
+
+        for density in ('pyclone_binomial', 'pyclone_beta_binomial'):
+            for init_method in ('connected', 'disconnected'):
+                random.seed(1)
+
+                sampler = _get_sampler(density)
+
+                sampler.initialise_partition(data, init_method)
+
+                self._check_partition(sampler, len(data))
+
+                for _ in range(50):
+                    sampler.interactive_sample(data)
+
+                    self._check_partition(sampler, len(data))
+
+    def test_recovers_clusters(self):
+        data = _get_data([[0.2, 0.8]] * 10 + [[0.9, 0.3]] * 10)
+
+        random.seed(1)
+
+        sampler = _get_sampler('pyclone_binomial')
+
+        sampler.initialise_partition(data, 'disconnected')
+
+        labels = []
+
+        for i in range(200):
+            sampler.interactive_sample(data)
+
+            if i >= 100:
+                labels.append(sampler.labels.copy())
+
+        sim_mat = _get_similarity_matrix(labels)
+
+        self.assertTrue(np.all(sim_mat[:10, :10] > 0.9))
+
+        self.assertTrue(np.all(sim_mat[10:, 10:] > 0.9))
+
+        self.assertTrue(np.all(sim_mat[:10, 10:] < 0.1))
+
+    def test_sample_params_keeps_partition(self):
+        data = _get_data([[0.2, 0.8]] * 5 + [[0.9, 0.3]] * 5)
+
+        packed_data = _pack_data(data, SAMPLE_IDS)
+
+        np.random.seed(1)
+
+        labels = np.array([0] * 5 + [1] * 5, dtype=np.int64)
+
+        params = np.full((len(data), len(SAMPLE_IDS)), 0.5)
+
+        for _ in range(100):
+            _sample_params(packed_data, labels, params, 2, 1.0, 1.0, 0, 0.0)
+
+        np.testing.assert_array_equal(labels, [0] * 5 + [1] * 5)
+
+        self.assertTrue(np.all((params[:2] > 0) & (params[:2] < 1)))
+
+        # Parameters of unused cluster slots are not updated.
+        np.testing.assert_array_equal(params[2:], 0.5)
+
+        np.testing.assert_allclose(params[:2], [[0.2, 0.8], [0.9, 0.3]], atol=0.1)
+
+    def test_sample_alpha_positive(self):
+        np.random.seed(1)
+
+        for num_clusters in (1, 10, 100):
+            alpha = 1.0
+
+            for _ in range(1000):
+                alpha = _sample_alpha(alpha, num_clusters, 100, 1.0, 1.0)
+
+                self.assertTrue(np.isfinite(alpha) and (alpha > 0))
+
+    def test_sample_precision_positive(self):
+        data = _get_data([[0.2, 0.8]] * 5 + [[0.9, 0.3]] * 5)
+
+        packed_data = _pack_data(data, SAMPLE_IDS)
+
+        np.random.seed(1)
+
+        labels = np.array([0] * 5 + [1] * 5, dtype=np.int64)
+
+        params = np.array([[0.2, 0.8], [0.9, 0.3]] + [[0.5, 0.5]] * 8)
+
+        precision = 400.0
+
+        for _ in range(100):
+            precision = _sample_precision(packed_data, labels, params, precision, 1.0, 0.001, 0.01)
+
+            self.assertTrue(np.isfinite(precision) and (precision > 0))
+
+    def test_seeded_runs_are_reproducible(self):
+        data = _get_data([[0.2, 0.8]] * 10 + [[0.9, 0.3]] * 10)
+
+        states = []
+
+        for _ in range(2):
+            random.seed(1)
+
+            sampler = _get_sampler('pyclone_beta_binomial')
+
+            sampler.initialise_partition(data, 'disconnected')
+
+            for _ in range(20):
+                sampler.interactive_sample(data)
+
+            states.append(sampler.state)
+
+        self._check_states_equal(states[0], states[1])
+
+    def test_resume_from_pickle(self):
+        data = _get_data([[0.2, 0.8]] * 10 + [[0.9, 0.3]] * 10)
+
+        random.seed(1)
+
+        sampler = _get_sampler('pyclone_beta_binomial')
+
+        sampler.initialise_partition(data, 'disconnected')
+
+        for _ in range(10):
+            sampler.interactive_sample(data)
+
+        checkpoint = pickle.dumps(sampler, protocol=pickle.HIGHEST_PROTOCOL)
+
+        random_state = random.getstate()
+
+        for _ in range(10):
+            sampler.interactive_sample(data)
+
+        resumed_sampler = pickle.loads(checkpoint)
+
+        self.assertIsNone(resumed_sampler.data)
+
+        random.setstate(random_state)
+
+        for _ in range(10):
+            resumed_sampler.interactive_sample(data)
+
+        self._check_states_equal(sampler.state, resumed_sampler.state)
+
+    def test_state_is_snapshot(self):
+        data = _get_data([[0.2, 0.8]] * 10 + [[0.9, 0.3]] * 10)
+
+        random.seed(1)
+
+        sampler = _get_sampler('pyclone_binomial')
+
+        sampler.initialise_partition(data, 'disconnected')
+
+        state = sampler.state
+
+        labels = state['labels'].copy()
+
+        for s, sample_id in enumerate(SAMPLE_IDS):
+            np.testing.assert_array_equal(state['cellular_frequencies'][sample_id], sampler.params[labels, s])
+
+        cellular_frequencies = dict([(x, y.copy()) for x, y in state['cellular_frequencies'].items()])
+
+        for _ in range(5):
+            sampler.interactive_sample(data)
+
+        np.testing.assert_array_equal(state['labels'], labels)
+
+        for sample_id in SAMPLE_IDS:
+            np.testing.assert_array_equal(state['cellular_frequencies'][sample_id], cellular_frequencies[sample_id])
+
+    def _check_partition(self, sampler, num_data_points):
+        num_clusters = sampler.num_clusters
+
+        sizes = sampler.sizes[:num_clusters]
+
+        self.assertEqual(len(sampler.labels), num_data_points)
+
+        self.assertTrue(np.all((sampler.labels >= 0) & (sampler.labels < num_clusters)))
+
+        np.testing.assert_array_equal(np.bincount(sampler.labels, minlength=num_clusters), sizes)
+
+        self.assertEqual(sizes.sum(), num_data_points)
+
+        self.assertTrue(np.all(sizes > 0))
+
+        self.assertTrue(np.all((sampler.params[:num_clusters] > 0) & (sampler.params[:num_clusters] < 1)))
+
+        self.assertTrue(sampler.alpha > 0)
+
+        if sampler.precision_priors is not None:
+            self.assertTrue(sampler.precision > 0)
+
+    def _check_states_equal(self, state, other_state):
+        self.assertEqual(state['alpha'], other_state['alpha'])
+
+        np.testing.assert_array_equal(state['labels'], other_state['labels'])
+
+        for sample_id in SAMPLE_IDS:
+            np.testing.assert_array_equal(
+                state['cellular_frequencies'][sample_id],
+                other_state['cellular_frequencies'][sample_id]
+            )
+
+        self.assertEqual(state['global_params'], other_state['global_params'])
+
+
+class PyDPComparisonTest(unittest.TestCase):
+    '''
+    Compare the posterior of the native sampler to the pydp sampler it replaces.
+    '''
+
+    def test_pyclone_binomial(self):
+        data = _get_data([[0.2, 0.8]] * 5 + [[0.9, 0.3]] * 5 + [[0.5, 0.5]] * 5)
+
+        native_labels, native_ccfs = _run_sampler(_get_sampler('pyclone_binomial'), data)
+
+        try:
+            pydp_sampler = _get_pydp_binomial_sampler()
+
+        except ImportError:
+            self.skipTest('pydp is not installed')
+
+        pydp_labels, pydp_ccfs = _run_sampler(pydp_sampler, data)
+
+        np.testing.assert_allclose(_get_similarity_matrix(native_labels), _get_similarity_matrix(pydp_labels), atol=0.1)
+
+        np.testing.assert_allclose(native_ccfs.mean(axis=0), pydp_ccfs.mean(axis=0), atol=0.02)
+
+
+def _get_data(cellular_prevalences, depth=1000, seed=0):
+    '''
+    Simulate heterozygous diploid mutations with the given cellular prevalence in each sample.
+    '''
+    rng = np.random.RandomState(seed)
+
+    state_tables = config.StateTableCache()
+
+    data = []
+
+    for i, mutation_cellular_prevalences in enumerate(cellular_prevalences):
+        data_point = OrderedDict()
+
+        for sample_id, f in zip(SAMPLE_IDS, mutation_cellular_prevalences):
+            var_counts = rng.binomial(depth, 0.5 * f)
+
+            mutation = config.get_mutation(
+                'm{0}'.format(i), depth - var_counts, var_counts, 2, 1, 1, 'major_copy_number'
+            )
+
+            data_point[sample_id] = config._get_pyclone_data(mutation, 0.001, 1.0, state_tables)
+
+        data.append(data_point)
+
+    return data
+
+
+def _get_pydp_binomial_sampler():
+    from pydp.base_measures import BetaBaseMeasure
+    from pydp.samplers.atom import BaseMeasureAtomSampler
+    from pydp.samplers.dp import DirichletProcessSampler
+    from pydp.samplers.partition import AuxillaryParameterPartitionSampler
+
+    from pyclone.multi_sample import MultiSampleBaseMeasure, MultiSampleDensity, MultiSampleAtomSampler
+    from pyclone.pyclone_binomial import PyCloneBinomialDensity
+
+    sample_base_measures = OrderedDict()
+
+    sample_cluster_densities = OrderedDict()
+
+    sample_atom_samplers = OrderedDict()
+
+    for sample_id in SAMPLE_IDS:
+        sample_base_measures[sample_id] = BetaBaseMeasure(BASE_MEASURE_PARAMS['alpha'], BASE_MEASURE_PARAMS['beta'])
+
+        sample_cluster_densities[sample_id] = PyCloneBinomialDensity()
+
+        sample_atom_samplers[sample_id] = BaseMeasureAtomSampler(
+            sample_base_measures[sample_id],
+            sample_cluster_densities[sample_id]
+        )
+
+    base_measure = MultiSampleBaseMeasure(sample_base_measures)
+
+    cluster_density = MultiSampleDensity(sample_cluster_densities)
+
+    atom_sampler = MultiSampleAtomSampler(base_measure, cluster_density, sample_atom_samplers)
+
+    partition_sampler = AuxillaryParameterPartitionSampler(base_measure, cluster_density)
+
+    return DirichletProcessSampler(atom_sampler, partition_sampler, 1.0, ALPHA_PRIORS)
+
+
+def _get_sampler(density):
+    if density == 'pyclone_beta_binomial':
+        precision_params = PRECISION_PARAMS
+
+    else:
+        precision_params = None
+
+    return NativeDirichletProcessSampler(
+        density,
+        SAMPLE_IDS,
+        BASE_MEASURE_PARAMS,
+        1.0,
+        alpha_priors=ALPHA_PRIORS,
+        precision_params=precision_params
+    )
+
+
+def _get_similarity_matrix(labels):
+    labels = np.array(labels)
+
+    return np.mean(labels[:, :, np.newaxis] == labels[:, np.newaxis, :], axis=0)
+
+
+def _run_sampler(sampler, data, num_iters=1000, burnin=200, seed=1):
+    '''
+    Run a sampler from a fixed seed and return the post burnin labels and cellular prevalences of sample s1.
+    '''
+    random.seed(seed)
+
+    np.random.seed(seed)
+
+    sampler.initialise_partition(data, 'disconnected')
+
+    labels = []
+
+    cellular_prevalences = []
+
+    for i in range(num_iters):
+        sampler.interactive_sample(data)
+
+        if i < burnin:
+            continue
+
+        state = sampler.state
+
+        labels.append(np.array(state['labels']))
+
+        if 'cellular_frequencies' in state:
+            cellular_prevalences.append(state['cellular_frequencies']['s1'])
+
+        else:
+            cellular_prevalences.append([x['s1'].x for x in state['params']])
+
+    return labels, np.array(cellular_prevalences)
+
+
+if __name__ == '__main__':
+    unittest.main()
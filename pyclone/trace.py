@@ -3,41 +3,398 @@ Created on 2013-04-23
 
 @author: Andrew Roth
 '''
+try:
+    from yaml import CDumper as Dumper, CLoader as Loader
+except ImportError:
+    from yaml import Dumper, Loader
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 import bz2
 import csv
+import numpy as np
+import os
 import pandas as pd
+import scipy.sparse as sp
+import threading
+import traceback
+import yaml
 
+from pyclone.math_utils import jit
 from pyclone.utils import make_directory
 
 import pyclone.paths as paths
 
 
-def load_cellular_frequencies_trace(file_name, burnin, thin):
-    return _load_trace(file_name, burnin, thin, float)
+def load_cluster_labels_traces(config_file, burnin, thin, columns=None):
+    '''
+    Load the cluster labels trace. The post burnin samples of all chains are concatenated.
+
+    Args:
+        columns : (list) Mutation IDs to load. If None all mutations are loaded.
+    '''
+    trace_files = [paths.get_labels_trace_file(config_file, chain=x) for x in paths.get_chain_ids(config_file)]
+
+    return _concat_traces([load_cluster_labels_trace(x, burnin, thin, columns=columns) for x in trace_files])
+
+
+def load_precision_traces(config_file, burnin, thin):
+    '''
+    Load the beta-binomial precision trace as a Series. The post burnin samples of all chains are concatenated.
+    '''
+    traces = []
+
+    for chain_id in paths.get_chain_ids(config_file):
+        trace_file = paths.get_precision_trace_file(config_file, chain=chain_id)
+
+        traces.append(load_scalar_trace(trace_file, burnin, thin))
+
+    return _concat_traces(traces)
+
+
+def iter_cellular_frequencies_trace_blocks(config_file, sample_id, burnin, thin, block_size=1000):
+    '''
+    Iterate over the post burnin cellular prevalence trace of a sample in blocks of rows, chain by chain, without
+    loading the full trace into memory.
+
+    The blocks of every chain are reordered to the columns of the first chain, so they can be combined by position.
+
+    Yields:
+        (DataFrame) Block of at most block_size rows with one column per mutation.
+    '''
+    columns = None
+
+    for file_name in _get_cellular_frequencies_trace_files(config_file, sample_id):
+        for block in _iter_trace_file_blocks(file_name, burnin, thin, block_size):
+            if columns is None:
+                columns = list(block.columns)
+
+            elif list(block.columns) != columns:
+                if set(block.columns) != set(columns):
+                    raise Exception('Trace file {0} does not have the same mutations as the first chain.'.format(
+                        file_name))
+
+                block = block[columns]
+
+            yield block
+
+
+def _iter_trace_file_blocks(file_name, burnin, thin, block_size):
+    if _is_binary_trace_file(file_name):
+        reader = BinaryTraceReader(file_name)
+
+        for block in reader.iter_blocks(burnin=burnin, thin=thin, block_size=block_size):
+            yield pd.DataFrame(block, columns=reader.columns)
+
+    else:
+        reader = pd.read_csv(file_name, compression='bz2', sep='\t', chunksize=block_size)
+
+        for block in reader:
+            rows = block.index.values
+
+            block = block[(rows >= burnin) & ((rows - burnin) % thin == 0)]
+
+            if len(block) > 0:
+                yield block.astype(float)
+
+
+def load_similarity_matrices(config_file, burnin, thin, columns=None):
+    '''
+    Load the posterior similarity matrix accumulated during sampling, averaged over chains.
+
+    Returns None if any chain has no matrix or it was accumulated with a different burnin or thin, in which case the
+    matrix has to be computed from the labels trace.
+
+    Each chain is restricted to the requested mutations before the chains are summed, so memory scales with the number
+    of columns rather than the number of mutations.
+
+    Args:
+        columns : (list) Mutation IDs to load. If None all mutations are loaded.
+
+    Returns:
+        (DataFrame) Symmetric matrix of co-clustering probabilities indexed by mutation ID.
+    '''
+    counts = None
+
+    mutation_ids = None
+
+    num_samples = 0
+
+    for chain_id in paths.get_chain_ids(config_file):
+        file_name = paths.get_similarity_matrix_file(config_file, chain=chain_id)
+
+        if not os.path.exists(file_name):
+            return None
+
+        chain_sim_mat = SimilarityMatrix.load(file_name)
+
+        if (chain_sim_mat.burnin != burnin) or (chain_sim_mat.thin != thin):
+            return None
+
+        if mutation_ids is None:
+            mutation_ids = chain_sim_mat.mutation_ids
+
+            if columns is None:
+                columns = mutation_ids
+
+            index = dict([(x, i) for i, x in enumerate(mutation_ids)])
+
+            rows = np.array([index[x] for x in columns], dtype=np.int64)
+
+        elif chain_sim_mat.mutation_ids != mutation_ids:
+            return None
+
+        chain_counts = chain_sim_mat.get_counts(rows=rows)
+
+        if counts is None:
+            counts = chain_counts
+
+        else:
+            counts += chain_counts
+
+        num_samples += chain_sim_mat.num_samples
+
+    if num_samples == 0:
+        return None
+
+    return pd.DataFrame(counts / num_samples, index=columns, columns=columns)
+
+
+def _get_cellular_frequencies_trace_files(config_file, sample_id):
+    chain_ids = paths.get_chain_ids(config_file)
+
+    return [paths.get_cellular_prevalence_trace_files(config_file, chain=x)[sample_id] for x in chain_ids]
+
 
+def _concat_traces(traces):
+    if len(traces) == 1:
+        return traces[0]
 
-def load_cluster_labels_trace(file_name, burnin, thin):
-    return _load_trace(file_name, burnin, thin, int)
+    return pd.concat(traces, axis=0, ignore_index=True)
 
 
-def _load_trace(trace_file, burnin, thin, cast_func):
+def load_cellular_frequencies_trace(file_name, burnin, thin, columns=None):
+    return _load_trace(file_name, burnin, thin, float, columns=columns)
+
+
+def load_cluster_labels_trace(file_name, burnin, thin, columns=None):
+    return _load_trace(file_name, burnin, thin, int, columns=columns)
+
+
+def load_scalar_trace(file_name, burnin, thin):
+    '''
+    Load the trace of a scalar parameter such as the concentration or precision as a Series.
+    '''
+    if _is_binary_trace_file(file_name):
+        reader = BinaryTraceReader(file_name)
+
+        trace = pd.Series(reader.view(burnin=burnin, thin=thin), index=reader.get_index(burnin, thin))
+
+    else:
+        trace = pd.read_csv(file_name, header=None, compression='bz2', sep='\t', squeeze=True)
+
+        trace = trace.iloc[burnin::thin]
+
+    return trace.astype(float)
+
+
+def _load_trace(trace_file, burnin, thin, cast_func, columns=None):
     '''
         Args:
             trace_file : (str) Path to file to load.
             burnin : (int) Number of samples from the begining of MCMC chain to discard.
             thin : (int) Number of samples to skip when building trace.
             cast_func : (function) A function to cast data from string to appropriate type i.e. int, float
+            columns : (list) Columns to load. If None all columns are loaded.
+
+        Binary traces are memory mapped and, when all columns are loaded and the stored type matches cast_func, the
+        returned DataFrame is a strided view of the file rather than a copy.
     '''
-    trace = pd.read_csv(trace_file, compression='bz2', sep='\t')
+    if _is_binary_trace_file(trace_file):
+        reader = BinaryTraceReader(trace_file)
+
+        values = reader.view(burnin=burnin, thin=thin, columns=columns)
+
+        if columns is None:
+            columns = reader.columns
+
+        trace = pd.DataFrame(values, index=reader.get_index(burnin, thin), columns=columns, copy=False)
+
+        if values.dtype.kind == np.dtype(cast_func).kind:
+            return trace
+
+    else:
+        trace = pd.read_csv(trace_file, compression='bz2', sep='\t', usecols=columns)
+
+        if columns is not None:
+            trace = trace[columns]
 
-    trace = trace.iloc[burnin::thin]
+        trace = trace.iloc[burnin::thin]
 
     return trace.astype(cast_func)
 
 
+def _is_binary_trace_file(file_name):
+    return file_name.endswith(paths.TRACE_FILE_EXTENSIONS['binary'])
+
+
+def _load_binary_trace_header(file_name):
+    with open(get_binary_trace_header_file(file_name)) as fh:
+        return yaml.load(fh, Loader=Loader)
+
+
+def get_binary_trace_header_file(file_name):
+    return os.path.splitext(file_name)[0] + '.header.yaml'
+
+
+class BinaryTraceReader(object):
+    '''
+    Memory mapped access to a trace written by BinaryTraceWriter. Only the pages touched by a view are read from disk
+    so traces larger than memory can be used.
+
+    Args:
+        file_name : (str) Path to the binary trace file.
+    '''
+
+    def __init__(self, file_name):
+        header = _load_binary_trace_header(file_name)
+
+        self.columns = header['columns']
+
+        self.dtype = np.dtype(header['dtype'])
+
+        num_values = os.path.getsize(file_name) // self.dtype.itemsize
+
+        if self.columns is None:
+            shape = (num_values,)
+
+        else:
+            shape = (num_values // len(self.columns), len(self.columns))
+
+        # Trailing partial rows left by an interrupted run are ignored.
+        if shape[0] == 0:
+            self.values = np.zeros(shape, dtype=self.dtype)
+
+        else:
+            self.values = np.memmap(file_name, dtype=self.dtype, mode='r', shape=shape)
+
+    @property
+    def num_rows(self):
+        return self.values.shape[0]
+
+    def get_index(self, burnin=0, thin=1):
+        '''
+        Get the iteration numbers of the rows of view(burnin, thin).
+        '''
+        return pd.RangeIndex(burnin, max(burnin, self.num_rows), thin)
+
+    def get_column_indices(self, columns):
+        column_index = dict(zip(self.columns, range(len(self.columns))))
+
+        return np.array([column_index[x] for x in columns], dtype=int)
+
+    def iter_blocks(self, burnin=0, thin=1, block_size=1000, columns=None):
+        '''
+        Iterate over the view(burnin, thin, columns) in blocks of at most block_size rows.
+        '''
+        values = self.values[burnin::thin]
+
+        if columns is not None:
+            column_indices = self.get_column_indices(columns)
+
+        for start in range(0, values.shape[0], block_size):
+            block = values[start:start + block_size]
+
+            if columns is not None:
+                block = block[:, column_indices]
+
+            yield block
+
+    def view(self, burnin=0, thin=1, columns=None):
+        '''
+        Get the trace with burnin and thinning applied. Without a column subset this is a zero copy strided view of
+        the memory map. Selecting columns copies only the selected columns.
+        '''
+        values = self.values[burnin::thin]
+
+        if columns is not None:
+            values = values[:, self.get_column_indices(columns)]
+
+        return values
+
+
+def export_trace(config_file, out_dir):
+    '''
+    Export the trace of an analysis to the legacy bz2 compressed tsv format.
+
+    Args:
+        config_file : (str | PyCloneConfig) Path to configuration file used for analysis.
+        out_dir : (str) Directory where the trace files will be written. Chains are written to chain_<i> sub
+            directories as in the trace directory.
+    '''
+    for chain_id in paths.get_chain_ids(config_file):
+        if chain_id is None:
+            chain_dir = out_dir
+
+        else:
+            chain_dir = os.path.join(out_dir, 'chain_{0}'.format(chain_id))
+
+        make_directory(chain_dir)
+
+        trace_files = list(paths.get_cellular_prevalence_trace_files(config_file, chain=chain_id).values())
+
+        trace_files.append(paths.get_labels_trace_file(config_file, chain=chain_id))
+
+        for file_name in trace_files:
+            if not _is_binary_trace_file(file_name):
+                continue
+
+            reader = BinaryTraceReader(file_name)
+
+            writer = TsvTraceWriter(_get_tsv_export_file(file_name, chain_dir), columns=reader.columns)
+
+            for row in reader.values:
+                writer.write_row(row)
+
+            writer.close()
+
+        scalar_files = [
+            paths.get_concentration_trace_file(config_file, chain=chain_id),
+            paths.get_precision_trace_file(config_file, chain=chain_id)
+        ]
+
+        for file_name in scalar_files:
+            if (not _is_binary_trace_file(file_name)) or (not os.path.exists(file_name)):
+                continue
+
+            writer = TsvTraceWriter(_get_tsv_export_file(file_name, chain_dir))
+
+            for x in BinaryTraceReader(file_name).values:
+                writer.write_row([x, ])
+
+            writer.close()
+
+
+def _get_tsv_export_file(file_name, out_dir):
+    name = os.path.basename(file_name)[:-len(paths.TRACE_FILE_EXTENSIONS['binary'])]
+
+    return os.path.join(out_dir, name + paths.TRACE_FILE_EXTENSIONS['tsv'])
+
+
 class DiskTrace(object):
+    '''
+    Write the sampler state to the trace files.
+
+    If trace_async is set in the config file, update copies the state into a bounded queue and a background thread
+    does the formatting and compression, so trace I/O overlaps with sampling. update blocks when the queue is full.
+    '''
+
+    def __init__(self, config_file, mutation_ids, attribute_map, precision=False, chain=None, max_queue_size=100):
+        self.chain = chain
 
-    def __init__(self, config_file, mutation_ids, attribute_map, precision=False):
         self.config_file = config_file
 
         self.sample_ids = paths.get_sample_ids(config_file)
@@ -48,7 +405,20 @@ class DiskTrace(object):
 
         self.update_precision = precision
 
+        self.async_writes = paths.get_trace_async(config_file)
+
+        self.max_queue_size = max_queue_size
+
+        self.similarity_matrix_params = paths.get_similarity_matrix_params(config_file)
+
     def close(self):
+        if self.async_writes:
+            self._queue.put(None)
+
+            self._writer_thread.join()
+
+        self._write_similarity_matrix()
+
         self.alpha_writer.close()
 
         self.labels_writer.close()
@@ -59,118 +429,563 @@ class DiskTrace(object):
         if self.update_precision:
             self.precision_writer.close()
 
-    def open(self):
-        make_directory(paths.get_trace_dir(self.config_file))
+        if self.async_writes:
+            self._raise_writer_error()
+
+    def flush(self):
+        '''
+        Wait for queued rows to be written and flush the trace files.
+        '''
+        if self.async_writes:
+            self._queue.join()
+
+            self._raise_writer_error()
+
+        self.alpha_writer.flush()
 
-        self.alpha_writer = ConcentrationParameterWriter(paths.get_concentration_trace_file(self.config_file))
+        self.labels_writer.flush()
 
-        self.labels_writer = LabelsWriter(
-            paths.get_labels_trace_file(self.config_file),
-            self.mutation_ids
+        for writer in self.cellular_frequency_writers.values():
+            writer.flush()
+
+        if self.update_precision:
+            self.precision_writer.flush()
+
+    def open(self, num_rows=None, similarity_matrix=None):
+        '''
+        Open the trace files for writing.
+
+        Args:
+            num_rows : (int) If set, keep the first num_rows rows of the existing trace files and append to them.
+                Otherwise the files are overwritten.
+            similarity_matrix : (SimilarityMatrix) Similarity matrix to continue accumulating when resuming.
+        '''
+        make_directory(paths.get_trace_dir(self.config_file, chain=self.chain))
+
+        trace_format = paths.get_trace_format(self.config_file)
+
+        self.alpha_writer = get_trace_writer(
+            trace_format,
+            paths.get_concentration_trace_file(self.config_file, chain=self.chain),
+            np.float64,
+            num_rows=num_rows
+        )
+
+        self.labels_writer = get_trace_writer(
+            trace_format,
+            paths.get_labels_trace_file(self.config_file, chain=self.chain),
+            np.int32,
+            columns=self.mutation_ids,
+            num_rows=num_rows
         )
 
         self.cellular_frequency_writers = {}
 
-        for sample_id, file_name in paths.get_cellular_prevalence_trace_files(self.config_file).items():
-            self.cellular_frequency_writers[sample_id] = CellularFrequenciesWriter(
+        trace_files = paths.get_cellular_prevalence_trace_files(self.config_file, chain=self.chain)
+
+        for sample_id, file_name in trace_files.items():
+            self.cellular_frequency_writers[sample_id] = get_trace_writer(
+                trace_format,
                 file_name,
-                self.mutation_ids,
-                sample_id
+                np.float32,
+                columns=self.mutation_ids,
+                num_rows=num_rows
             )
 
         if self.update_precision:
-            self.precision_writer = PrecisionWriter(paths.get_precision_trace_file(self.config_file))
+            self.precision_writer = get_trace_writer(
+                trace_format,
+                paths.get_precision_trace_file(self.config_file, chain=self.chain),
+                np.float64,
+                num_rows=num_rows
+            )
+
+        self.num_rows = 0 if num_rows is None else num_rows
+
+        self._open_similarity_matrix(num_rows, similarity_matrix)
+
+        if self.async_writes:
+            self._queue = queue.Queue(maxsize=self.max_queue_size)
+
+            self._writer_error = None
+
+            self._writer_thread = threading.Thread(target=self._write_queued_rows)
+
+            self._writer_thread.daemon = True
+
+            self._writer_thread.start()
 
     def update(self, state):
-        self.alpha_writer.write_row([state['alpha'], ])
+        rows = self._get_rows(state)
 
-        self.labels_writer.write_row(state['labels'])
+        if self.async_writes:
+            self._raise_writer_error()
 
-        for sample_id in self.sample_ids:
-            row = []
+            self._queue.put(rows)
 
-            for param in state['params']:
-                attr = self.attribute_map['cellular_frequencies']
+        else:
+            self._write_rows(rows)
 
-                row.append(getattr(param[sample_id], attr))
+    def _get_rows(self, state):
+        '''
+        Copy the values to write out of the sampler state, so they are not affected by later sampler updates.
 
-            self.cellular_frequency_writers[sample_id].write_row(row)
+        Samplers which keep their parameters in arrays, such as the native sampler, pass the cellular prevalence of each
+        data point as an array per sample in state['cellular_frequencies']. These are snapshots already and are used
+        as is. Otherwise the values are read from the per data point parameters in state['params'].
+        '''
+        rows = {
+            'alpha': [state['alpha'], ],
+            'labels': np.array(state['labels'])
+        }
+
+        if 'cellular_frequencies' in state:
+            rows['cellular_frequencies'] = state['cellular_frequencies']
+
+        else:
+            attr = self.attribute_map['cellular_frequencies']
+
+            rows['cellular_frequencies'] = {}
+
+            for sample_id in self.sample_ids:
+                rows['cellular_frequencies'][sample_id] = np.array(
+                    [getattr(x[sample_id], attr) for x in state['params']]
+                )
 
         if self.update_precision:
-            self.precision_writer.write_row([state['global_params'].x])
+            rows['precision'] = [state['global_params'].x]
 
+        return rows
 
-class ConcentrationParameterWriter(object):
+    def _write_rows(self, rows):
+        self.alpha_writer.write_row(rows['alpha'])
 
-    def __init__(self, file_name):
-        self.file_name = file_name
+        self.labels_writer.write_row(rows['labels'])
 
-        self.file_handle = bz2.BZ2File(self.file_name, 'w')
+        for sample_id in self.sample_ids:
+            self.cellular_frequency_writers[sample_id].write_row(rows['cellular_frequencies'][sample_id])
 
-        self.writer = csv.writer(self.file_handle, delimiter='\t')
+        if self.update_precision:
+            self.precision_writer.write_row(rows['precision'])
 
-        self.param_id = 'alpha'
+        if self.similarity_matrix is not None:
+            burnin = self.similarity_matrix.burnin
 
-    def close(self):
-        self.file_handle.close()
+            if (self.num_rows >= burnin) and ((self.num_rows - burnin) % self.similarity_matrix.thin == 0):
+                self.similarity_matrix.update(rows['labels'])
 
-    def write_row(self, row):
-        self.writer.writerow(row)
+        self.num_rows += 1
 
+    def _open_similarity_matrix(self, num_rows, similarity_matrix):
+        if self.similarity_matrix_params is None:
+            self.similarity_matrix = None
 
-class CellularFrequenciesWriter(object):
+        elif num_rows is None:
+            self.similarity_matrix = SimilarityMatrix(
+                self.mutation_ids,
+                burnin=self.similarity_matrix_params['burnin'],
+                thin=self.similarity_matrix_params['thin'],
+                sparse=(self.similarity_matrix_params['format'] == 'sparse')
+            )
 
-    def __init__(self, file_name, mutation_ids, sample_id):
-        self.file_name = file_name
+        elif similarity_matrix is None:
+            raise Exception('The checkpoint has no similarity matrix. Cannot resume analysis.')
 
-        self.file_handle = bz2.BZ2File(self.file_name, 'w')
+        else:
+            self.similarity_matrix = similarity_matrix
 
-        self.writer = csv.writer(self.file_handle, delimiter='\t')
+    def _write_similarity_matrix(self):
+        if self.similarity_matrix is None:
+            return
 
-        self.writer.writerow(mutation_ids)
+        self.similarity_matrix.num_iters = self.num_rows
 
-        self.param_id = (sample_id, 'cellular_frequencies')
+        self.similarity_matrix.save(
+            paths.get_similarity_matrix_file(self.config_file, chain=self.chain),
+            matrix_format=self.similarity_matrix_params['format']
+        )
 
-    def close(self):
-        self.file_handle.close()
+    def _write_queued_rows(self):
+        while True:
+            rows = self._queue.get()
 
-    def write_row(self, row):
-        self.writer.writerow(row)
+            if rows is None:
+                self._queue.task_done()
+
+                break
+
+            # Keep draining the queue after an error so the sampler never blocks on a full queue.
+            if self._writer_error is None:
+                try:
+                    self._write_rows(rows)
+
+                except Exception:
+                    self._writer_error = traceback.format_exc()
+
+            self._queue.task_done()
+
+    def _raise_writer_error(self):
+        if self._writer_error is not None:
+            raise Exception('Error writing trace in background thread.\n{0}'.format(self._writer_error))
+
+#=======================================================================================================================
+# Similarity matrix
+#=======================================================================================================================
+
+
+class SimilarityMatrix(object):
+    '''
+    Running count of how often each pair of mutations is in the same cluster.
+
+    By default the counts of the upper triangle are kept in a dense int32 matrix. If sparse is set they are kept in a
+    sparse matrix instead, with draws buffered and added block_size at a time as the product of the cluster indicator
+    matrix of the block with its transpose. Each stored pair then costs three to four times as much as a dense entry,
+    so the sparse matrix only saves memory when the posterior is fragmented into many small clusters and most pairs
+    are never clustered together.
+
+    Saved as a npz file holding either the dense float32 matrix of co-clustering probabilities or, in the sparse format,
+    the non-zero entries of its upper triangle.
+
+    Args:
+        mutation_ids : (list) Mutation IDs in the order of the labels.
+        burnin : (int) Number of iterations discarded before accumulating.
+        thin : (int) Accumulate every thin-th iteration after burnin.
+        sparse : (bool) Whether to keep the counts in a sparse matrix.
+        block_size : (int) Number of draws buffered before they are added to the sparse counts.
+    '''
+
+    def __init__(self, mutation_ids, burnin=0, thin=1, sparse=False, block_size=100):
+        self.mutation_ids = list(mutation_ids)
+
+        self.burnin = burnin
+
+        self.thin = thin
+
+        self.sparse = sparse
+
+        self.block_size = block_size
+
+        self.num_iters = 0
+
+        self.num_samples = 0
+
+        shape = (len(self.mutation_ids), len(self.mutation_ids))
+
+        if self.sparse:
+            self._counts = sp.csr_matrix(shape, dtype=np.int32)
+
+        else:
+            self._counts = np.zeros(shape, dtype=np.int32)
+
+        self._labels = []
+
+    @property
+    def counts(self):
+        '''
+        Matrix of co-clustering counts of the pairs in the upper triangle. Sparse if the sparse option is set.
+        '''
+        self._add_buffered_labels()
+
+        return self._counts
+
+    @staticmethod
+    def load(file_name):
+        '''
+        Load a saved matrix. The counts are kept in the same format as the file.
+        '''
+        with np.load(file_name) as fh:
+            sim_mat = SimilarityMatrix(
+                [str(x) for x in fh['mutation_ids']],
+                burnin=int(fh['burnin']),
+                thin=int(fh['thin']),
+                sparse=('values' not in fh)
+            )
+
+            sim_mat.num_iters = int(fh['num_iters'])
+
+            sim_mat.num_samples = int(fh['num_samples'])
+
+            # Probabilities are stored as float32 which represents count / num_samples exactly enough to recover
+            # counts.
+            if sim_mat.sparse:
+                values = np.rint(fh['sparse_values'].astype(np.float64) * sim_mat.num_samples).astype(np.int32)
+
+                sim_mat._counts = sp.csr_matrix((values, (fh['rows'], fh['cols'])), shape=sim_mat._counts.shape)
+
+            else:
+                values = fh['values']
+
+                # Convert a block of rows at a time to bound the size of the float64 temporaries.
+                for start in range(0, values.shape[0], sim_mat.block_size):
+                    stop = start + sim_mat.block_size
+
+                    block = np.rint(values[start:stop].astype(np.float64) * sim_mat.num_samples)
+
+                    sim_mat._counts[start:stop] = np.triu(block, k=start + 1)
+
+        return sim_mat
+
+    def get_counts(self, rows=None):
+        '''
+        Get the dense symmetric matrix of co-clustering counts, with num_samples on the diagonal.
+
+        Args:
+            rows : (list) Indices of the mutations to restrict the matrix to. If None all mutations are used.
+        '''
+        counts = self.counts
+
+        if self.sparse:
+            counts = (counts + counts.T).tocsr()
+
+            if rows is not None:
+                counts = counts[rows][:, rows]
+
+            counts = counts.toarray().astype(np.float64)
+
+        else:
+            if rows is not None:
+                counts = counts[np.ix_(rows, rows)]
+
+            counts = counts.astype(np.float64)
+
+            counts = counts + counts.T
+
+        np.fill_diagonal(counts, self.num_samples)
 
+        return counts
 
-class LabelsWriter(object):
+    def save(self, file_name, matrix_format=None):
+        '''
+        Save the matrix as a npz file.
 
-    def __init__(self, file_name, mutation_ids):
+        Args:
+            matrix_format : (str) Either dense or sparse. If None the format the counts are kept in is used.
+        '''
+        if matrix_format is None:
+            matrix_format = 'sparse' if self.sparse else 'dense'
+
+        arrays = {
+            'burnin': self.burnin,
+            'mutation_ids': np.array([str(x) for x in self.mutation_ids]),
+            'num_iters': self.num_iters,
+            'num_samples': self.num_samples,
+            'thin': self.thin
+        }
+
+        num_samples = max(self.num_samples, 1)
+
+        if matrix_format == 'dense':
+            if self.sparse:
+                values = self.get_counts().astype(np.float32)
+
+            else:
+                # Dividing in float32 avoids a float64 copy and rounds correctly while counts are below 2^24.
+                values = self.counts.astype(np.float32)
+
+                values += values.T
+
+                np.fill_diagonal(values, self.num_samples)
+
+            values /= num_samples
+
+            arrays['values'] = values
+
+        else:
+            if self.sparse:
+                counts = self.counts.tocoo()
+
+                rows, cols, values = counts.row, counts.col, counts.data
+
+            else:
+                rows, cols = np.nonzero(self.counts)
+
+                values = self.counts[rows, cols]
+
+            arrays['rows'] = rows.astype(np.int32)
+
+            arrays['cols'] = cols.astype(np.int32)
+
+            arrays['sparse_values'] = (values.astype(np.float64) / num_samples).astype(np.float32)
+
+        # Write to a temporary file then rename so readers never see a partial file.
+        tmp_file_name = file_name + '.tmp.npz'
+
+        np.savez(tmp_file_name, **arrays)
+
+        os.rename(tmp_file_name, file_name)
+
+    def update(self, labels):
+        labels = np.array(labels, dtype=np.int64)
+
+        self.num_samples += 1
+
+        if self.sparse:
+            self._labels.append(labels)
+
+            if len(self._labels) >= self.block_size:
+                self._add_buffered_labels()
+
+        else:
+            _update_similarity_counts(self._counts, labels)
+
+    def _add_buffered_labels(self):
+        if (len(self._labels) == 0) or (len(self.mutation_ids) == 0):
+            self._labels = []
+
+            return
+
+        num_mutations = len(self.mutation_ids)
+
+        # One column per cluster of each draw, so Z.Z^T counts the draws in which each pair shares a cluster.
+        cols = []
+
+        offset = 0
+
+        for labels in self._labels:
+            _, labels = np.unique(labels, return_inverse=True)
+
+            cols.append(labels.ravel() + offset)
+
+            offset += labels.max() + 1
+
+        cols = np.concatenate(cols)
+
+        rows = np.tile(np.arange(num_mutations), len(self._labels))
+
+        Z = sp.csr_matrix((np.ones(len(cols), dtype=np.int32), (rows, cols)), shape=(num_mutations, offset))
+
+        self._counts = self._counts + sp.triu(Z.dot(Z.T), k=1, format='csr')
+
+        self._labels = []
+
+
+@jit(cache=True, nopython=True)
+def _update_similarity_counts(counts, labels):
+    order = np.argsort(labels)
+
+    n = len(labels)
+
+    start = 0
+
+    # Loop over runs of equal labels in sorted order so only pairs in the same cluster are visited.
+    while start < n:
+        stop = start + 1
+
+        while (stop < n) and (labels[order[stop]] == labels[order[start]]):
+            stop += 1
+
+        for a in range(start, stop):
+            for b in range(a + 1, stop):
+                i = min(order[a], order[b])
+
+                j = max(order[a], order[b])
+
+                counts[i, j] += 1
+
+        start = stop
+
+#=======================================================================================================================
+# Trace writers
+#=======================================================================================================================
+
+
+def get_trace_writer(trace_format, file_name, dtype, columns=None, num_rows=None):
+    '''
+    Get a writer for the trace format.
+
+    Args:
+        trace_format : (str) Either binary or tsv.
+        file_name : (str) Path of the trace file.
+        dtype : (numpy.dtype) Type of the values stored by the binary format.
+        columns : (list) Column names. None for scalar parameters.
+        num_rows : (int) If set, keep the first num_rows rows of the existing file and append to it.
+    '''
+    if trace_format == 'binary':
+        return BinaryTraceWriter(file_name, dtype, columns=columns, num_rows=num_rows)
+
+    elif trace_format == 'tsv':
+        if num_rows is not None:
+            raise Exception('Trace file {0} is in the tsv format which cannot be appended to.'.format(file_name))
+
+        return TsvTraceWriter(file_name, columns=columns)
+
+    else:
+        raise Exception('{0} is not a valid trace format.'.format(trace_format))
+
+
+class BinaryTraceWriter(object):
+    '''
+    Write rows of fixed width values to a flat binary file. The dtype and column names are stored in a YAML header
+    file next to the trace, the number of rows is inferred from the file size.
+    '''
+
+    def __init__(self, file_name, dtype, columns=None, num_rows=None):
         self.file_name = file_name
 
-        self.file_handle = bz2.BZ2File(self.file_name, 'w')
+        self.dtype = np.dtype(dtype)
 
-        self.writer = csv.writer(self.file_handle, delimiter='\t')
+        self.columns = columns
+
+        if num_rows is None:
+            with open(get_binary_trace_header_file(file_name), 'w') as fh:
+                header = {
+                    'columns': None if columns is None else [str(x) for x in columns],
+                    'dtype': self.dtype.str
+                }
+
+                yaml.dump(header, fh, default_flow_style=False, Dumper=Dumper)
+
+            self.file_handle = open(self.file_name, 'wb')
+
+        else:
+            reader = BinaryTraceReader(file_name)
+
+            if reader.num_rows < num_rows:
+                raise Exception('Trace file {0} has {1} rows but {2} are required to resume.'.format(
+                    file_name, reader.num_rows, num_rows))
+
+            row_size = reader.values[0].nbytes if reader.num_rows > 0 else 0
 
-        self.writer.writerow(mutation_ids)
+            del reader
 
-        self.param_id = 'labels'
+            self.file_handle = open(self.file_name, 'r+b')
+
+            self.file_handle.truncate(num_rows * row_size)
+
+            self.file_handle.seek(0, os.SEEK_END)
 
     def close(self):
         self.file_handle.close()
 
+    def flush(self):
+        self.file_handle.flush()
+
     def write_row(self, row):
-        self.writer.writerow(row)
+        self.file_handle.write(np.asarray(row, dtype=self.dtype).tostring())
 
 
-class PrecisionWriter(object):
+class TsvTraceWriter(object):
+    '''
+    Write rows to a bz2 compressed tab separated file. This is the legacy trace format.
 
-    def __init__(self, file_name):
+    The bz2 stream is only complete once the file is closed, so tsv traces do not support checkpoints.
+    '''
+
+    def __init__(self, file_name, columns=None):
         self.file_name = file_name
 
         self.file_handle = bz2.BZ2File(self.file_name, 'w')
 
         self.writer = csv.writer(self.file_handle, delimiter='\t')
 
-        self.param_id = 'precision'
+        if columns is not None:
+            self.writer.writerow(columns)
 
     def close(self):
         self.file_handle.close()
 
+    def flush(self):
+        pass
+
     def write_row(self, row):
         self.writer.writerow(row)